@@ -0,0 +1,129 @@
+"""
+Benchmark of the Bot API client settings (BotAPIRequest) against a local fake Bot API.
+
+Starts a fake Bot API in a subprocess (uvicorn, 20ms per request) and measures:
+- throughput of 1000 concurrent sendMessage calls, for the builder's default HTTPXRequest and for BotAPIRequest
+- new connections opened by a burst of requests after 6s idle
+- latency of interactive replies while a 3000 message bulk run is sending, with one shared pool and with a separate bulk pool
+
+Usage, from the repository root:
+python benchmarks/bot_api_pool.py
+"""
+import asyncio
+import logging
+import os
+import subprocess
+import sys
+import time
+
+PORT = 8999
+BASE_URL = f"http://127.0.0.1:{PORT}/bot"
+LATENCY = 0.02 # seconds the fake Bot API takes per request
+
+def serve():
+    """Fake Bot API answering every method with a message, counting the connections it accepts"""
+    import orjson
+    import uvicorn
+    from uvicorn.protocols.http.h11_impl import H11Protocol
+
+    connections = {"n": 0}
+
+    class CountingProtocol(H11Protocol):
+        def connection_made(self, transport):
+            connections["n"] += 1
+            super().connection_made(transport)
+
+    me = {"id": 1, "is_bot": True, "first_name": "bot", "username": "bot"}
+    message = {"message_id": 1, "date": 0, "chat": {"id": 1, "type": "private"}}
+
+    async def app(scope, receive, send):
+        if scope["type"] != "http":
+            return
+        while (await receive()).get("more_body"):
+            pass
+        path = scope["path"]
+        if path.endswith("/connections"):
+            body = orjson.dumps(connections)
+        else:
+            await asyncio.sleep(LATENCY)
+            body = orjson.dumps({"ok": True, "result": me if path.endswith("getMe") else message})
+        await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"application/json")]})
+        await send({"type": "http.response.body", "body": body})
+
+    uvicorn.run(app, port=PORT, log_level="warning", http=CountingProtocol, timeout_keep_alive=300)
+
+async def benchmark():
+    # main.py reads its settings at import, the values only need to be present
+    for name, value in {"CLOUD_URL": "https://localhost", "BOT_TOKEN": "1:x", "DB_USER": "u", "DB_PASS": "p", "DB_NAME": "n", "LOG_LEVEL": "WARNING"}.items():
+        os.environ.setdefault(name, value)
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import httpx
+    import main
+    from telegram import Bot
+    from telegram.request import HTTPXRequest
+    logging.getLogger().setLevel(logging.ERROR)
+
+    async def connections() -> int:
+        async with httpx.AsyncClient() as client:
+            return (await client.get(f"http://127.0.0.1:{PORT}/connections")).json()["n"]
+
+    async def make_bot(request) -> Bot:
+        bot = Bot("1:x", base_url=BASE_URL, request=request)
+        await bot.initialize()
+        return bot
+
+    async def burst(bot: Bot, n: int) -> float:
+        start = time.perf_counter()
+        await asyncio.gather(*[bot.send_message(1, "hi") for _ in range(n)])
+        return time.perf_counter() - start
+
+    print(f"== throughput, 1000 concurrent sendMessage, {LATENCY * 1000:.0f}ms server latency")
+    for name, request in [
+        ("HTTPXRequest pool=256", HTTPXRequest(256)),
+        ("BotAPIRequest pool=64", main.BotAPIRequest(64)),
+        (f"BotAPIRequest pool={main.BOT_API_POOL_SIZE}", main.BotAPIRequest()),
+    ]:
+        bot = await make_bot(request)
+        elapsed = await burst(bot, 1000)
+        print(f"{name:28s} {1000 / elapsed:7.0f} req/s ({elapsed:.2f}s)")
+        await bot.shutdown()
+
+    print("== new connections after 6s idle (50 request bursts)")
+    for name, request in [("HTTPXRequest pool=256", HTTPXRequest(256)), (f"BotAPIRequest pool={main.BOT_API_POOL_SIZE}", main.BotAPIRequest())]:
+        bot = await make_bot(request)
+        await burst(bot, 50)
+        before = await connections()
+        await asyncio.sleep(6)
+        elapsed = await burst(bot, 50)
+        # The /connections request itself opens one
+        print(f"{name:28s} new connections in 2nd burst: {await connections() - before - 1}, burst took {elapsed * 1000:.0f}ms")
+        await bot.shutdown()
+
+    print("== interactive reply latency during a 3000 message bulk run")
+    for shared in (True, False):
+        interactive = await make_bot(main.BotAPIRequest())
+        bulk = interactive if shared else await make_bot(main.BotAPIRequest(main.BOT_API_BULK_POOL_SIZE))
+        bulk_run = asyncio.create_task(burst(bulk, 3000))
+        await asyncio.sleep(0.2)
+        latencies = []
+        for _ in range(20):
+            start = time.perf_counter()
+            await interactive.send_message(1, "reply")
+            latencies.append((time.perf_counter() - start) * 1000)
+        await bulk_run
+        latencies.sort()
+        print(f"{'one shared pool' if shared else 'separate bulk pool':28s} p50 {latencies[10]:.0f}ms  max {latencies[-1]:.0f}ms")
+        await interactive.shutdown()
+        if not shared:
+            await bulk.shutdown()
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["--serve"]:
+        serve()
+    else:
+        server = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve"])
+        try:
+            time.sleep(2)
+            asyncio.run(benchmark())
+        finally:
+            server.terminate()
@@ -3,46 +3,58 @@
 # pylint: disable=import-error,unused-argument
 """
 Simple example of a bot that uses a custom webhook setup and handles custom updates.
-For the custom webhook setup, the libraries `flask`, `asgiref` and `uvicorn` are used. Please
-install them as `pip install flask[async]~=2.3.2 uvicorn~=0.23.2 asgiref~=3.7.2`.
-Note that any other `asyncio` based web server framework can be used for a custom webhook setup
-just as well.
+For the custom webhook setup, a small ASGI app (WebhookServer) served by `uvicorn` is used, with
+`orjson` for parsing request bodies. Please install them as `pip install uvicorn~=0.23.2 orjson~=3.10.0`.
 
 Usage:
 Set bot Token, URL, admin CHAT_ID and PORT after the imports.
 You may also need to change the `listen` value in the uvicorn configuration to match your setup.
+The database is reached through the Cloud SQL unix socket that Cloud Run mounts under /cloudsql
+(deploy with `--add-cloudsql-instances`), or over TCP if DB_HOST is set.
+Reads can be sent to a read replica by setting DB_READ_HOST or DB_READ_INSTANCE_CONNECTION_NAME.
 Press Ctrl-C on the command line or send a signal to the process to stop the bot.
 """
 import os
 import re
-import mysql
-import mysql.connector
+import atexit
+import queue
+import socket
+import random
 import asyncio
 import schedule
-import traceback
 import time
-import pymysql
 from dateutil.relativedelta import relativedelta
 from datetime import datetime, timedelta
-from typing import Callable
-from google.cloud.sql.connector import Connector, IPTypes
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from typing import Awaitable, Callable, Collection
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+import asyncmy
+from asyncmy.constants import CLIENT
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine
 from sqlalchemy.ext.asyncio import AsyncConnection
-from sqlalchemy.orm import sessionmaker
 
 import sqlalchemy
 import html
 import logging
-import json
-from dataclasses import dataclass
+import logging.handlers
+import io
+import pickle
+import functools
+import hmac
+import hashlib
+import collections
+import bisect
+from dataclasses import dataclass, field
 from http import HTTPStatus
 
 import uvicorn
-from asgiref.wsgi import WsgiToAsgi
-from flask import Flask, Response, abort, make_response, request
-from telegram import Update, Message, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardRemove, InputFile
-from telegram.constants import ParseMode
+import httpx
+import orjson
+from urllib.parse import parse_qs
+from telegram import Update, Message, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardRemove, InputFile, TelegramObject
+from telegram.constants import ParseMode, MessageLimit
 import telegram.error
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application,
     CallbackContext,
@@ -53,7 +65,11 @@ from telegram.ext import (
     ConversationHandler,
     MessageHandler,
     filters,
-    CallbackQueryHandler
+    CallbackQueryHandler,
+    SimpleUpdateProcessor,
+    BasePersistence,
+    PersistenceInput,
+    BaseRateLimiter
     )
 from dotenv import load_dotenv
 
@@ -61,14 +77,176 @@ from dotenv import load_dotenv
 # TODO add try and except blocks for conversation handlers
 # Load .env
 load_dotenv()
-# Enable logging
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
-)
+
+###########################################################################################################################################################
+# Logging
+# Handlers only put records on a queue, a QueueListener thread formats and writes them so that the event loop never
+# blocks on stderr. Records are written as one JSON object per line, which Cloud Logging parses into structured entries.
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json').lower() # json, or text for the plain format when running locally
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000)) # records waiting to be written, further records are dropped
+LOG_SAMPLE_RATES = os.environ.get('LOG_SAMPLE_RATES', 'main.db=0.1') # logger=rate pairs, share of DEBUG/INFO records kept
+LOG_MAX_MESSAGE_CHARS = int(os.environ.get('LOG_MAX_MESSAGE_CHARS', 2000)) # longer messages are cut
+LOG_MAX_ARG_CHARS = int(os.environ.get('LOG_MAX_ARG_CHARS', 300)) # same, for each argument of a lazily formatted message
+LOG_ACCESS = os.environ.get('LOG_ACCESS', 'false').lower() == 'true' # uvicorn access log, Cloud Run already logs every request
+
+def shorten(text: str, limit: int) -> str:
+    """Cuts text to limit characters, noting how much was left out"""
+    if len(text) <= limit:
+        return text
+    return f"{text[:limit]}...[{len(text) - limit} chars redacted]"
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps only a share of the DEBUG/INFO records of the given loggers (and their children), WARNING and above are always kept.
+    Runs before the record is queued, so dropped records cost nothing further.
+    """
+
+    def __init__(self, rates: dict):
+        super().__init__()
+        self.rates = rates
+        self.resolved = {}
+
+    def rate(self, name: str) -> float:
+        rate = self.resolved.get(name)
+        if rate is None:
+            parent = name
+            while parent not in self.rates and "." in parent:
+                parent = parent.rsplit(".", 1)[0]
+            rate = self.resolved[name] = self.rates.get(parent, 1.0)
+        return rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rate(record.name)
+        return rate >= 1 or random.random() < rate
+
+    @staticmethod
+    def parse(rates: str) -> dict:
+        """Parses "logger=rate,logger=rate" """
+        parsed = {}
+        for pair in filter(None, (pair.strip() for pair in rates.split(","))):
+            name, _, rate = pair.partition("=")
+            parsed[name.strip()] = float(rate)
+        return parsed
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Puts records on the queue, the message is formatted by the listener thread. Arguments that the caller could still
+    change (params dicts, user_data, ...) are turned into text first, so that the record shows them as they were logged.
+    When the queue is full the record is dropped and counted instead of waiting for the writer.
+    """
+    IMMUTABLE = (str, bytes, int, float, type(None))
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def snapshot(self, arg):
+        return arg if isinstance(arg, self.IMMUTABLE) else str(arg)
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if isinstance(record.args, dict):
+            record.args = {key: self.snapshot(value) for key, value in record.args.items()}
+        elif record.args:
+            record.args = tuple(self.snapshot(arg) for arg in record.args)
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class StructuredFormatter(logging.Formatter):
+    """
+    Formats records as Cloud Logging JSON (or plain text), with long messages and arguments cut and secrets masked.
+    Fields passed with `extra=` are added to the JSON entry.
+    """
+    RESERVED = set(logging.makeLogRecord({}).__dict__) | {"message", "asctime"}
+
+    def __init__(self, json_output: bool = True, secrets: tuple = ()):
+        super().__init__("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+        self.json_output = json_output
+        # short values would mask ordinary words
+        self.secrets = [secret for secret in secrets if secret and len(secret) >= 8]
+
+    def shorten_arg(self, arg):
+        # numbers are left alone so that %d / %.2f keep working
+        if isinstance(arg, (int, float)):
+            return arg
+        return shorten(str(arg), LOG_MAX_ARG_CHARS)
+
+    def redacted_message(self, record: logging.LogRecord) -> str:
+        try:
+            if isinstance(record.args, dict):
+                message = str(record.msg) % {key: self.shorten_arg(value) for key, value in record.args.items()}
+            elif record.args:
+                message = str(record.msg) % tuple(self.shorten_arg(arg) for arg in record.args)
+            else:
+                message = str(record.msg)
+        except (TypeError, ValueError):
+            message = record.getMessage()
+        for secret in self.secrets:
+            message = message.replace(secret, "[REDACTED]")
+        return shorten(message, LOG_MAX_MESSAGE_CHARS)
+
+    def format(self, record: logging.LogRecord) -> str:
+        record.message = self.redacted_message(record)
+        stack_trace = self.formatException(record.exc_info) if record.exc_info else record.exc_text
+        if not self.json_output:
+            text = f"{self.formatTime(record)} - {record.name} - {record.levelname} - {record.message}"
+            return f"{text}\n{stack_trace}" if stack_trace else text
+        entry = {
+            "severity": record.levelname,
+            "message": record.message,
+            "time": datetime.fromtimestamp(record.created).astimezone().isoformat(),
+            "logger": record.name,
+            "logging.googleapis.com/sourceLocation": {"file": record.pathname, "line": record.lineno, "function": record.funcName},
+        }
+        if stack_trace:
+            entry["stack_trace"] = stack_trace
+        for key, value in record.__dict__.items():
+            if key not in self.RESERVED:
+                entry[key] = value
+        return orjson.dumps(entry, default=str).decode()
+
+def configure_logging() -> NonBlockingQueueHandler:
+    """
+    Routes all logging through a NonBlockingQueueHandler on the root logger, written out by a QueueListener thread.
+    The listener is flushed and stopped at exit.
+
+    Returns:
+        The queue handler, which counts dropped records
+    """
+    writer = logging.StreamHandler()
+    writer.setFormatter(StructuredFormatter(
+        json_output=LOG_FORMAT == 'json',
+        secrets=(os.environ.get('BOT_TOKEN'), os.environ.get('DB_PASS'), os.environ.get('WEBHOOK_SECRET_TOKEN')),
+    ))
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    handler = NonBlockingQueueHandler(log_queue)
+    handler.addFilter(SamplingFilter(SamplingFilter.parse(LOG_SAMPLE_RATES)))
+    root = logging.getLogger()
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(LOG_LEVEL)
+    listener = logging.handlers.QueueListener(log_queue, writer, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return handler
+
+log_handler = configure_logging()
 # set higher logging level for httpx to avoid all GET and POST requests being logged
 logging.getLogger("httpx").setLevel(logging.WARNING)
 
-logger = logging.getLogger(__name__)
+# Named "main" rather than __name__, which is "__main__" when run as `python main.py`, so that LOG_SAMPLE_RATES keys match
+logger = logging.getLogger("main")
+db_logger = logging.getLogger("main.db") # statements and their params, sampled through LOG_SAMPLE_RATES
+update_logger = logging.getLogger("main.updates") # one record per incoming update
 
 
 
@@ -82,143 +260,1775 @@ ADMIN_CHAT_ID = 133704697
 # CHANNEL_ID = -1002192841091
 CHANNEL_ID = -1001496940354
 PORT = 8080
+MAX_REQUEST_BODY_BYTES = int(os.environ.get('MAX_REQUEST_BODY_BYTES', 1024 * 1024)) # Telegram updates are a few KB at most
+WEBHOOK_SECRET_TOKEN = os.environ.get('WEBHOOK_SECRET_TOKEN') # Sent by Telegram with every update, requests without it are rejected if set
+UPDATE_DEDUPE_SIZE = int(os.environ.get('UPDATE_DEDUPE_SIZE', 10000)) # update_ids remembered to drop redeliveries
+UPDATE_DEDUPE_DB = os.environ.get('UPDATE_DEDUPE_DB', 'false').lower() == 'true' # also record update_ids in the DB, to dedupe across instances
+UPDATE_DEDUPE_DB_DAYS = 2 # processed_updates rows older than this are pruned by daily_checks
+BULK_UPDATES_TOKEN = os.environ.get('BULK_UPDATES_TOKEN') # if set, /submitpayload/bulk requires "Authorization: Bearer <token>"
+BULK_QUEUE_SHARE = float(os.environ.get('BULK_QUEUE_SHARE', 0.5)) # share of the update queue bulk updates may fill, the rest is kept for users
+BULK_ADMIT_TIMEOUT = float(os.environ.get('BULK_ADMIT_TIMEOUT', 30)) # seconds a bulk request waits for room in the queue before giving up
+BULK_MAX_ERRORS = 100 # rejected records listed in a bulk response, the rest are only counted
 BOT_TOKEN = os.environ['BOT_TOKEN'] # nosec B105
 JOB_POST_PRICE = 70
 PART_JOB_POST_PRICE = 45
 JOB_REPOST_PRICE = 30
 JOB_EXPIRY_DAYS = 30
+ADMIN_ACK_PATTERN = re.compile(r'^(ss_|jp_)(accept|reject)_\d+$') # Admin approve/reject buttons, handled by get_admin_acknowledgement
+PENDING_PATTERN = re.compile(r'^pending_') # Buttons of the admin's /pending view, handled by pending_button
+PAYNOW_QR_CODE = "paynow_qrcode.jpg" # Sent with every purchase, see MediaAssets
+PENDING_PAGE_SIZE = int(os.environ.get('PENDING_PAGE_SIZE', 8)) # pending job posts and payments shown per page of /pending
+
+# Database connection settings
+INSTANCE_CONNECTION_NAME = os.environ.get('INSTANCE_CONNECTION_NAME', "telegram-bot-job:asia-southeast1:app-reg")
+DB_SOCKET_DIR = os.environ.get('DB_SOCKET_DIR', '/cloudsql')
+DB_HOST = os.environ.get('DB_HOST') # Set to connect over TCP (private IP / local MySQL) instead of the Cloud SQL socket
+DB_PORT = int(os.environ.get('DB_PORT', 3306))
+DB_CONNECT_TIMEOUT = int(os.environ.get('DB_CONNECT_TIMEOUT', 10))
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 10))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800)) # seconds, keep below MySQL wait_timeout
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'true').lower() == 'true'
+# Read replica, reads go to the primary if neither is set
+DB_READ_HOST = os.environ.get('DB_READ_HOST')
+DB_READ_PORT = int(os.environ.get('DB_READ_PORT', DB_PORT))
+DB_READ_INSTANCE_CONNECTION_NAME = os.environ.get('DB_READ_INSTANCE_CONNECTION_NAME') # Cloud SQL read replica, connected to over its socket
+DB_READ_FALLBACK_TO_PRIMARY = os.environ.get('DB_READ_FALLBACK_TO_PRIMARY', 'true').lower() == 'true'
+DB_READ_RETRY_AFTER = int(os.environ.get('DB_READ_RETRY_AFTER', 30)) # seconds to send reads to the primary after the replica failed
+FETCH_MANY_MAX_CONNECTIONS = int(os.environ.get('FETCH_MANY_MAX_CONNECTIONS', 3)) # pooled connections one fetch_many call uses at once, its other queries wait for them
+# Update processing
+# Each update holds its unit of work's connection and may open FETCH_MANY_MAX_CONNECTIONS more, so the default leaves
+# room in the pool for all of them at once. Above that, updates waiting for connections can starve each other until pool_timeout.
+UPDATE_CONCURRENCY = int(os.environ.get('UPDATE_CONCURRENCY', max(1, (DB_POOL_SIZE + DB_MAX_OVERFLOW) // (1 + FETCH_MANY_MAX_CONNECTIONS)))) # updates processed at once
+UPDATE_QUEUE_LIMIT = int(os.environ.get('UPDATE_QUEUE_LIMIT', 1000)) # updates accepted but not yet processed, beyond this the webhook answers 503
+UPDATE_PRIORITY_QUEUE_LIMIT = int(os.environ.get('UPDATE_PRIORITY_QUEUE_LIMIT', 200)) # same, for admin acknowledgements and payment photos
+UPDATE_RETRY_AFTER = int(os.environ.get('UPDATE_RETRY_AFTER', 5)) # seconds, sent with the 503 so that Telegram redelivers later
+# Query metrics
+DB_SLOW_QUERY_MS = float(os.environ.get('DB_SLOW_QUERY_MS', 250)) # statements slower than this are logged as warnings
+DB_LOG_ROWS = os.environ.get('DB_LOG_ROWS', 'false').lower() == 'true' # log every row returned by safe_get_db
+METRICS_TOP_N = int(os.environ.get('METRICS_TOP_N', 20)) # statements listed on /metrics by default
+# Schema migrations
+DB_MIGRATE_ON_STARTUP = os.environ.get('DB_MIGRATE_ON_STARTUP', 'true').lower() == 'true'
+DB_EXPLAIN_ON_STARTUP = os.environ.get('DB_EXPLAIN_ON_STARTUP', 'true').lower() == 'true'
+# Startup
+DB_WARM_CONNECTIONS = min(int(os.environ.get('DB_WARM_CONNECTIONS', 5)), DB_POOL_SIZE) # connections opened before the webhook is registered
+PACKAGE_CATALOG_TTL = int(os.environ.get('PACKAGE_CATALOG_TTL', 300)) # seconds before the cached package catalogs are reloaded
+# Persistence
+PERSISTENCE_UPDATE_INTERVAL = float(os.environ.get('PERSISTENCE_UPDATE_INTERVAL', 10)) # seconds between writes of changed user_data and conversation states
+PERSISTENCE_CACHE_SIZE = int(os.environ.get('PERSISTENCE_CACHE_SIZE', 50000)) # user_data and conversation versions remembered, least recently used are forgotten
+# Scheduled jobs
+SCHEDULER_LEASE_SECONDS = int(os.environ.get('SCHEDULER_LEASE_SECONDS', 60)) # how long the leader's lease lasts without a heartbeat
+SCHEDULER_HEARTBEAT_SECONDS = int(os.environ.get('SCHEDULER_HEARTBEAT_SECONDS', 20)) # how often the lease is renewed (or tried for, by the other instances)
+SCHEDULER_MISFIRE_GRACE_SECONDS = int(os.environ.get('SCHEDULER_MISFIRE_GRACE_SECONDS', 3600)) # a job that did not run (or failed) at its time is still run this long after it
+INSTANCE_ID = f"{os.environ.get('K_REVISION', 'local')}-{os.getpid()}-{os.urandom(4).hex()}" # identifies this process as lease holder
+OUTBOX_BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE', 50)) # outbox messages claimed and sent at a time
+OUTBOX_POLL_SECONDS = float(os.environ.get('OUTBOX_POLL_SECONDS', 5)) # how often the outbox is checked when nothing wakes the sender
+OUTBOX_LEASE_SECONDS = int(os.environ.get('OUTBOX_LEASE_SECONDS', 120)) # how long claimed messages are hidden from other senders, renewed every third of it while they are being sent
+OUTBOX_RETRY_SECONDS = int(os.environ.get('OUTBOX_RETRY_SECONDS', 10)) # first retry delay of a failed message, doubled on every attempt
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', 6)) # attempts before a message is given up
+OUTBOX_KEEP_DAYS = int(os.environ.get('OUTBOX_KEEP_DAYS', 7)) # sent and failed messages are kept this long
+DAILY_CHECKS_SEND_CONCURRENCY = int(os.environ.get('DAILY_CHECKS_SEND_CONCURRENCY', 16)) # user notices daily_checks sends at once
+# Outbound rate limits, see https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
+SEND_GLOBAL_PER_SECOND = float(os.environ.get('SEND_GLOBAL_PER_SECOND', 30)) # messages per second over all chats
+SEND_CHAT_PER_SECOND = float(os.environ.get('SEND_CHAT_PER_SECOND', 1)) # messages per second to one private chat
+SEND_GROUP_PER_MINUTE = float(os.environ.get('SEND_GROUP_PER_MINUTE', 20)) # messages per minute to one group or channel
+SEND_CHAT_BURST = int(os.environ.get('SEND_CHAT_BURST', 3)) # messages a chat or group can get at once before its rate applies
+SEND_EDIT_PER_SECOND = float(os.environ.get('SEND_EDIT_PER_SECOND', 5)) # edits per second of messages in one chat (browsing buttons), counted apart from new messages
+SEND_EDIT_BURST = int(os.environ.get('SEND_EDIT_BURST', 5)) # edits a chat can get at once before SEND_EDIT_PER_SECOND applies
+SEND_MAX_RETRIES = int(os.environ.get('SEND_MAX_RETRIES', 3)) # retries of a request Telegram answered with 429
+# Bot API client
+BOT_API_POOL_SIZE = int(os.environ.get('BOT_API_POOL_SIZE', 256)) # connections for replies to users, PTB's builder default (see benchmarks/bot_api_pool.py)
+BOT_API_BULK_POOL_SIZE = int(os.environ.get('BOT_API_BULK_POOL_SIZE', 8)) # connections for bulk notifications (daily_checks), kept apart so they never hold up replies
+BOT_API_KEEPALIVE_EXPIRY = float(os.environ.get('BOT_API_KEEPALIVE_EXPIRY', 120)) # seconds an idle connection is kept open, httpx closes them after 5
+BOT_API_HTTP_VERSION = os.environ.get('BOT_API_HTTP_VERSION', '1.1') # '2' multiplexes requests over one connection, needs `pip install "python-telegram-bot[http2]"`
+BOT_API_CONNECT_TIMEOUT = float(os.environ.get('BOT_API_CONNECT_TIMEOUT', 5))
+BOT_API_READ_TIMEOUT = float(os.environ.get('BOT_API_READ_TIMEOUT', 10))
+BOT_API_WRITE_TIMEOUT = float(os.environ.get('BOT_API_WRITE_TIMEOUT', 20)) # photos and documents have to be uploaded within this
+BOT_API_POOL_TIMEOUT = float(os.environ.get('BOT_API_POOL_TIMEOUT', 5)) # seconds a request waits for a free connection
+
+def make_async_creator(host: str = None, port: int = DB_PORT, unix_socket: str = None) -> Callable:
+    """
+    Returns a coroutine function that opens a new asyncmy connection.
+    The whole handshake (TCP/socket, auth) is awaited on the event loop, so a slow connect
+    only delays the coroutine that asked for the connection.
+    async_creator bypasses the dialect's connect arguments, so FOUND_ROWS is set here: like with SQLAlchemy's own
+    connections, rowcount counts the rows an UPDATE matched, not only the ones it changed.
 
-# initialize Connector object
-connector = Connector()
-
-# function to return the database connection
-def getconn() -> pymysql.connections.Connection:
-    conn: pymysql.connections.Connection = connector.connect(
-        "telegram-bot-job:asia-southeast1:app-reg",
-        "pymysql",
-        user=os.environ['DB_USER'],
-        password=os.environ['DB_PASS'],
-        db=os.environ['DB_NAME']
+    Args:
+        host (str): Hostname/IP of the MySQL server, used if given
+        port (int): Port of the MySQL server
+        unix_socket (str): Path to the unix socket, used if no host is given
+
+    Returns:
+        Callable: async function returning an asyncmy connection
+    """
+    async def getconn_async() -> asyncmy.Connection:
+        return await asyncmy.connect(
+            host=host,
+            port=port,
+            unix_socket=None if host else unix_socket,
+            user=os.environ['DB_USER'],
+            password=os.environ['DB_PASS'],
+            database=os.environ['DB_NAME'],
+            connect_timeout=DB_CONNECT_TIMEOUT,
+            client_flag=CLIENT.FOUND_ROWS,
+        )
+    return getconn_async
+
+def create_db_engine(creator: Callable) -> AsyncEngine:
+    """Creates an async engine with a connection pool sized from the DB_POOL_* settings"""
+    return create_async_engine(
+        "mysql+asyncmy://",
+        async_creator=creator,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
     )
-    return conn
 
 # create connection pool
-pool = sqlalchemy.create_engine(
-    "mysql+pymysql://",
-    creator=getconn,
+# Cloud Run mounts the Cloud SQL instance as a unix socket under /cloudsql/<instance connection name>
+async_pool = create_db_engine(
+    make_async_creator(host=DB_HOST, unix_socket=f"{DB_SOCKET_DIR}/{INSTANCE_CONNECTION_NAME}")
 )
+# Read-only pool for safe_get_db, same as async_pool if no replica is configured
+if DB_READ_HOST or DB_READ_INSTANCE_CONNECTION_NAME:
+    read_pool = create_db_engine(
+        make_async_creator(host=DB_READ_HOST, port=DB_READ_PORT, unix_socket=f"{DB_SOCKET_DIR}/{DB_READ_INSTANCE_CONNECTION_NAME}")
+    )
+else:
+    read_pool = async_pool
+read_replica_down_until = 0.0
 
-async_pool = create_async_engine(
-    "mysql+asyncmy://",
-    creator=getconn,
-)
+async def connect_read_pool() -> AsyncConnection:
+    """
+    Checks out a connection from the read replica.
+    If the replica cannot be reached and DB_READ_FALLBACK_TO_PRIMARY is set, the primary is used instead
+    and the replica is skipped for the next DB_READ_RETRY_AFTER seconds.
+    """
+    global read_replica_down_until
+    if read_pool is async_pool or time.monotonic() < read_replica_down_until:
+        return await async_pool.connect()
+    try:
+        return await read_pool.connect()
+    except (sqlalchemy.exc.DBAPIError, OSError, asyncio.TimeoutError) as e:
+        if not DB_READ_FALLBACK_TO_PRIMARY:
+            raise
+        logger.warning("Read replica unavailable, sending reads to the primary for %ss: %s", DB_READ_RETRY_AFTER, e)
+        read_replica_down_until = time.monotonic() + DB_READ_RETRY_AFTER
+        return await async_pool.connect()
 
-AsyncSessionLocal = sessionmaker(bind=async_pool, class_=AsyncSession, expire_on_commit=False)
-async def get_db_fetchone(query_string: str):
-    """Retrieves entry from DB
+###########################################################################################################################################################
+# Query metrics
+
+class QueryStats:
+    """Per-statement call counts, total/max duration, latency histogram and row counts"""
+
+    BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+    def __init__(self):
+        self.stats = {}
+
+    def record(self, name: str, elapsed_ms: float, rows: int, params=None):
+        entry = self.stats.get(name)
+        if entry is None:
+            entry = self.stats[name] = {
+                "calls": 0,
+                "total_ms": 0.0,
+                "max_ms": 0.0,
+                "rows": 0,
+                "histogram": [0] * (len(self.BUCKETS_MS) + 1),
+            }
+        entry["calls"] += 1
+        entry["total_ms"] += elapsed_ms
+        entry["max_ms"] = max(entry["max_ms"], elapsed_ms)
+        entry["rows"] += max(rows, 0)
+        entry["histogram"][bisect.bisect_left(self.BUCKETS_MS, elapsed_ms)] += 1
+        if elapsed_ms >= DB_SLOW_QUERY_MS:
+            logger.warning("Slow query: %s took %.1fms (%s rows) with params: %s", name, elapsed_ms, rows, params)
+
+    def top(self, n: int = METRICS_TOP_N) -> list:
+        """Returns the n statements with the highest total time"""
+        ranked = sorted(self.stats.items(), key=lambda item: item[1]["total_ms"], reverse=True)[:n]
+        bucket_labels = [f"<={bucket}ms" for bucket in self.BUCKETS_MS] + [f">{self.BUCKETS_MS[-1]}ms"]
+        return [
+            {
+                "statement": name,
+                "calls": entry["calls"],
+                "total_ms": round(entry["total_ms"], 1),
+                "mean_ms": round(entry["total_ms"] / entry["calls"], 2),
+                "max_ms": round(entry["max_ms"], 1),
+                "rows": entry["rows"],
+                "histogram": dict(zip(bucket_labels, entry["histogram"])),
+            }
+            for name, entry in ranked
+        ]
 
-    Args:
-        query_string (str): Query for DB to execute
-        fetch_fn (Callable): fetchall() or fetchone(), etc
+query_stats = QueryStats()
 
-    Returns:
-        Data from query
-    """    
-    try: 
-        logger.info(f"Executing fetch query: {query_string}")
-        async with AsyncSessionLocal() as conn:
-            results = await conn.execute(sqlalchemy.text(query_string))
-            data = results.fetchone()
-            logger.info(f"Results from query: {data}")
-            return data
-    except Exception as e:
-        logger.info(f"Error in interacting with database: {e}")
+def instrument_engine(engine: AsyncEngine):
+    """Times every statement executed on engine and records it in query_stats under its registered name"""
 
-async def get_db(query_string: str):
-    """Retrieves entry from DB
+    @sqlalchemy.event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info['query_start_time'] = time.perf_counter()
 
-    Args:
-        query_string (str): Query for DB to execute
-        fetch_fn (Callable): fetchall() or fetchone(), etc
+    @sqlalchemy.event.listens_for(engine.sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed_ms = (time.perf_counter() - conn.info.pop('query_start_time')) * 1000
+        if context.compiled is not None:
+            name = query_name(context.compiled.statement)
+        else:
+            name = " ".join(statement.split())
+        query_stats.record(name, elapsed_ms, cursor.rowcount, parameters)
 
-    Returns:
-        Data from query
-    """    
-    try: 
-        logger.info(f"Executing fetch query: {query_string}")
-        async with AsyncSessionLocal() as conn:
-            results = await conn.execute(sqlalchemy.text(query_string))
-            data = results.fetchall()
-            logger.info(f"Results from query: {data}")
-            return data
-    except Exception as e:
-        logger.info(f"Error in interacting with database: {e}")
+instrument_engine(async_pool)
+if read_pool is not async_pool:
+    instrument_engine(read_pool)
+
+###########################################################################################################################################################
+# Per-update unit of work
 
+class UnitOfWork:
+    """
+    Shares one pooled connection and one transaction between all DB calls made while processing an update.
+    The connection is only checked out on the first DB call, so updates that never touch the DB do not take one.
+    Reads use a second connection on the read replica until the first write, after which they go to the primary
+    so that they see the update's own changes.
+    Writes are committed before every Bot API request (see checkpoint()), so row locks are not held while a request
+    waits for its rate limit, and whatever the user is told about has been committed.
+    """
+
+    def __init__(self, engine: AsyncEngine):
+        self.engine = engine
+        self.conn: AsyncConnection = None
+        self.lock = asyncio.Lock() # Statements on one connection cannot overlap
+        self.read_conn: AsyncConnection = None
+        self.read_lock = asyncio.Lock()
+        self.has_writes = False
+        self.uncommitted = False # Writes since the last commit
+        self.failed = False # Set by fail_unit_of_work(), the unit of work is rolled back instead of committed
+        self.after_commit: list = [] # callbacks to run once the unit of work has committed
+        self.savepoints = 0 # open savepoint() blocks, which a checkpoint must not commit half of
+        self.closed = False
+
+    async def connection(self) -> AsyncConnection:
+        if self.conn is None:
+            self.conn = await self.engine.connect()
+        return self.conn
+
+    async def read_connection(self) -> AsyncConnection:
+        if self.read_conn is None:
+            self.read_conn = await connect_read_pool()
+        return self.read_conn
+
+    async def commit(self):
+        if self.conn is not None:
+            await self.conn.commit()
+        self.uncommitted = False
+
+    async def checkpoint(self):
+        """Commits the writes made so far, reads keep going to the primary"""
+        if self.uncommitted and not self.failed and not self.savepoints:
+            async with self.lock:
+                await self.commit()
+
+    async def rollback(self):
+        if self.conn is not None:
+            await self.conn.rollback()
+
+    async def close(self):
+        self.closed = True
+        if self.read_conn is not None:
+            await self.read_conn.close()
+            self.read_conn = None
+        if self.conn is not None:
+            await self.conn.close()
+            self.conn = None
+
+current_unit_of_work: ContextVar = ContextVar('current_unit_of_work', default=None)
+
+@asynccontextmanager
+async def unit_of_work():
+    """
+    Opens a unit of work for the enclosed block. DB calls made inside it run on a single connection
+    and are committed together when the block exits, or rolled back if it raises or fail_unit_of_work() was called.
+    Example usage:
+    async with unit_of_work():
+        await safe_set_db(query, params)
+        await safe_get_db(query, params)
+    """
+    uow = UnitOfWork(async_pool)
+    token = current_unit_of_work.set(uow)
+    try:
+        yield uow
+        if uow.failed:
+            await uow.rollback()
+            return
+        await uow.commit()
+        for callback in uow.after_commit:
+            callback()
+    except BaseException:
+        await uow.rollback()
+        raise
+    finally:
+        current_unit_of_work.reset(token)
+        await uow.close()
+
+@asynccontextmanager
+async def db_connection(commit: bool = False, new_connection: bool = False, read_only: bool = False):
+    """
+    Yields the connection of the current unit of work.
+    Outside of a unit of work (e.g. scheduled jobs, tasks outliving their update) or if new_connection is True,
+    a new pooled connection is used instead, which is committed on exit if commit is True.
+    If read_only is True, a read replica connection is used unless the unit of work has already written.
+    """
+    uow = current_unit_of_work.get()
+    in_unit_of_work = uow is not None and not uow.closed
+    if read_only and not commit and read_pool is not async_pool and not (in_unit_of_work and uow.has_writes):
+        if in_unit_of_work and not new_connection:
+            async with uow.read_lock:
+                yield await uow.read_connection()
+            return
+        conn = await connect_read_pool()
+        try:
+            yield conn
+        finally:
+            await conn.close()
+        return
+    if in_unit_of_work and not new_connection:
+        async with uow.lock:
+            if commit:
+                uow.has_writes = True
+                uow.uncommitted = True
+            yield await uow.connection()
+        return
+    async with async_pool.connect() as conn:
+        yield conn
+        if commit:
+            await conn.commit()
+
+@asynccontextmanager
+async def savepoint():
+    """
+    Makes the DB calls of the enclosed block all or nothing within the current unit of work, on its connection:
+    if the block raises, they are rolled back to a SAVEPOINT and the rest of the unit of work is kept.
+    They are only committed with the unit of work, so fail_unit_of_work() rolls them back too.
+    Outside of a unit of work, the block runs in a unit of work of its own.
+    Example usage:
+    async with savepoint():
+        await safe_set_db(query, params)
+        await notify(chat_id, text="Done!")
+    """
+    uow = current_unit_of_work.get()
+    if uow is None or uow.closed:
+        async with unit_of_work():
+            yield
+        return
+    async with db_connection(commit=True) as conn:
+        nested = await conn.begin_nested()
+    uow.savepoints += 1
+    try:
+        yield
+    except BaseException:
+        async with uow.lock:
+            await nested.rollback()
+        raise
+    else:
+        async with uow.lock:
+            await nested.commit()
+    finally:
+        uow.savepoints -= 1
+
+def fail_unit_of_work():
+    """
+    Makes the current unit of work roll back instead of committing.
+    PTB hands handler exceptions to the error handlers instead of raising them, so global_error_handler calls this.
+    """
+    uow = current_unit_of_work.get()
+    if uow is not None and not uow.closed:
+        uow.failed = True
+
+async def commit_before_sending():
+    """Commits the current unit of work's writes, called before every Bot API request"""
+    uow = current_unit_of_work.get()
+    if uow is not None and not uow.closed:
+        await uow.checkpoint()
+
+class UnitOfWorkUpdateProcessor(SimpleUpdateProcessor):
+    """Update processor that acts as a middleware around the handlers, running each update in its own unit of work"""
+
+    async def do_process_update(self, update: object, coroutine: Awaitable) -> None:
+        async with unit_of_work():
+            await coroutine
+
+class PrioritySlots:
+    """Semaphore that hands a freed slot to waiting priority holders before normal ones"""
+
+    def __init__(self, slots: int):
+        self.free = slots
+        self.waiters = {True: collections.deque(), False: collections.deque()}
+
+    def waiting(self, priority: bool) -> int:
+        return sum(not waiter.done() for waiter in self.waiters[priority])
+
+    async def acquire(self, priority: bool = False):
+        if self.free > 0 and not self.waiters[True] and not self.waiters[False]:
+            self.free -= 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters[priority].append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if not waiter.cancelled(): # The slot was handed over just before the cancellation
+                self.release()
+            raise
+
+    def release(self):
+        for priority in (True, False):
+            while self.waiters[priority]:
+                waiter = self.waiters[priority].popleft()
+                if not waiter.done():
+                    waiter.set_result(None)
+                    return
+        self.free += 1
+
+    @asynccontextmanager
+    async def slot(self, priority: bool = False):
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+class ChatOrderedUpdateProcessor(UnitOfWorkUpdateProcessor):
+    """
+    Processes updates from different chats concurrently, but updates from the same chat strictly one after another
+    and in the order they arrived, so that ConversationHandler states stay consistent.
+    An update first waits for the previous update of its chat, and only then for one of the max_concurrent_updates
+    processing slots, so a busy chat queues behind itself without taking slots from other chats.
+
+    The webhook admits updates through admit(), which bounds the updates accepted but not yet processed.
+    Admin acknowledgements and payment photos have their own bound and get free processing slots first.
+    """
+
+    def __init__(self, max_concurrent_updates: int, queue_limit: int = UPDATE_QUEUE_LIMIT, priority_queue_limit: int = UPDATE_PRIORITY_QUEUE_LIMIT):
+        # The base class semaphore bounds the updates waiting for their chat, the concurrency limit is applied after it
+        super().__init__(max_concurrent_updates=max(queue_limit + priority_queue_limit, max_concurrent_updates))
+        self.slots = PrioritySlots(max_concurrent_updates)
+        self.chat_locks = {} # ordering key: [lock, number of updates holding or waiting for it]
+        self.limits = {True: priority_queue_limit, False: queue_limit}
+        self.in_flight = {True: 0, False: 0}
+        self.rejected = {True: 0, False: 0}
+        self.admitted = {} # id(update): priority, for updates admitted and not yet processed
+
+    @staticmethod
+    def is_priority(update: object) -> bool:
+        """Admin approve/reject callbacks and photos (payment screenshots) skip ahead of everything else"""
+        if not isinstance(update, Update):
+            return False
+        if update.callback_query and update.callback_query.data:
+            return bool(ADMIN_ACK_PATTERN.match(update.callback_query.data) or PENDING_PATTERN.match(update.callback_query.data))
+        return bool(update.message and update.message.photo)
+
+    def admit(self, update: object) -> bool:
+        """Accepts the update if its lane is not full, returns False if it should be delivered again later"""
+        priority = self.is_priority(update)
+        if self.in_flight[priority] >= self.limits[priority]:
+            self.rejected[priority] += 1
+            return False
+        self.in_flight[priority] += 1
+        self.admitted[id(update)] = priority
+        return True
+
+    def stats(self) -> dict:
+        return {
+            lane: {
+                "in_flight": self.in_flight[priority],
+                "limit": self.limits[priority],
+                "waiting_for_slot": self.slots.waiting(priority),
+                "rejected": self.rejected[priority],
+            }
+            for lane, priority in (("priority", True), ("normal", False))
+        } | {"free_slots": self.slots.free, "busy_chats": len(self.chat_locks)}
+
+    @staticmethod
+    def ordering_key(update: object):
+        """Chat the update belongs to, None if it can be processed in any order"""
+        if isinstance(update, Update):
+            if update.effective_chat:
+                return update.effective_chat.id
+            if update.effective_user:
+                return update.effective_user.id
+        elif isinstance(update, WebhookUpdate):
+            return update.user_id
+        return None
+
+    async def do_process_update(self, update: object, coroutine: Awaitable) -> None:
+        try:
+            await self._process_in_order(update, coroutine)
+        finally:
+            priority = self.admitted.pop(id(update), None)
+            if priority is not None:
+                self.in_flight[priority] -= 1
+
+    async def _process_in_order(self, update: object, coroutine: Awaitable) -> None:
+        priority = self.is_priority(update)
+        key = self.ordering_key(update)
+        if key is None:
+            async with self.slots.slot(priority):
+                await super().do_process_update(update, coroutine)
+            return
+        entry = self.chat_locks.get(key)
+        if entry is None:
+            entry = self.chat_locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self.slots.slot(priority):
+                    await super().do_process_update(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.chat_locks[key]
 
 #SANITIZED VERSION
-async def safe_get_db(query_string: str, params: dict = None):
+async def safe_get_db(query_string, params: dict = None, new_connection: bool = False, primary: bool = False):
     """
     Retrieves entry from DB
     Example usage:
+    await safe_get_db(QUERIES['token_balance.get'], {"chat_id": 1})
     query = "SELECT * FROM users WHERE id = :user_id"
     params = {"user_id": 1}
-    await get_db(query, params)
+    await safe_get_db(query, params)
 
     Args:
-        query_string (str): Query for DB to execute
+        query_string (str | TextClause): Registered statement from QUERIES, or query for DB to execute
         params (dict): Parameters for the query
+        new_connection (bool): Run on a separate pooled connection instead of the update's unit of work
+            Reads go to the read replica unless the update has already written to the DB
+        primary (bool): Read from the primary even so, e.g. right after changes committed by another unit of work
 
     Returns:
         Data from query
     """    
     try: 
-        logger.info(f"Executing fetch query: {query_string} with params: {params}")
-        async with AsyncSessionLocal() as conn:
-            results = await conn.execute(sqlalchemy.text(query_string), params)
+        statement = as_statement(query_string)
+        db_logger.info("Executing fetch query: %s with params: %s", query_name(statement), params)
+        async with db_connection(new_connection=new_connection, read_only=not primary) as conn:
+            results = await conn.execute(statement, params)
             data = results.fetchall()
-            logger.info(f"Results from query: {data}")
+            if DB_LOG_ROWS:
+                db_logger.info("Results from query: %s", data)
             return data
     except Exception as e:
-        logger.info(f"Error in interacting with database: {e}")
+        logger.info("Error in interacting with database: %s", e)
+
+async def fetch_many(*queries: tuple, primary: bool = False) -> list:
+    """
+    Runs independent read queries concurrently, each on its own pooled connection (at most FETCH_MANY_MAX_CONNECTIONS
+    at once), and returns all results together.
+    If the current update has already written to the DB, the queries run one after another on the update's
+    connection instead, so that they see its uncommitted changes.
+    Example usage:
+    transaction, user = await fetch_many(
+        ("SELECT chat_id, package_id FROM transactions WHERE transaction_id = :transaction_id", {"transaction_id": 1}),
+        ("SELECT user_handle FROM user_data WHERE chat_id = :chat_id", {"chat_id": 1}),
+    )
 
-logger = logging.getLogger(__name__)
+    Args:
+        queries (tuple): (query_string, params) pairs
+        primary (bool): Read from the primary instead of the read replica, see safe_get_db
 
-async def safe_set_db(query_string: str, params: dict = None):
+    Returns:
+        list: Results of each query (as returned by safe_get_db), in the order they were given
+    """
+    uow = current_unit_of_work.get()
+    if uow is not None and not uow.closed and uow.has_writes:
+        return [await safe_get_db(query_string, params) for query_string, params in queries]
+    semaphore = asyncio.Semaphore(FETCH_MANY_MAX_CONNECTIONS)
+    async def fetch(query_string, params):
+        async with semaphore:
+            return await safe_get_db(query_string, params, new_connection=True, primary=primary)
+    return list(await asyncio.gather(*[fetch(query_string, params) for query_string, params in queries]))
+
+logger = logging.getLogger("main")
+
+async def safe_set_db(query_string, params: dict = None):
     """
     Executes a database commit operation
+    Inside a unit of work the commit is deferred until the update has been processed.
     Example usage:
     query = "UPDATE users SET name = :name WHERE id = :user_id"
     params = {"name": "John Doe", "user_id": 1}
-    await set_db(query, params)
+    await safe_set_db(query, params)
 
     Args:
-        query_string (str): Query for DB to execute
+        query_string (str | TextClause): Registered statement from QUERIES, or query for DB to execute
         params (dict): Parameters for the query
 
     Returns:
         bool: True if the operation was successful, False otherwise
     """
     try:
-        logger.info(f"Executing commit query: {query_string} with params: {params}")
-        async with AsyncSessionLocal() as conn:
-            await conn.execute(sqlalchemy.text(query_string), params)
-            await conn.commit()
+        statement = as_statement(query_string)
+        db_logger.info("Executing commit query: %s with params: %s", query_name(statement), params)
+        async with db_connection(commit=True) as conn:
+            await conn.execute(statement, params)
             return True
     except Exception as e:
-        logger.error(f"Error in interacting with database: {e}")
+        logger.error("Error in interacting with database: %s", e)
         return False
 
-async def set_db(query_string: str):
-    try:
-        logger.info(f"Executing commit query: {query_string}")
-        async with AsyncSessionLocal() as conn:
-            await conn.execute(sqlalchemy.text(query_string))
+###########################################################################################################################################################
+# Query registry
+# Named, parameterised statements, built once at import (SQLAlchemy compiles each one for the dialect on first use and
+# caches that). Pass them to safe_get_db/safe_set_db/fetch_many instead of building SQL inline,
+# e.g. await safe_get_db(QUERIES['token_balance.get'], {"chat_id": chat_id})
+# Registered so far: the balances, payments and their approval, job posting, reposting and approval, shortlisting,
+# daily_checks and the infrastructure tables. Queries of the other handlers (registration, profiles, applying, the
+# package admin commands) are still inline strings, which as_statement builds once and caches.
+
+QUERIES = {}
+_query_names = {}
+
+def register_query(name: str, query_string: str, **column_types) -> sqlalchemy.TextClause:
+    """
+    Builds the statement for query_string and registers it in QUERIES under name.
+
+    Args:
+        name (str): Name of the statement, <table>.<action>
+        query_string (str): SQL with :named parameters
+        column_types: Result column types of a SELECT (e.g. tokens=sqlalchemy.Integer), rows are returned converted to them
+
+    Returns:
+        The statement
+    """
+    statement = sqlalchemy.text(query_string)
+    if column_types:
+        statement = statement.columns(**column_types)
+    QUERIES[name] = statement
+    _query_names[id(statement)] = name
+    return statement
+
+@functools.lru_cache(maxsize=512)
+def _inline_statement(query_string: str) -> sqlalchemy.TextClause:
+    return sqlalchemy.text(query_string)
+
+def as_statement(query):
+    """Returns the statement for a registered statement or an inline query string (built once and cached)"""
+    if isinstance(query, str):
+        return _inline_statement(query)
+    return query
+
+def query_name(statement) -> str:
+    """Name of a registered statement, or its SQL if it was not registered"""
+    return _query_names.get(id(statement)) or " ".join(str(statement).split())
+
+# Profiles
+register_query('user_data.user_handle', "SELECT user_handle FROM user_data WHERE chat_id = :chat_id", user_handle=sqlalchemy.String)
+register_query('user_data.user_handles', "SELECT chat_id, user_handle FROM user_data WHERE chat_id IN :chat_ids", chat_id=sqlalchemy.BigInteger, user_handle=sqlalchemy.String)
+register_query('user_data.exists', "SELECT EXISTS (SELECT 1 FROM user_data WHERE chat_id = :chat_id)")
+register_query('user_data.by_transaction', "SELECT user_handle FROM user_data WHERE chat_id = (SELECT chat_id FROM transactions WHERE transaction_id = :transaction_id)", user_handle=sqlalchemy.String)
+register_query('agencies.by_chat_id', "SELECT id, name, agency_name FROM agencies WHERE chat_id = :chat_id")
+register_query('agencies.by_user_handle', "SELECT id, agency_name FROM agencies WHERE user_handle = :user_handle")
+register_query('agencies.details', "SELECT user_handle, chat_id, name, agency_name, agency_uen FROM agencies WHERE id = :agency_id")
+register_query('agencies.delete', "DELETE FROM agencies WHERE id = :id")
+register_query('applicants.by_chat_id', "SELECT id, name FROM applicants WHERE chat_id = :chat_id")
+register_query('applicants.by_user_handle', "SELECT id, name FROM applicants WHERE user_handle = :user_handle")
+register_query('applicants.delete', "DELETE FROM applicants WHERE id = :id")
+register_query('applicants.card', "SELECT dob, past_exp, citizenship, race, gender, education, lang_spoken FROM applicants WHERE id = :applicant_id")
+register_query('applicants.contact_card', "SELECT user_handle, name, dob, past_exp, citizenship, race, gender, education, lang_spoken, whatsapp_no FROM applicants WHERE id = :applicant_id")
+# Editable profile attributes, one statement per column so that the column name is never taken from user input
+EDITABLE_ATTRIBUTES = {
+    'agency': ('agencies', ['name', 'agency_name', 'agency_uen']),
+    'applicant': ('applicants', ['name', 'dob', 'past_exp', 'citizenship', 'race', 'gender', 'education', 'lang_spoken', 'whatsapp_no']),
+}
+for table, attributes in EDITABLE_ATTRIBUTES.values():
+    for attribute in attributes:
+        register_query(f'{table}.update.{attribute}', f"UPDATE {table} SET {attribute} = :new_value WHERE id = :profile_id")
+
+# Job posts
+register_query('job_posts.details', "SELECT agency_id, job_type, company_name, industry, job_title, date, time, basic_salary, commissions, job_scope, other_req FROM job_posts WHERE id = :job_id")
+register_query('job_posts.set_status', "UPDATE job_posts SET status = :status WHERE id = :job_post_id")
+register_query('job_posts.approved_by_chat_id', "SELECT jp.id AS job_id FROM job_posts jp JOIN agencies a ON jp.agency_id = a.id WHERE jp.status = 'approved' AND a.chat_id = :chat_id")
+register_query('job_posts.is_approved', "SELECT EXISTS (SELECT 1 FROM job_posts WHERE id = :job_post_id AND status = 'approved')")
+register_query('job_posts.is_part_time', "SELECT EXISTS (SELECT 1 FROM job_posts WHERE id = :job_post_id AND job_type = 'part')")
+register_query('job_posts.agency_chat_id', "SELECT a.chat_id FROM job_posts jp JOIN agencies a ON jp.agency_id = a.id WHERE jp.id = :job_post_id")
+register_query('job_applications.shortlist', "UPDATE job_applications SET shortlist_status = 'yes' WHERE job_id = :job_id AND applicant_id = :applicant_id")
+register_query('job_posts.pending', "SELECT jp.id, jp.job_title, jp.company_name, jp.job_type, a.agency_name FROM job_posts jp JOIN agencies a ON jp.agency_id = a.id WHERE jp.status = 'pending' ORDER BY jp.id")
+register_query('job_posts.lock_pending', "SELECT jp.id, jp.job_type, a.chat_id FROM job_posts jp JOIN agencies a ON jp.agency_id = a.id WHERE jp.id IN :job_post_ids AND jp.status = 'pending' FOR UPDATE")
+register_query('last_insert_id', "SELECT LAST_INSERT_ID()")
+
+# Tokens and shortlists
+register_query('token_balance.exists', "SELECT EXISTS (SELECT 1 FROM token_balance WHERE chat_id = :chat_id)")
+register_query('token_balance.tokens', "SELECT tokens FROM token_balance WHERE chat_id = :chat_id", tokens=sqlalchemy.Integer)
+register_query('token_balance.get', "SELECT tokens, exp_date FROM token_balance WHERE chat_id = :chat_id", tokens=sqlalchemy.Integer, exp_date=sqlalchemy.DateTime)
+register_query('token_balance.expired', "SELECT chat_id, tokens FROM token_balance WHERE exp_date <= :now", chat_id=sqlalchemy.BigInteger, tokens=sqlalchemy.Integer)
+register_query('token_balance.delete_expired', "DELETE FROM token_balance WHERE chat_id = :chat_id AND exp_date <= :now")
+register_query('token_balance.debit', "UPDATE token_balance SET tokens = tokens - :cost WHERE chat_id = :chat_id AND tokens >= :cost")
+register_query('token_balance.credit', "INSERT INTO token_balance (chat_id, tokens, exp_date) VALUES (:chat_id, :tokens, :exp_date) ON DUPLICATE KEY UPDATE tokens = tokens + VALUES(tokens), exp_date = GREATEST(COALESCE(exp_date, VALUES(exp_date)), VALUES(exp_date))")
+register_query('token_balance.refund', "UPDATE token_balance SET tokens = tokens + :tokens WHERE chat_id = :chat_id")
+register_query('shortlist_balance.get', "SELECT shortlist FROM shortlist_balance WHERE chat_id = :chat_id", shortlist=sqlalchemy.Integer)
+register_query('shortlist_balance.existing', "SELECT chat_id FROM shortlist_balance WHERE chat_id IN :chat_ids")
+register_query('shortlist_balance.add', "UPDATE shortlist_balance SET shortlist = shortlist + :new_shortlists WHERE chat_id = :chat_id")
+register_query('shortlist_balance.insert', "INSERT INTO shortlist_balance (chat_id, shortlist) VALUES (:chat_id, :new_shortlists)")
+register_query('shortlist_balance.use', "INSERT INTO shortlist_balance (chat_id, shortlist) VALUES (:chat_id, :shortlist) ON DUPLICATE KEY UPDATE shortlist = shortlist - 1")
+
+# Packages and transactions
+register_query('token_packages.list', "SELECT package_id, package_name, description FROM token_packages")
+register_query('token_packages.catalog', "SELECT package_id, package_name, number_of_tokens, price, description, validity FROM token_packages")
+register_query('token_packages.details', "SELECT package_name, number_of_tokens, price, description FROM token_packages WHERE package_id = :package_id")
+register_query('token_packages.delete', "DELETE FROM token_packages WHERE package_id = :package_id")
+register_query('subscription_packages.catalog', "SELECT subpkg_code, sub_name, number_of_tokens, duration_months, price FROM subscription_packages")
+register_query('token_packages.allocation', "SELECT number_of_tokens, validity FROM token_packages WHERE package_id = :package_id", number_of_tokens=sqlalchemy.Integer, validity=sqlalchemy.Integer)
+register_query('subscription_packages.details', "SELECT sub_name, number_of_tokens, duration_months, price FROM subscription_packages WHERE subpkg_code = :package_id")
+register_query('transactions.insert', "INSERT INTO transactions (chat_id, package_id) VALUES (:chat_id, :package_id)")
+register_query('transactions.latest_id', "SELECT transaction_id FROM transactions WHERE chat_id = :chat_id ORDER BY transaction_id DESC LIMIT 1")
+register_query('transactions.details', "SELECT chat_id, package_id FROM transactions WHERE transaction_id = :transaction_id")
+register_query('transactions.subscription_package', "SELECT sub_name, number_of_tokens, duration_months, price FROM subscription_packages WHERE subpkg_code = (SELECT package_id FROM transactions WHERE transaction_id = :transaction_id)")
+register_query('transactions.token_package', "SELECT package_name, number_of_tokens, price, validity FROM token_packages WHERE package_id = (SELECT package_id FROM transactions WHERE transaction_id = :transaction_id)")
+register_query('transactions.set_status', "UPDATE transactions SET status = :status WHERE transaction_id = :transaction_id")
+register_query('transactions.pending', (
+    "SELECT t.transaction_id, COALESCE((SELECT u.user_handle FROM user_data u WHERE u.chat_id = t.chat_id LIMIT 1), t.chat_id), "
+    "COALESCE(tp.package_name, sp.sub_name, t.package_id), COALESCE(tp.price, sp.price) FROM transactions t "
+    "LEFT JOIN token_packages tp ON tp.package_id = t.package_id LEFT JOIN subscription_packages sp ON sp.subpkg_code = t.package_id "
+    "WHERE t.status = 'pending' ORDER BY t.transaction_id"
+))
+register_query('outbox.insert', "INSERT INTO outbox (chat_id, method, payload) VALUES (:chat_id, :method, :payload)")
+# The first pending message of each chat, if it is due. Later messages of a chat wait for it, even while it is claimed or backing off
+register_query('outbox.claim', "SELECT o.chat_id FROM outbox o WHERE o.status = 'pending' AND o.available_at <= NOW() AND NOT EXISTS (SELECT 1 FROM outbox e WHERE e.chat_id = o.chat_id AND e.status = 'pending' AND e.id < o.id) ORDER BY o.id LIMIT :batch FOR UPDATE OF o SKIP LOCKED")
+register_query('outbox.claim_chats', "SELECT id, chat_id, method, payload, attempts FROM outbox WHERE chat_id IN :chat_ids AND status = 'pending' ORDER BY id LIMIT :batch FOR UPDATE", attempts=sqlalchemy.Integer)
+register_query('outbox.lease', "UPDATE outbox SET available_at = NOW() + INTERVAL :seconds SECOND WHERE id IN :ids")
+register_query('outbox.release', "UPDATE outbox SET available_at = NOW() WHERE id = :id")
+register_query('outbox.sent', "UPDATE outbox SET status = 'sent', attempts = attempts + 1, sent_at = NOW() WHERE id = :id")
+register_query('outbox.retry', "UPDATE outbox SET attempts = attempts + 1, available_at = NOW() + INTERVAL :delay SECOND, last_error = :error WHERE id = :id")
+register_query('outbox.failed', "UPDATE outbox SET status = 'failed', attempts = attempts + 1, last_error = :error WHERE id = :id")
+register_query('outbox.prune', "DELETE FROM outbox WHERE status <> 'pending' AND created_at < :before")
+register_query('media_assets.get', "SELECT file_id FROM media_assets WHERE name = :name AND content_hash = :content_hash", file_id=sqlalchemy.String)
+register_query('media_assets.upsert', "INSERT INTO media_assets (name, content_hash, file_id) VALUES (:name, :content_hash, :file_id) ON DUPLICATE KEY UPDATE content_hash = VALUES(content_hash), file_id = VALUES(file_id)")
+register_query('transactions.lock_pending', "SELECT transaction_id, chat_id, package_id FROM transactions WHERE transaction_id IN :transaction_ids AND status = 'pending' FOR UPDATE")
+
+# Subscriptions
+register_query('subscription_balance.active', "SELECT id, chat_id, start_date, end_date, last_distribution, subpkg_id FROM subscription_balance WHERE status = 'active'")
+register_query('subscription_balance.has_active', "SELECT EXISTS (SELECT 1 FROM subscription_balance WHERE chat_id = :chat_id AND status = 'active')")
+register_query('subscription_balance.has_active_by_transaction', "SELECT EXISTS (SELECT 1 FROM subscription_balance WHERE chat_id = (SELECT chat_id FROM transactions WHERE transaction_id = :transaction_id) AND status = 'active')")
+register_query('subscription_balance.set_status', "UPDATE subscription_balance SET status = :status WHERE id = :sub_balance_id")
+register_query('subscription_balance.expire', "UPDATE subscription_balance SET status = 'expired' WHERE id = :sub_balance_id AND status = 'active'")
+register_query('subscription_balance.claim_distribution', "UPDATE subscription_balance SET last_distribution = :now WHERE id = :id AND last_distribution = :last_distribution")
+
+# Webhook
+register_query('processed_updates.claim', "INSERT IGNORE INTO processed_updates (update_id) VALUES (:update_id)")
+register_query('processed_updates.release', "DELETE FROM processed_updates WHERE update_id = :update_id")
+register_query('processed_updates.prune', "DELETE FROM processed_updates WHERE received_at < :before")
+
+# Persistence
+# Versions only, the user's row has no name. A NULL user_id or conversation_key skips that half
+register_query('persistence.versions', "SELECT NULL AS name, version FROM persistence_user_data WHERE user_id = :user_id UNION ALL SELECT name, version FROM persistence_conversations WHERE conversation_key = :conversation_key")
+register_query('persistence_user_data.get', "SELECT data, version FROM persistence_user_data WHERE user_id = :user_id")
+register_query('persistence_user_data.insert', "INSERT IGNORE INTO persistence_user_data (user_id, data, version) VALUES (:user_id, :data, 1)")
+register_query('persistence_user_data.update', "UPDATE persistence_user_data SET data = :data, version = version + 1 WHERE user_id = :user_id AND version = :version")
+register_query('persistence_user_data.delete', "DELETE FROM persistence_user_data WHERE user_id = :user_id AND version = :version")
+register_query('persistence_conversations.by_key', "SELECT name, state, version FROM persistence_conversations WHERE conversation_key = :conversation_key")
+register_query('persistence_conversations.insert', "INSERT IGNORE INTO persistence_conversations (name, conversation_key, state, version) VALUES (:name, :conversation_key, :state, 1)")
+register_query('persistence_conversations.update', "UPDATE persistence_conversations SET state = :state, version = version + 1 WHERE name = :name AND conversation_key = :conversation_key AND version = :version")
+register_query('persistence_conversations.delete', "DELETE FROM persistence_conversations WHERE name = :name AND conversation_key = :conversation_key AND version = :version")
+
+# Scheduled jobs, lease expiry is compared on the DB's clock so that instances' clocks do not need to agree
+register_query('scheduler_leases.renew', "UPDATE scheduler_leases SET holder = :holder, expires_at = NOW() + INTERVAL :seconds SECOND WHERE name = :name AND (holder = :holder OR expires_at < NOW())")
+register_query('scheduler_leases.insert', "INSERT IGNORE INTO scheduler_leases (name, holder, expires_at) VALUES (:name, :holder, NOW() + INTERVAL :seconds SECOND)")
+register_query('scheduler_leases.release', "UPDATE scheduler_leases SET expires_at = NOW() - INTERVAL 1 SECOND WHERE name = :name AND holder = :holder")
+register_query('scheduled_job_runs.claim', "INSERT IGNORE INTO scheduled_job_runs (job, period, holder) VALUES (:job, :period, :holder)")
+register_query('scheduled_job_runs.finish', "UPDATE scheduled_job_runs SET finished_at = NOW() WHERE job = :job AND period = :period")
+register_query('scheduled_job_runs.release', "DELETE FROM scheduled_job_runs WHERE job = :job AND period = :period AND holder = :holder AND finished_at IS NULL")
+
+###########################################################################################################################################################
+# Token balance
+
+async def debit_tokens(chat_id, cost: int, check_only: bool = False) -> tuple:
+    """
+    Deducts cost tokens from chat_id's balance if it has enough.
+    The check and the deduction are a single conditional UPDATE, so two concurrent spends can never both
+    take the same tokens. The new balance is read back in the same transaction.
+    Example usage:
+    debited, balance = await debit_tokens(chat_id, JOB_POST_PRICE)
+
+    Args:
+        chat_id: Chat ID spending tokens
+        cost (int): Number of tokens to deduct
+        check_only (bool): Only check whether the balance covers cost, without deducting
+
+    Returns:
+        (bool, int)
+        bool: True if the balance covers cost (and it was deducted, unless check_only)
+        int: Balance of account after the deduction, or the current balance if nothing was deducted
+    """
+    params = {"chat_id": chat_id, "cost": cost}
+    if check_only:
+        results = await safe_get_db(QUERIES['token_balance.tokens'], params)
+        balance = results[0][0] if results else 0
+        return (balance >= cost, balance)
+    async with db_connection(commit=True) as conn:
+        debited = (await conn.execute(QUERIES['token_balance.debit'], params)).rowcount == 1
+        balance = (await conn.execute(QUERIES['token_balance.tokens'], params)).scalar()
+    balance = balance or 0
+    if debited:
+        logger.info("%s tokens have been deducted from %s's account, %s remaining", cost, chat_id, balance)
+    else:
+        logger.info("Could not deduct %s tokens from %s's account, balance is %s", cost, chat_id, balance)
+    return (debited, balance)
+
+async def credit_tokens(chat_id, tokens: int, exp_date: datetime) -> tuple:
+    """
+    Adds tokens to chat_id's balance, creating the balance if there is none.
+    The expiry date is only ever extended: it becomes the later of the current expiry date and exp_date.
+    The resulting balance is read back in the same transaction, while the upsert still holds the row lock.
+    Example usage:
+    new_balance, new_exp_date = await credit_tokens(chat_id, 100, datetime.now() + timedelta(days=30))
+
+    Args:
+        chat_id: Chat ID receiving tokens
+        tokens (int): Number of tokens to add
+        exp_date (datetime): Expiry date of the added tokens
+
+    Returns:
+        (int, datetime): Balance and expiry date of account after the credit
+    """
+    params = {"chat_id": chat_id, "tokens": tokens, "exp_date": exp_date}
+    async with db_connection(commit=True) as conn:
+        await conn.execute(QUERIES['token_balance.credit'], params)
+        new_balance, new_exp_date = (await conn.execute(QUERIES['token_balance.get'], params)).one()
+    logger.info("%s tokens have been credited to %s's account, %s expiring on %s", tokens, chat_id, new_balance, new_exp_date)
+    return new_balance, new_exp_date
+
+###########################################################################################################################################################
+# Schema migrations
+# Versioned schema changes, applied in order at startup and recorded in the schema_migrations table.
+# To change the schema, append a new migration to MIGRATIONS, never edit one that has already shipped.
+
+async def _ensure_index(conn: AsyncConnection, table: str, name: str, columns: list):
+    """Creates the index unless the table already has an index (or primary key) starting with these columns"""
+    results = await conn.execute(sqlalchemy.text(
+        "SELECT index_name, GROUP_CONCAT(column_name ORDER BY seq_in_index) FROM information_schema.statistics "
+        "WHERE table_schema = DATABASE() AND table_name = :table GROUP BY index_name"
+    ), {"table": table})
+    for index_name, index_columns in results:
+        if index_columns.lower().split(',')[:len(columns)] == [column.lower() for column in columns]:
+            logger.info("Index on %s (%s) already exists as %s", table, ', '.join(columns), index_name)
+            return
+    logger.info("Creating index %s on %s (%s)", name, table, ', '.join(columns))
+    await conn.execute(sqlalchemy.text(f"CREATE INDEX {name} ON {table} ({', '.join(columns)})"))
+
+async def _migration_hot_path_indexes(conn: AsyncConnection):
+    for table, name, columns in [
+        ('token_balance', 'idx_token_balance_chat_id', ['chat_id']),
+        ('token_balance', 'idx_token_balance_exp_date', ['exp_date']),
+        ('shortlist_balance', 'idx_shortlist_balance_chat_id', ['chat_id']),
+        ('agencies', 'idx_agencies_chat_id', ['chat_id']),
+        ('agencies', 'idx_agencies_user_handle', ['user_handle']),
+        ('applicants', 'idx_applicants_chat_id', ['chat_id']),
+        ('applicants', 'idx_applicants_user_handle', ['user_handle']),
+        ('user_data', 'idx_user_data_chat_id', ['chat_id']),
+        ('job_applications', 'idx_job_applications_job_id_status', ['job_id', 'shortlist_status']),
+        ('job_posts', 'idx_job_posts_agency_id_status', ['agency_id', 'status']),
+        ('subscription_balance', 'idx_subscription_balance_status', ['status']),
+        ('subscription_balance', 'idx_subscription_balance_chat_id_status', ['chat_id', 'status']),
+        ('transactions', 'idx_transactions_chat_id', ['chat_id', 'transaction_id']),
+        ('subscription_packages', 'idx_subscription_packages_subpkg_code', ['subpkg_code']),
+    ]:
+        await _ensure_index(conn, table, name, columns)
+
+async def _migration_processed_updates(conn: AsyncConnection):
+    await conn.execute(sqlalchemy.text(
+        "CREATE TABLE IF NOT EXISTS processed_updates ("
+        "update_id BIGINT PRIMARY KEY, received_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP, "
+        "INDEX idx_processed_updates_received_at (received_at))"
+    ))
+
+async def _migration_persistence(conn: AsyncConnection):
+    await conn.execute(sqlalchemy.text(
+        "CREATE TABLE IF NOT EXISTS persistence_user_data ("
+        "user_id BIGINT PRIMARY KEY, data MEDIUMBLOB NOT NULL, "
+        "updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP)"
+    ))
+    await conn.execute(sqlalchemy.text(
+        "CREATE TABLE IF NOT EXISTS persistence_conversations ("
+        "name VARCHAR(64) NOT NULL, conversation_key VARCHAR(128) NOT NULL, state VARCHAR(255) NOT NULL, "
+        "updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP, "
+        "PRIMARY KEY (name, conversation_key))"
+    ))
+
+async def _migration_scheduler(conn: AsyncConnection):
+    await conn.execute(sqlalchemy.text(
+        "CREATE TABLE IF NOT EXISTS scheduler_leases ("
+        "name VARCHAR(64) PRIMARY KEY, holder VARCHAR(128) NOT NULL, expires_at DATETIME NOT NULL)"
+    ))
+    await conn.execute(sqlalchemy.text(
+        "CREATE TABLE IF NOT EXISTS scheduled_job_runs ("
+        "job VARCHAR(64) NOT NULL, period VARCHAR(32) NOT NULL, holder VARCHAR(128) NOT NULL, "
+        "started_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP, finished_at DATETIME NULL, "
+        "PRIMARY KEY (job, period))"
+    ))
+
+async def _migration_pending_indexes(conn: AsyncConnection):
+    for table, name, columns in [
+        ('job_posts', 'idx_job_posts_status', ['status']),
+        ('transactions', 'idx_transactions_status', ['status', 'transaction_id']),
+    ]:
+        await _ensure_index(conn, table, name, columns)
+
+async def _migration_media_assets(conn: AsyncConnection):
+    await conn.execute(sqlalchemy.text(
+        "CREATE TABLE IF NOT EXISTS media_assets ("
+        "name VARCHAR(255) PRIMARY KEY, content_hash CHAR(64) NOT NULL, file_id VARCHAR(255) NOT NULL, "
+        "updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP)"
+    ))
+
+async def _migration_outbox(conn: AsyncConnection):
+    await conn.execute(sqlalchemy.text(
+        "CREATE TABLE IF NOT EXISTS outbox ("
+        "id BIGINT AUTO_INCREMENT PRIMARY KEY, chat_id BIGINT NOT NULL, method VARCHAR(32) NOT NULL, payload MEDIUMTEXT NOT NULL, "
+        "status VARCHAR(16) NOT NULL DEFAULT 'pending', attempts INT NOT NULL DEFAULT 0, last_error VARCHAR(255) NULL, "
+        "available_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP, created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP, sent_at DATETIME NULL, "
+        "INDEX idx_outbox_status_available_at (status, available_at), INDEX idx_outbox_created_at (created_at))"
+    ))
+
+async def _migration_outbox_chat_index(conn: AsyncConnection):
+    await _ensure_index(conn, 'outbox', 'idx_outbox_chat_id_status', ['chat_id', 'status'])
+
+async def _migration_persistence_versions(conn: AsyncConnection):
+    for table in ('persistence_user_data', 'persistence_conversations'):
+        await conn.execute(sqlalchemy.text(f"ALTER TABLE {table} ADD COLUMN version BIGINT NOT NULL DEFAULT 1"))
+    await _ensure_index(conn, 'persistence_conversations', 'idx_persistence_conversations_key', ['conversation_key'])
+
+# (version, description, migration), versions must be increasing
+MIGRATIONS = [
+    (1, "Indexes for hot path lookups", _migration_hot_path_indexes),
+    (2, "processed_updates table for update deduplication", _migration_processed_updates),
+    (3, "persistence tables for user_data and conversation states", _migration_persistence),
+    (4, "scheduler lease and job run tables", _migration_scheduler),
+    (5, "Indexes for the pending approval queue", _migration_pending_indexes),
+    (6, "media_assets table for the file_ids of uploaded static files", _migration_media_assets),
+    (7, "outbox table for notifications", _migration_outbox),
+    (8, "versions of persisted user_data and conversation states", _migration_persistence_versions),
+    (9, "Index for the per chat order of the outbox", _migration_outbox_chat_index),
+]
+
+async def run_migrations():
+    """
+    Applies the migrations in MIGRATIONS that have not been applied yet.
+    A MySQL named lock makes sure that only one instance migrates at a time when several start together.
+    """
+    async with async_pool.connect() as conn:
+        await conn.execute(sqlalchemy.text(
+            "CREATE TABLE IF NOT EXISTS schema_migrations ("
+            "version INT PRIMARY KEY, description VARCHAR(255) NOT NULL, applied_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP)"
+        ))
+        await conn.commit()
+        locked = (await conn.execute(sqlalchemy.text("SELECT GET_LOCK('schema_migrations', 60)"))).scalar()
+        if not locked:
+            logger.error("Could not get the schema_migrations lock, skipping migrations")
+            return
+        try:
+            applied = {row[0] for row in await conn.execute(sqlalchemy.text("SELECT version FROM schema_migrations"))}
             await conn.commit()
-            return True
-    except Exception as e:
-        logger.info(f"Error in interacting with database: {e}")
-        return False
-    
+            for version, description, migration in MIGRATIONS:
+                if version in applied:
+                    continue
+                logger.info("Applying migration %s: %s", version, description)
+                await migration(conn)
+                await conn.execute(
+                    sqlalchemy.text("INSERT INTO schema_migrations (version, description) VALUES (:version, :description)"),
+                    {"version": version, "description": description}
+                )
+                await conn.commit()
+            logger.info("Schema is at version %s", max([version for version, _, _ in MIGRATIONS], default=0))
+        finally:
+            await conn.execute(sqlalchemy.text("SELECT RELEASE_LOCK('schema_migrations')"))
+
+async def check_query_plans() -> list:
+    """
+    Runs EXPLAIN on every registered statement that filters on parameters and warns about full table scans.
+    Statements without parameters (e.g. the package catalogs) are full listings on purpose and are skipped.
+
+    Returns:
+        list: Names of the statements that scan a whole table
+    """
+    full_scans = []
+    async with async_pool.connect() as conn:
+        for name, statement in QUERIES.items():
+            query_string = str(statement)
+            # Sample value for every parameter, a string so that it compares with both text and numeric columns without defeating their indexes
+            params = {key: '0' for key in statement.compile().params}
+            if not params or not query_string.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE')):
+                continue
+            try:
+                plan = (await conn.execute(sqlalchemy.text(f"EXPLAIN {query_string}"), params)).mappings().all()
+            except Exception as e:
+                logger.warning("Could not EXPLAIN %s: %s", name, e)
+                continue
+            scanned_tables = [row['table'] for row in plan if row['type'] == 'ALL']
+            if scanned_tables:
+                full_scans.append(name)
+                logger.error("FULL TABLE SCAN: %s scans %s, add an index through a migration", name, ', '.join(scanned_tables))
+        await conn.rollback()
+    if not full_scans:
+        logger.info("Query plans checked, no full table scans in %s registered statements", len(QUERIES))
+    return full_scans
+
+###########################################################################################################################################################
+# Package catalogs
+
+class PackageCatalog:
+    """
+    Cached token and subscription package catalogs, shown on every /purchase_tokens and /purchase_subscription.
+    Reloaded after PACKAGE_CATALOG_TTL seconds, or on the next read after an admin adds or deletes a package.
+    """
+
+    def __init__(self):
+        self.token_packages = None
+        self.subscription_packages = None
+        self.loaded_at = 0.0
+
+    async def load(self):
+        token_packages, subscription_packages = await fetch_many(
+            (QUERIES['token_packages.catalog'], {}),
+            (QUERIES['subscription_packages.catalog'], {}),
+        )
+        if token_packages is None or subscription_packages is None:
+            return # safe_get_db failed, try again on the next read
+        self.token_packages, self.subscription_packages = token_packages, subscription_packages
+        self.loaded_at = time.monotonic()
+        logger.info("Loaded %s token packages and %s subscription packages", len(token_packages), len(subscription_packages))
+
+    def invalidate(self):
+        """Marks the catalogs stale, after the current unit of work has committed if there is one"""
+        uow = current_unit_of_work.get()
+        if uow is not None and not uow.closed:
+            uow.after_commit.append(self._mark_stale)
+        else:
+            self._mark_stale()
+
+    def _mark_stale(self):
+        self.loaded_at = 0.0
+
+    async def _ensure_loaded(self):
+        if time.monotonic() - self.loaded_at > PACKAGE_CATALOG_TTL or self.token_packages is None:
+            await self.load()
+
+    async def get_token_packages(self) -> list:
+        await self._ensure_loaded()
+        return self.token_packages or []
+
+    async def get_subscription_packages(self) -> list:
+        await self._ensure_loaded()
+        return self.subscription_packages or []
+
+package_catalog = PackageCatalog()
+
+###########################################################################################################################################################
+# Persistence
+# user_data and ConversationHandler states are kept in the DB, so that a restarted or additional instance carries on with
+# users who are mid-flow. Every PERSISTENCE_UPDATE_INTERVAL seconds PTB hands over the user_data and conversations that
+# updates have touched, only the ones that actually changed are written, together in one transaction.
+
+def _restore_telegram_object(cls, state: dict, bot: ExtBot) -> TelegramObject:
+    obj = cls.__new__(cls)
+    obj.__setstate__(state)
+    obj.set_bot(bot)
+    return obj
+
+class _BotPickler(pickle.Pickler):
+    """Pickles telegram objects without the bot, which is swapped back in by _BotUnpickler"""
+
+    def __init__(self, bot: ExtBot, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.bot = bot
+
+    def persistent_id(self, obj):
+        return "bot" if obj is self.bot else None
+
+    def reducer_override(self, obj):
+        if isinstance(obj, TelegramObject):
+            return _restore_telegram_object, (type(obj), obj.__getstate__(), self.bot)
+        return NotImplemented
+
+class _BotUnpickler(pickle.Unpickler):
+    def __init__(self, bot: ExtBot, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.bot = bot
+
+    def persistent_load(self, pid):
+        if pid == "bot":
+            return self.bot
+        raise pickle.UnpicklingError(f"Unknown persistent id {pid}")
+
+class DBPersistence(BasePersistence):
+    """
+    Persistence for user_data and conversation states on the bot's DB (persistence_user_data and persistence_conversations).
+    Nothing is loaded at startup. refresh() runs before the other handlers of every update that a handler using this state
+    will see, and reloads the user's user_data and conversation states if another instance has written them since this one
+    last saw them (every row has a version). stateless_callbacks are handler callbacks that use neither.
+    Writes are buffered and deduplicated per user/conversation, and only apply if the row still has the version this
+    instance last saw, so a stale instance never overwrites newer state. A write that fails is retried with the next batch.
+    """
+
+    def __init__(self, update_interval: float = PERSISTENCE_UPDATE_INTERVAL, cache_size: int = PERSISTENCE_CACHE_SIZE, stateless_callbacks: Collection = ()):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.cache_size = cache_size
+        self.known = collections.OrderedDict() # user_id or (name, key) -> (hash of what the DB holds, its version), least recently used first
+        self.stateless_callbacks = set(stateless_callbacks)
+        self.conversation_handlers = None # name -> persistent ConversationHandler, collected on the first refresh
+        self.conversation_steps = [] # handlers inside the persistent ConversationHandlers
+        self.user_data_handlers = [] # other handlers that may use user_data
+        self.pending_user_data = {} # user_id -> pickled user_data, None to delete
+        self.pending_conversations = {} # (name, key) -> serialised state, None to delete
+        self.write_lock = asyncio.Lock()
+        self.write_task = None
+        self.conflicts = 0
+
+    def dumps(self, data: dict) -> bytes:
+        buffer = io.BytesIO()
+        _BotPickler(self.bot, buffer, protocol=pickle.HIGHEST_PROTOCOL).dump(data)
+        return buffer.getvalue()
+
+    def loads(self, data: bytes) -> dict:
+        return _BotUnpickler(self.bot, io.BytesIO(data)).load()
+
+    def remember(self, key, value_hash, version: int):
+        self.known[key] = (value_hash, version)
+        self.known.move_to_end(key)
+        while len(self.known) > self.cache_size:
+            self.known.popitem(last=False)
+
+    def is_current(self, key, version: int) -> bool:
+        """Whether this instance has seen version of key (or has newer changes of its own waiting to be written)"""
+        known = self.known.get(key)
+        if known is None or known[1] != version:
+            return False
+        self.known.move_to_end(key)
+        return True
+
+    async def get_user_data(self) -> dict:
+        # Loaded per user in refresh() instead
+        return {}
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        # Loaded per chat in refresh() instead
+        return {}
+
+    def collect_handlers(self, application: Application):
+        """Sorts the application's handlers by the state they can reach, once they have all been added"""
+        self.conversation_handlers = {}
+        for group, handlers in application.handlers.items():
+            if group < 0:
+                continue
+            for handler in handlers:
+                if isinstance(handler, ConversationHandler):
+                    steps = handler.entry_points + [step for steps in handler.states.values() for step in steps] + handler.fallbacks
+                    if handler.persistent:
+                        self.conversation_handlers[handler.name] = handler
+                        self.conversation_steps += steps
+                    else:
+                        self.user_data_handlers += steps
+                elif handler.callback not in self.stateless_callbacks:
+                    self.user_data_handlers.append(handler)
+
+    def is_stale(self, key, pending: dict, version: int) -> bool:
+        return key not in pending and not self.is_current(key, version)
+
+    async def refresh(self, update: object, context: ContextTypes.DEFAULT_TYPE):
+        """
+        Handler in group -1, so that it runs before the ConversationHandlers check the update.
+        Reloads the user_data and conversation states of the update's user and chat that another instance has changed.
+        Updates that no handler using them would see (whatever the conversation states) are let through without a DB read.
+        """
+        if not isinstance(update, Update) or update.effective_user is None:
+            return
+        if self.conversation_handlers is None:
+            self.collect_handlers(context.application)
+        conversations = update.effective_chat is not None and any(step.check_update(update) for step in self.conversation_steps)
+        if not conversations and not any(handler.check_update(update) for handler in self.user_data_handlers):
+            return
+        user_id = update.effective_user.id
+        key = (update.effective_chat.id, user_id) if conversations else None # per_chat and per_user conversations
+        conversation_key = orjson.dumps(key).decode() if conversations else None
+        try:
+            # On a connection of its own, returned before the handlers run, and on the primary since a replica may not
+            # have this instance's own latest writes yet. The state itself is only read if its version has changed
+            async with db_connection(new_connection=True) as conn:
+                versions = dict((await conn.execute(QUERIES['persistence.versions'], {"user_id": user_id, "conversation_key": conversation_key})).all())
+                user_version = versions.pop(None, 0)
+                user_row = conversation_rows = None
+                if user_version and self.is_stale(user_id, self.pending_user_data, user_version):
+                    user_row = (await conn.execute(QUERIES['persistence_user_data.get'], {"user_id": user_id})).first()
+                if conversations and any(
+                    self.is_stale((name, key), self.pending_conversations, versions.get(name, 0)) for name in self.conversation_handlers
+                ):
+                    conversation_rows = (await conn.execute(QUERIES['persistence_conversations.by_key'], {"conversation_key": conversation_key})).all()
+        except Exception as e:
+            logger.error("Could not refresh the persisted state of %s: %s", user_id, e)
+            return
+        if user_row is not None or self.is_stale(user_id, self.pending_user_data, user_version):
+            self.refresh_user(user_id, context.user_data, user_row)
+        if conversation_rows is not None:
+            self.refresh_conversations(key, conversation_rows)
+
+    def refresh_user(self, user_id: int, user_data: dict, row):
+        data, version = row if row else (None, 0)
+        if user_id in self.pending_user_data or self.is_current(user_id, version):
+            return
+        user_data.clear()
+        if data is not None:
+            try:
+                user_data.update(self.loads(data))
+            except Exception as e:
+                logger.warning("Could not load user_data of %s: %s", user_id, e)
+        self.remember(user_id, None if data is None else hash(data), version)
+
+    def refresh_conversations(self, key: tuple, rows: list):
+        stored = {name: (state, version) for name, state, version in rows}
+        for name, handler in self.conversation_handlers.items():
+            state, version = stored.get(name, (None, 0))
+            if (name, key) in self.pending_conversations or self.is_current((name, key), version):
+                continue
+            # PTB has no public way to change the state of a running ConversationHandler, set it without marking it as changed.
+            # This relies on PTB internals, hence the pinned python-telegram-bot version, tests/test_persistence.py checks it still works
+            conversations = handler._conversations
+            if state is None:
+                conversations.data.pop(key, None)
+            else:
+                conversations.update_no_track({key: orjson.loads(state)})
+            self.remember((name, key), None if state is None else hash(state), version)
+
+    async def refresh_user_data(self, user_id: int, user_data: dict):
+        pass # Done in refresh(), which runs before the ConversationHandlers look at the update
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict):
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict):
+        pass
+
+    async def update_user_data(self, user_id: int, data: dict):
+        try:
+            pickled = self.dumps(data)
+        except Exception as e:
+            logger.warning("Could not pickle user_data of %s, it is not persisted: %s", user_id, e)
+            return
+        self.buffer(self.pending_user_data, user_id, pickled)
+
+    async def update_conversation(self, name: str, key: tuple, new_state):
+        self.buffer(self.pending_conversations, (name, key), None if new_state is None else orjson.dumps(new_state).decode())
+
+    async def drop_user_data(self, user_id: int):
+        self.buffer(self.pending_user_data, user_id, None)
+
+    async def update_chat_data(self, chat_id: int, data: dict):
+        pass
+
+    async def update_bot_data(self, data: dict):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id: int):
+        pass
+
+    def buffer(self, pending: dict, key, value):
+        """Queues value to be written for key, unless the DB already holds it"""
+        known = self.known.get(key, (None, 0))
+        if known[0] == (None if value is None else hash(value)) and key not in pending:
+            return
+        pending[key] = value
+        if self.write_task is None or self.write_task.done():
+            # Runs once the rest of this round of update_* calls has been buffered
+            self.write_task = asyncio.create_task(self.write_pending())
+
+    async def write_pending(self):
+        """Writes everything buffered in one transaction"""
+        async with self.write_lock:
+            user_data, self.pending_user_data = self.pending_user_data, {}
+            conversations, self.pending_conversations = self.pending_conversations, {}
+            if not user_data and not conversations:
+                return
+            writes = [
+                (user_id, "persistence_user_data", {"user_id": user_id, "data": data})
+                for user_id, data in user_data.items()
+            ] + [
+                ((name, key), "persistence_conversations", {"name": name, "conversation_key": orjson.dumps(key).decode(), "state": state})
+                for (name, key), state in conversations.items()
+            ]
+            results = []
+            try:
+                async with db_connection(commit=True, new_connection=True) as conn:
+                    for key, table, params in writes:
+                        version = self.known.get(key, (None, 0))[1]
+                        value = params.get("data", params.get("state"))
+                        if value is None and version == 0: # Nothing stored to delete
+                            results.append((key, value, 0))
+                            continue
+                        if value is None:
+                            query_name = f"{table}.delete"
+                        elif version == 0:
+                            query_name = f"{table}.insert"
+                        else:
+                            query_name = f"{table}.update"
+                        written = (await conn.execute(QUERIES[query_name], {**params, "version": version})).rowcount
+                        results.append((key, value, (0 if value is None else version + 1) if written else None))
+            except Exception as e:
+                logger.error("Could not write %s user_data and %s conversation states, retrying with the next batch: %s", len(user_data), len(conversations), e)
+                # Keep what was buffered in the meantime, it is newer
+                for key, value in user_data.items():
+                    self.pending_user_data.setdefault(key, value)
+                for key, value in conversations.items():
+                    self.pending_conversations.setdefault(key, value)
+                return
+            for key, value, version in results:
+                if version is None:
+                    # Another instance wrote it since this one last saw it, the next refresh loads theirs
+                    self.conflicts += 1
+                    self.known.pop(key, None)
+                    logger.warning("Persisted state of %s was changed by another instance, not overwriting it", key)
+                else:
+                    self.remember(key, None if value is None else hash(value), version)
+            logger.info("Persisted %s user_data and %s conversation states", len(user_data), len(conversations))
+
+    async def flush(self):
+        if self.write_task is not None:
+            await self.write_task
+        await self.write_pending()
+
+###########################################################################################################################################################
+# Bot API client
+
+class BotAPIRequest(HTTPXRequest):
+    """
+    HTTPXRequest with the BOT_API_* pool and timeout settings. Idle connections are kept for BOT_API_KEEPALIVE_EXPIRY
+    (with TCP keepalive on), so that the first requests after a quiet spell do not wait for a new TLS connection.
+    """
+
+    def __init__(self, connection_pool_size: int = BOT_API_POOL_SIZE, keepalive_expiry: float = BOT_API_KEEPALIVE_EXPIRY):
+        self.limits = httpx.Limits(
+            max_connections=connection_pool_size,
+            max_keepalive_connections=connection_pool_size,
+            keepalive_expiry=keepalive_expiry,
+        )
+        super().__init__(
+            connection_pool_size=connection_pool_size,
+            connect_timeout=BOT_API_CONNECT_TIMEOUT,
+            read_timeout=BOT_API_READ_TIMEOUT,
+            write_timeout=BOT_API_WRITE_TIMEOUT,
+            pool_timeout=BOT_API_POOL_TIMEOUT,
+            http_version=BOT_API_HTTP_VERSION,
+        )
+
+    def _build_client(self) -> httpx.AsyncClient:
+        # The limits have to be given to the transport, a client only applies its own to the transport it creates itself
+        transport = httpx.AsyncHTTPTransport(
+            limits=self.limits,
+            http1=self._client_kwargs["http1"],
+            http2=self._client_kwargs["http2"],
+            socket_options=((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),),
+        )
+        return httpx.AsyncClient(**self._client_kwargs | {"limits": self.limits, "transport": transport})
+
+###########################################################################################################################################################
+# Outbound rate limiting
+# Every Bot API request that targets a chat passes through SendScheduler. It waits for a token from that chat's bucket and
+# then from the global one, so bursts (e.g. daily_checks notifying every user) are spread out instead of failing with 429.
+# A 429 pauses all sending for its retry_after, after which the request is retried.
+
+class TokenBucket:
+    """Hands out `rate` tokens per second, up to `capacity` at once. Waiters are served in order"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        async with self.lock:
+            self._refill()
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+
+    def is_idle(self) -> bool:
+        """True if nobody is waiting and the bucket is full again, so it can be dropped"""
+        self._refill()
+        return not self.lock.locked() and self.tokens >= self.capacity
+
+class SendScheduler(BaseRateLimiter[int]):
+    """
+    Rate limiter for the bot: a global bucket for all messages, plus a bucket per private chat and per group.
+    Edits of messages (Next/Previous, Refresh buttons) have a looser bucket per chat of their own, so browsing
+    is not held to the 1 message per second of new messages.
+    Requests Telegram answers with RetryAfter are retried up to SEND_MAX_RETRIES times (or the number passed as
+    `rate_limit_args`), after the retry_after it gave, doubled on each further attempt.
+    """
+
+    def __init__(self):
+        self.global_bucket = TokenBucket(SEND_GLOBAL_PER_SECOND, SEND_GLOBAL_PER_SECOND)
+        self.chat_buckets = {}
+        self.resume_at = 0 # time.monotonic() before which nothing is sent, after a RetryAfter
+        self.waiting = 0
+        self.sending = 0
+        self.rate_limited = 0
+        self.failed = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def chat_bucket(self, chat_id, edit: bool = False) -> TokenBucket:
+        if len(self.chat_buckets) > 1024:
+            for key, bucket in list(self.chat_buckets.items()):
+                if bucket.is_idle():
+                    del self.chat_buckets[key]
+        key = (chat_id, edit)
+        bucket = self.chat_buckets.get(key)
+        if bucket is None:
+            # Negative ids (and @usernames) are groups and channels
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            if edit:
+                bucket = TokenBucket(SEND_EDIT_PER_SECOND, SEND_EDIT_BURST)
+            elif is_group:
+                bucket = TokenBucket(SEND_GROUP_PER_MINUTE / 60, SEND_CHAT_BURST)
+            else:
+                bucket = TokenBucket(SEND_CHAT_PER_SECOND, SEND_CHAT_BURST)
+            self.chat_buckets[key] = bucket
+        return bucket
+
+    async def process_request(self, callback, args, kwargs, endpoint: str, data: dict, rate_limit_args):
+        # No DB locks are held while waiting for a bucket or for Telegram
+        await commit_before_sending()
+        chat_id = data.get("chat_id")
+        if chat_id is None:
+            return await callback(*args, **kwargs)
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            pass
+        max_retries = SEND_MAX_RETRIES if rate_limit_args is None else rate_limit_args
+        edit = endpoint.startswith("edit") # editMessageText, editMessageCaption, editMessageReplyMarkup, ...
+        self.waiting += 1
+        try:
+            for attempt in range(max_retries + 1):
+                await self.chat_bucket(chat_id, edit).acquire()
+                await self.global_bucket.acquire()
+                while (pause := self.resume_at - time.monotonic()) > 0:
+                    await asyncio.sleep(pause)
+                self.waiting -= 1
+                self.sending += 1
+                try:
+                    return await callback(*args, **kwargs)
+                except telegram.error.RetryAfter as e:
+                    self.rate_limited += 1
+                    if attempt == max_retries:
+                        self.failed += 1
+                        logger.error("%s to %s still rate limited after %s retries, giving up", endpoint, chat_id, max_retries)
+                        raise
+                    delay = e.retry_after * 2 ** attempt
+                    self.resume_at = max(self.resume_at, time.monotonic() + e.retry_after)
+                    logger.warning("%s to %s rate limited, retrying in %.1fs", endpoint, chat_id, delay)
+                finally:
+                    self.sending -= 1
+                    self.waiting += 1
+                await asyncio.sleep(delay)
+        finally:
+            self.waiting -= 1
+
+    def stats(self) -> dict:
+        return {
+            "waiting": self.waiting,
+            "sending": self.sending,
+            "paused_for": round(max(0, self.resume_at - time.monotonic()), 1),
+            "rate_limited": self.rate_limited,
+            "failed": self.failed,
+            "chats": len(self.chat_buckets),
+        }
+
+###########################################################################################################################################################
+# Media assets
+# Static files (e.g. the PayNow QR code) are uploaded to Telegram once. The file_id Telegram returns is kept in media_assets
+# together with a hash of the file, so every later send (on any instance, after restarts) only sends the file_id, and a changed
+# file is uploaded again.
+
+class MediaAssets:
+    """Sends static files by their cached Telegram file_id, uploading them on first use or when Telegram rejects the file_id"""
+
+    # Parts of the BadRequest messages Telegram answers a stale or invalid file_id with. Any other BadRequest (bad caption,
+    # chat not found, ...) would fail the upload just the same, so it is raised instead
+    FILE_ID_ERRORS = ("wrong file identifier", "wrong remote file identifier", "file reference", "wrong padding")
+
+    def __init__(self):
+        self.file_ids = {} # path: file_id
+        self.hashes = {} # path: sha256 of the file content, read once per process
+        self.locks = collections.defaultdict(asyncio.Lock) # path: lock, so a file is uploaded once even if many wait for it
+        self.uploads = 0
+
+    def content_hash(self, path: str) -> str:
+        if path not in self.hashes:
+            with open(path, 'rb') as file:
+                self.hashes[path] = hashlib.sha256(file.read()).hexdigest()
+        return self.hashes[path]
+
+    async def file_id(self, path: str):
+        """Cached file_id of the current content of path, None if it has not been uploaded yet"""
+        if path not in self.file_ids:
+            results = await safe_get_db(QUERIES['media_assets.get'], {"name": path, "content_hash": self.content_hash(path)})
+            if results:
+                self.file_ids[path] = results[0][0]
+        return self.file_ids.get(path)
+
+    async def reply_photo(self, message: Message, path: str, **kwargs) -> Message:
+        """message.reply_photo() with the photo at path"""
+        file_id = await self.file_id(path)
+        if file_id is None:
+            async with self.locks[path]:
+                file_id = await self.file_id(path) # Uploaded while we waited
+                if file_id is None:
+                    return await self.upload(message, path, **kwargs)
+        try:
+            return await message.reply_photo(photo=file_id, **kwargs)
+        except telegram.error.BadRequest as e:
+            if not any(error in e.message.lower() for error in self.FILE_ID_ERRORS):
+                raise
+            logger.warning("Telegram rejected the file_id of %s (%s), uploading it again", path, e)
+            if self.file_ids.get(path) == file_id:
+                del self.file_ids[path]
+            return await self.upload(message, path, **kwargs)
+
+    async def upload(self, message: Message, path: str, **kwargs) -> Message:
+        with open(path, 'rb') as file:
+            sent = await message.reply_photo(photo=file, **kwargs)
+        self.uploads += 1
+        self.file_ids[path] = sent.photo[-1].file_id
+        logger.info("Uploaded %s to Telegram as %s", path, self.file_ids[path])
+        try:
+            async with db_connection(commit=True, new_connection=True) as conn: # Keep the file_id even if the update fails later on
+                await conn.execute(QUERIES['media_assets.upsert'], {"name": path, "content_hash": self.content_hash(path), "file_id": self.file_ids[path]})
+        except Exception as e:
+            # The photo has been sent, so the conversation goes on. This process keeps using the file_id, other ones upload it again
+            logger.error("Could not store the file_id of %s: %s", path, e)
+        return sent
+
+media_assets = MediaAssets()
+
+###########################################################################################################################################################
+# Outbox
+# Notifications to other chats (the admin, agencies, the channel) are not sent by the handlers. notify() writes them to the
+# outbox table in the update's own transaction, so they are only sent if the change they are about is committed, and are not
+# lost if Telegram fails after the commit. OutboxSender sends them in the background: woken after every commit that queued
+# something, it claims the chats whose first pending message is due with SKIP LOCKED (so every instance can run one) and
+# sends concurrently per chat. Within a chat messages are sent in order: a chat is only claimed by one sender at a time, and
+# a failed message is retried with exponential backoff before any later message of its chat is sent.
+
+OUTBOX_METHODS = ("send_message", "send_photo") # Bot methods notify() can queue
+
+async def notify(chat_id, method: str = "send_message", **kwargs):
+    """
+    Queues bot.<method>(chat_id=chat_id, **kwargs) in the outbox, committed together with the current unit of work.
+    Example usage:
+    await notify(chat_id, text="Your posting has been approved!")
+    await notify(ADMIN_CHAT_ID, method="send_photo", photo=file_id, caption=caption, reply_markup=reply_markup)
+    """
+    if method not in OUTBOX_METHODS:
+        raise ValueError(f"notify() cannot queue {method}")
+    if isinstance(kwargs.get('reply_markup'), TelegramObject):
+        kwargs['reply_markup'] = kwargs['reply_markup'].to_dict()
+    params = {"chat_id": chat_id, "method": method, "payload": orjson.dumps(kwargs).decode()}
+    async with db_connection(commit=True) as conn: # Errors are raised, so that the change the message is about is rolled back too
+        await conn.execute(QUERIES['outbox.insert'], params)
+    uow = current_unit_of_work.get()
+    if uow is not None and not uow.closed:
+        uow.after_commit.append(outbox_sender.wake)
+    else:
+        outbox_sender.wake()
+
+class OutboxSender:
+    """Sends the messages queued by notify(), see run()"""
+
+    def __init__(self):
+        self.wakeup = asyncio.Event()
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+
+    def wake(self):
+        self.wakeup.set()
+
+    def stats(self) -> dict:
+        return {"sent": self.sent, "retried": self.retried, "failed": self.failed}
+
+    async def claim(self) -> list:
+        """
+        Claims the pending messages of the chats whose first one is due, up to OUTBOX_BATCH_SIZE, hiding them from other
+        senders for OUTBOX_LEASE_SECONDS
+        """
+        async with db_connection(commit=True, new_connection=True) as conn:
+            chat_ids = (await conn.execute(QUERIES['outbox.claim'], {"batch": OUTBOX_BATCH_SIZE})).scalars().all()
+            if not chat_ids:
+                return []
+            # Holding the lock on the first message of these chats, no other sender can claim any of their messages
+            rows = (await conn.execute(QUERIES['outbox.claim_chats'], {"chat_ids": tuple(chat_ids), "batch": OUTBOX_BATCH_SIZE})).all()
+            await self.lease(conn, rows)
+        return rows
+
+    @staticmethod
+    async def lease(conn: AsyncConnection, rows: list):
+        await conn.execute(QUERIES['outbox.lease'], {"ids": tuple(row[0] for row in rows), "seconds": OUTBOX_LEASE_SECONDS})
+
+    async def renew_lease(self, rows: list):
+        """Keeps rows hidden from other senders until cancelled, sending them can wait on SendScheduler for longer than a lease"""
+        while True:
+            await asyncio.sleep(OUTBOX_LEASE_SECONDS / 3)
+            try:
+                async with db_connection(commit=True, new_connection=True) as conn:
+                    await self.lease(conn, rows)
+            except Exception as e:
+                logger.warning("Outbox: could not renew the lease of %s messages: %s", len(rows), e)
+
+    @staticmethod
+    async def deliver(bot, chat_id, method: str, payload: str):
+        kwargs = orjson.loads(payload)
+        if 'reply_markup' in kwargs:
+            kwargs['reply_markup'] = InlineKeyboardMarkup.de_json(kwargs['reply_markup'], bot)
+        await getattr(bot, method)(chat_id=chat_id, **kwargs)
+
+    async def send_chat(self, bot, rows: list) -> list:
+        """
+        Sends the messages of one chat in order, stopping at the first that fails.
+        Returns (row, error) for each message tried, error is None if it was sent.
+        """
+        results = []
+        for row in rows:
+            message_id, chat_id, method, payload, attempts = row
+            try:
+                await self.deliver(bot, chat_id, method, payload)
+                results.append((row, None))
+            except Exception as e:
+                results.append((row, e))
+                break
+        return results
+
+    async def drain(self, bot) -> int:
+        """Sends one batch, returns the number of messages claimed"""
+        rows = await self.claim()
+        if not rows:
+            return 0
+        chats = {}
+        for row in rows:
+            chats.setdefault(row[1], []).append(row)
+        renewal = asyncio.create_task(self.renew_lease(rows))
+        try:
+            results = [result for chat_results in await asyncio.gather(*(self.send_chat(bot, chat_rows) for chat_rows in chats.values())) for result in chat_results]
+        finally:
+            renewal.cancel()
+
+        # Messages after a failed one in their chat were not tried, they are due again once it has been retried or given up
+        tried = {row[0] for row, error in results}
+        release = [{"id": row[0]} for row in rows if row[0] not in tried]
+        sent, retry, failed = [], [], []
+        for (message_id, chat_id, method, payload, attempts), error in results:
+            if error is None:
+                sent.append({"id": message_id})
+            # Blocked by the user, chat gone, bad message: sending it again will not help
+            elif isinstance(error, (telegram.error.Forbidden, telegram.error.BadRequest)) or attempts + 1 >= OUTBOX_MAX_ATTEMPTS:
+                logger.error("Outbox: giving up on message %s to %s after %s attempts: %s", message_id, chat_id, attempts + 1, error)
+                failed.append({"id": message_id, "error": str(error)[:255]})
+            else:
+                logger.warning("Outbox: could not send message %s to %s, retrying: %s", message_id, chat_id, error)
+                retry.append({"id": message_id, "error": str(error)[:255], "delay": OUTBOX_RETRY_SECONDS * 2 ** attempts})
+        async with db_connection(commit=True, new_connection=True) as conn:
+            for query_name, params in (('outbox.sent', sent), ('outbox.retry', retry), ('outbox.failed', failed), ('outbox.release', release)):
+                if params:
+                    await conn.execute(QUERIES[query_name], params)
+        self.sent += len(sent)
+        self.retried += len(retry)
+        self.failed += len(failed)
+        return len(rows)
+
+    async def run(self, bot):
+        """Sends queued messages whenever woken or every OUTBOX_POLL_SECONDS, until cancelled"""
+        while True:
+            self.wakeup.clear()
+            try:
+                while await self.drain(bot):
+                    pass
+            except Exception as e:
+                logger.warning("Outbox: could not send queued messages: %s", e)
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), OUTBOX_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+
+outbox_sender = OutboxSender()
+
+###########################################################################################################################################################
+# Startup
+
+async def log_startup_phase(phase: str, coroutine: Awaitable):
+    """Awaits coroutine and logs how long it took"""
+    start = time.perf_counter()
+    try:
+        return await coroutine
+    finally:
+        logger.info("Startup: %s took %.0fms", phase, (time.perf_counter() - start) * 1000)
+
+async def warm_pool(engine: AsyncEngine, connections: int):
+    """Opens and validates connections on engine at once, so that they are already pooled when the first updates arrive"""
+    async def open_connection():
+        async with engine.connect() as conn:
+            await conn.execute(as_statement("SELECT 1"))
+    results = await asyncio.gather(*[open_connection() for _ in range(connections)], return_exceptions=True)
+    failures = [result for result in results if isinstance(result, Exception)]
+    if failures:
+        logger.warning("Could only open %s of %s pooled connections: %s", connections - len(failures), connections, failures[0])
+    logger.info("Pool warmed: %s", engine.pool.status())
+
+async def prepare_database():
+    """Migrates and checks the schema, then warms the connection pools and loads the package catalogs together"""
+    try:
+        if DB_MIGRATE_ON_STARTUP:
+            await log_startup_phase("schema migrations", run_migrations())
+        if DB_EXPLAIN_ON_STARTUP:
+            await log_startup_phase("query plan check", check_query_plans())
+    except Exception:
+        logger.exception("Schema migration/check failed, starting anyway")
+    phases = [
+        log_startup_phase(f"warming {DB_WARM_CONNECTIONS} DB connections", warm_pool(async_pool, DB_WARM_CONNECTIONS)),
+        log_startup_phase("loading package catalogs", package_catalog.load()),
+    ]
+    if read_pool is not async_pool:
+        phases.append(log_startup_phase(f"warming {DB_WARM_CONNECTIONS} read replica connections", warm_pool(read_pool, DB_WARM_CONNECTIONS)))
+    await asyncio.gather(*phases)
+
 @dataclass
 class WebhookUpdate:
     """Simple dataclass to wrap a custom update type"""
@@ -226,6 +2036,19 @@ class WebhookUpdate:
     user_id: int
     payload: str
 
+    @classmethod
+    def from_json(cls, record: bytes) -> "WebhookUpdate":
+        """Parses a {"user_id": ..., "payload": ...} JSON object, raises ValueError if it is not one"""
+        data = orjson.loads(record)
+        if not isinstance(data, dict):
+            raise ValueError("Expected a JSON object")
+        user_id, payload = data.get("user_id"), data.get("payload")
+        if isinstance(user_id, bool) or not isinstance(user_id, (int, str)):
+            raise ValueError("The `user_id` must be an integer")
+        if not isinstance(payload, str):
+            raise ValueError("The `payload` must be a string")
+        return cls(user_id=int(user_id), payload=payload)
+
 
 class CustomContext(CallbackContext[ExtBot, dict, dict, dict]):
     """
@@ -610,21 +2433,10 @@ async def edit_profile(update: Update, context: CallbackContext) -> int:
     user_handle = update.effective_user.username
 
     # Retrieve agency and applicant profiles for the user_handle
-    async with AsyncSessionLocal() as conn:
-        results = await conn.execute(
-            sqlalchemy.text(
-                f"SELECT id, agency_name FROM agencies WHERE user_handle = '{user_handle}'"
-            )
-        )
-        agency_profiles = results.fetchall()
-
-    async with AsyncSessionLocal() as conn:
-        results = await conn.execute(
-            sqlalchemy.text(
-                f"SELECT id, name FROM applicants WHERE user_handle = '{user_handle}'"
-            )
-        )
-        applicant_profiles = results.fetchall()
+    agency_profiles, applicant_profiles = await fetch_many(
+        (QUERIES['agencies.by_user_handle'], {"user_handle": user_handle}),
+        (QUERIES['applicants.by_user_handle'], {"user_handle": user_handle}),
+    )
 
     # Format profiles as inline buttons
     keyboard = []
@@ -682,7 +2494,7 @@ async def select_profile(update: Update, context: CallbackContext) -> int:
         return SELECT_ATTRIBUTE
 
     except IndexError:
-        logger.info(f"Error: Malformed callback_data - {query.data}")
+        logger.info("Error: Malformed callback_data - %s", query.data)
 
     return ConversationHandler.END
 
@@ -749,7 +2561,7 @@ async def select_attribute(update: Update, context: CallbackContext) -> int:
             return ENTER_NEW_VALUE
 
     except IndexError:
-        logger.info(f"Error: Malformed callback_data - {query.data}")
+        logger.info("Error: Malformed callback_data - %s", query.data)
 
     return ConversationHandler.END
 
@@ -762,25 +2574,14 @@ async def enter_new_value(update: Update, context: CallbackContext) -> int:
     attribute = context.user_data['edit_attribute']
 
     try:
-        if profile_type == 'agency':
-            async with AsyncSessionLocal() as conn:
-                await conn.execute(
-                    sqlalchemy.text(
-                        f"UPDATE agencies SET {attribute} = :new_value WHERE id = :profile_id"
-                    ),
-                    {'new_value': new_value, 'profile_id': profile_id}
-                )
-                await conn.commit()
-
-        elif profile_type == 'applicant':
-            async with AsyncSessionLocal() as conn:
-                await conn.execute(
-                    sqlalchemy.text(
-                        f"UPDATE applicants SET {attribute} = :new_value WHERE id = :profile_id"
-                    ),
-                    {'new_value': new_value, 'profile_id': profile_id}
-                )
-                await conn.commit()
+        table, attributes = EDITABLE_ATTRIBUTES[profile_type]
+        if attribute not in attributes:
+            raise ValueError(f"{attribute} is not an editable {profile_type} attribute")
+        async with db_connection(commit=True) as conn:
+            await conn.execute(
+                QUERIES[f'{table}.update.{attribute}'],
+                {'new_value': new_value, 'profile_id': profile_id}
+            )
         if update.message:
             await update.message.reply_text('Profile updated successfully!')
         if update.callback_query:
@@ -788,7 +2589,7 @@ async def enter_new_value(update: Update, context: CallbackContext) -> int:
         context.user_data.clear()  # Clear user data after successful update
 
     except Exception as e:
-        logger.info(f"Unexpected error: {str(e)}")
+        logger.info("Unexpected error: %s", e)
         if update.message:
             await update.message.reply_text('An error occurred while updating the profile.')
         if update.callback_query:
@@ -805,14 +2606,8 @@ async def job_repost(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     context.user_data['chat_id'] = chat_id
     # Retrieve agency profiles for the user_handle
-    query_string = """
-    SELECT jp.id AS job_id
-    FROM job_posts jp
-    JOIN agencies a ON jp.agency_id = a.id
-    WHERE jp.status = 'approved' AND a.chat_id = :chat_id
-    """
     params = {"chat_id": chat_id}
-    results = await safe_get_db(query_string, params)
+    results = await safe_get_db(QUERIES['job_posts.approved_by_chat_id'], params)
     previously_posted_jobs = results
     
     # Check for previously posted jobs
@@ -825,25 +2620,12 @@ async def job_repost(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     for job in previously_posted_jobs:
         job_post_id = job[0]
-        query_string = '''
-        SELECT EXISTS (
-        SELECT 1
-        FROM job_posts
-        WHERE id = :job_post_id AND status = 'approved')
-        '''
         params = {"job_post_id": job_post_id}
-        results = await safe_get_db(query_string, params)
+        results = await safe_get_db(QUERIES['job_posts.is_approved'], params)
         repost = results[0][0]
 
         # Check if part time
-        query_string = '''
-        SELECT EXISTS (
-        SELECT 1
-        FROM job_posts
-        WHERE id = :job_post_id AND job_type = 'part')
-        '''
-        params = {"job_post_id": job_post_id}
-        results = await safe_get_db(query_string, params)
+        results = await safe_get_db(QUERIES['job_posts.is_part_time'], params)
         part_time = results[0][0]
         message = await draft_job_post_message(job[0], repost=repost, part_time=part_time)
     
@@ -901,47 +2683,24 @@ async def confirm_job_repost(update, context):
     tokens_to_deduct = JOB_REPOST_PRICE
     query = update.callback_query
     chat_id = context.user_data['chat_id']
-    # Check if got entry in token_balance table
-    query_string = "SELECT EXISTS (SELECT 1 FROM token_balance WHERE chat_id = :chat_id)"
-    params = {"chat_id": chat_id}
-    results = await safe_get_db(query_string, params)
-    have_entry = results[0][0]
-    # There is an entry in the table
-    if have_entry: 
-        # Get balance from chat_id in token_balance table
-        query_string = "SELECT tokens FROM token_balance WHERE chat_id = :chat_id"
-        results = await safe_get_db(query_string, params)
-        token_balance = results[0][0]
-        # Check user's account balance
-        if (token_balance >= tokens_to_deduct): # Sufficient tokens within account
-            new_balance = token_balance - tokens_to_deduct
-            # confirmation_msg = await contex.bot.send_message(chat_id = chat_id, text=f"{action} will cost you {tokens_to_deduct} tokens.\nYou currently have {token_balance} tokens in your account.\n\nWould you like to continue? ")
-            # confirmation_msg_id = confirmation_msg.message_id
-            # Get user confirmation to continue
-
-            # Update new balance in token_balance
-            query_string = "UPDATE token_balance SET tokens = :new_balance WHERE chat_id = :chat_id"
-            params = {"new_balance": new_balance, "chat_id": chat_id}
-            if (await safe_set_db(query_string, params)):
-                # Repost job
-                job_id = context.user_data['repost_job_id']
-                # job_id = await save_jobpost(context.user_data)
-                message = await draft_job_post_message(job_id, repost=True)
-                await forward_to_admin_for_acknowledgement(update, context, message=message, job_post_id = job_id)
-                await query.answer()
-                logger.info(f"{tokens_to_deduct} tokens have been deducted from {chat_id}'s account")
-                await update.callback_query.message.edit_text(
-                    f"Purchase successful!\n\n"
-                    f"You have <b>{new_balance} tokens</b> remaining.",
-                    parse_mode='HTML'
-                )
-                return ConversationHandler.END
-            else:
-                logger.info("Issue with token deduction")
-        else:
-            return ConversationHandler.END
-            # return (False, 0)# Insufficient tokens
+    # Deduct tokens, fails if the balance no longer covers the repost
+    debited, new_balance = await debit_tokens(chat_id, tokens_to_deduct)
+    if debited:
+        # Repost job
+        job_id = context.user_data['repost_job_id']
+        # job_id = await save_jobpost(context.user_data)
+        message = await draft_job_post_message(job_id, repost=True)
+        await forward_to_admin_for_acknowledgement(update, context, message=message, job_post_id = job_id)
+        await query.answer()
+        await update.callback_query.message.edit_text(
+            f"Purchase successful!\n\n"
+            f"You have <b>{new_balance} tokens</b> remaining.",
+            parse_mode='HTML'
+        )
+        return ConversationHandler.END
     else:
+        await query.answer()
+        await update.callback_query.message.edit_text("You do not have sufficient tokens.\nPlease top up via /purchase_tokens command!")
         return ConversationHandler.END
 
 ###########################################################################################################################################################   
@@ -953,14 +2712,8 @@ async def post_a_job_button(update: Update, context: CallbackContext) -> int:
     query = update.callback_query
     chat_id = query.from_user.id
     # Check if user has chat_id in /start
-    query_string = '''
-    SELECT EXISTS (
-    SELECT 1
-    FROM user_data
-    WHERE chat_id = :chat_id)
-    '''
     params = {"chat_id": chat_id}
-    results = await safe_get_db(query_string, params)
+    results = await safe_get_db(QUERIES['user_data.exists'], params)
     previously_used = results[0][0]
     if previously_used:
         await context.bot.send_message(chat_id=chat_id, text="You can use the /jobpost command to create a job posting!\n\nPlease ensure you have an <b>agency</b> profile before doing so.\nYou can create one with the /register command!", parse_mode='HTML')
@@ -995,14 +2748,7 @@ async def job_post(update: Update, context: CallbackContext) -> int:
     # user_handle = update.effective_user.username
     chat_id = update.effective_chat.id
     # Retrieve agency profiles for the user_handle
-    async with AsyncSessionLocal() as conn:
-        # Execute the query and fetch all results
-        results = await conn.execute(
-            sqlalchemy.text(
-               f"SELECT id, name, agency_name FROM agencies WHERE chat_id = '{chat_id}'"
-               )
-        )
-        agency_profiles = results.fetchall()
+    agency_profiles = await safe_get_db(QUERIES['agencies.by_chat_id'], {"chat_id": chat_id})
 
     if not agency_profiles:
         await update.message.reply_text('You have no agency profiles to post a job from.')
@@ -1054,22 +2800,8 @@ async def job_type_selection(update: Update, context: CallbackContext) -> int:
 
 async def check_sufficient_tokens(update, context, chat_id, tokens_to_deduct):
     chat_id = context.user_data['chat_id']
-    # Check if got entry in token_balance table
-    query_string = "SELECT EXISTS (SELECT 1 FROM token_balance WHERE chat_id = :chat_id)"
-    params = {"chat_id": chat_id}
-    results = await safe_get_db(query_string, params)
-    have_entry = results[0][0]
-    # There is an entry in the table
-    if have_entry: 
-        # Get balance from chat_id in token_balance table
-        query_string = "SELECT tokens FROM token_balance WHERE chat_id = :chat_id"
-        results = await safe_get_db(query_string, params)
-        token_balance = results[0][0]
-        # Check user's account balance
-        if (token_balance >= tokens_to_deduct): # Sufficient tokens within account
-            return True
-        else: return False
-    else: return False
+    have_enough, _ = await debit_tokens(chat_id, tokens_to_deduct, check_only=True)
+    return have_enough
 
 async def confirm_job_post(update, context):
     '''
@@ -1085,47 +2817,23 @@ async def confirm_job_post(update, context):
         part_time = False
     query = update.callback_query
     chat_id = context.user_data['chat_id']
-    # Check if got entry in token_balance table
-    query_string = "SELECT EXISTS (SELECT 1 FROM token_balance WHERE chat_id = :chat_id)"
-    params = {"chat_id": chat_id}
-    results = await safe_get_db(query_string, params)
-    have_entry = results[0][0]
-    # There is an entry in the table
-    if have_entry: 
-        # Get balance from chat_id in token_balance table
-        query_string = "SELECT tokens FROM token_balance WHERE chat_id = :chat_id"
-        results = await safe_get_db(query_string, params)
-        token_balance = results[0][0]
-        # Check user's account balance
-        if (token_balance >= tokens_to_deduct): # Sufficient tokens within account
-            new_balance = token_balance - tokens_to_deduct
-            # confirmation_msg = await contex.bot.send_message(chat_id = chat_id, text=f"{action} will cost you {tokens_to_deduct} tokens.\nYou currently have {token_balance} tokens in your account.\n\nWould you like to continue? ")
-            # confirmation_msg_id = confirmation_msg.message_id
-            # Get user confirmation to continue
-
-            # Update new balance in token_balance
-            query_string = "UPDATE token_balance SET tokens = :new_balance WHERE chat_id = :chat_id"
-            params = {"new_balance": new_balance, "chat_id": chat_id}
-            if (await safe_set_db(query_string, params)):
-                job_id = await save_jobpost(context.user_data)
-                message = await draft_job_post_message(job_id, part_time=part_time)
-                await forward_to_admin_for_acknowledgement(update, context, message=message, job_post_id = job_id)
-                await query.answer()
-                logger.info(f"{tokens_to_deduct} tokens have been deducted from {chat_id}'s account")
-                await update.callback_query.message.edit_text(
-                    f"Purchase successful!\n\n"
-                    f"You have <b>{new_balance} tokens</b> remaining.",
-                    parse_mode='HTML'
-                )
-                return ConversationHandler.END
-            else:
-                logger.info("Issue with token deduction")
-        else:
-            return ConversationHandler.END
-            # return (False, 0)# Insufficient tokens
+    # Deduct tokens, fails if the balance no longer covers the job post
+    debited, new_balance = await debit_tokens(chat_id, tokens_to_deduct)
+    if debited:
+        job_id = await save_jobpost(context.user_data)
+        message = await draft_job_post_message(job_id, part_time=part_time)
+        await forward_to_admin_for_acknowledgement(update, context, message=message, job_post_id = job_id)
+        await query.answer()
+        await update.callback_query.message.edit_text(
+            f"Purchase successful!\n\n"
+            f"You have <b>{new_balance} tokens</b> remaining.",
+            parse_mode='HTML'
+        )
+        return ConversationHandler.END
     else:
+        await query.answer()
+        await update.callback_query.message.edit_text("You do not have sufficient tokens.\nPlease top up via /purchase_tokens command!")
         return ConversationHandler.END
-        # return (False, 0) # No entry in token_balance
 async def cancel_job_post(update, context):
     callback_query = update.callback_query
     await callback_query.answer()
@@ -1166,36 +2874,7 @@ async def spend_tokens(update: Update, context: CallbackContext, chat_id, tokens
         bool: True if deduction went through, False otherwise.
         int: Balance of account
     """    
-    # Check if got entry in token_balance table
-    query_string = "SELECT EXISTS (SELECT 1 FROM token_balance WHERE chat_id = :chat_id)"
-    params = {"chat_id": chat_id}
-    results = await safe_get_db(query_string, params)
-    have_entry = results[0][0]
-    # There is an entry in the table
-    if have_entry: 
-        # Get balance from chat_id in token_balance table
-        query_string = "SELECT tokens FROM token_balance WHERE chat_id = :chat_id"
-        results = await safe_get_db(query_string, params)
-        token_balance = results[0][0]
-        # Check user's account balance
-        if (token_balance >= tokens_to_deduct): # Sufficient tokens within account
-            new_balance = token_balance - tokens_to_deduct
-            # confirmation_msg = await contex.bot.send_message(chat_id = chat_id, text=f"{action} will cost you {tokens_to_deduct} tokens.\nYou currently have {token_balance} tokens in your account.\n\nWould you like to continue? ")
-            # confirmation_msg_id = confirmation_msg.message_id
-            # Get user confirmation to continue
-
-            # Update new balance in token_balance
-            query_string = "UPDATE token_balance SET tokens = :new_balance WHERE chat_id = :chat_id"
-            params = {"new_balance": new_balance, "chat_id": chat_id}
-            if (await safe_set_db(query_string, params)):
-                logger.info(f"{tokens_to_deduct} tokens have been deducted from {chat_id}'s account")
-                return (True, new_balance)
-            else:
-                logger.info("Issue with token deduction")
-        else:
-            return (False, 0)# Insufficient tokens
-    else:
-        return (False, 0) # No entry in token_balance
+    return await debit_tokens(chat_id, tokens_to_deduct)
        
 # Callback function to handle job posting details input
 async def jobpost_text_handler(update: Update, context: CallbackContext) -> int:
@@ -1351,12 +3030,10 @@ async def draft_job_post_message(job_id, repost=False, part_time=False) -> str:
         str: Message to be approved by admin
     """    
     # Fetch job details from db
-    query_string = f"SELECT agency_id, job_type, company_name, industry, job_title, date, time, basic_salary, commissions, job_scope, other_req FROM job_posts WHERE id = '{job_id}'"
-    results = await get_db(query_string)
+    results = await safe_get_db(QUERIES['job_posts.details'], {"job_id": job_id})
     agency_id, job_type, company_name, industry, job_title, date, time, basic_salary, commissions, job_scope, other_req= results[0]
     # Fetch agency details from agency_id
-    query_string = f"SELECT user_handle, chat_id, name, agency_name, agency_uen FROM agencies WHERE id = '{agency_id}'"
-    results = await get_db(query_string)
+    results = await safe_get_db(QUERIES['agencies.details'], {"agency_id": agency_id})
     user_handle, chat_id, name, agency_name, agency_uen = results[0]
     # Draft message template
     repost_prefix = "<b>[REPOST]</b>"
@@ -1392,7 +3069,7 @@ async def draft_job_post_message(job_id, repost=False, part_time=False) -> str:
 
 async def post_job_in_channel(update: Update, context: ContextTypes.DEFAULT_TYPE, message, job_post_id):
     """
-    Broadcasts the job in the channel.
+    Broadcasts the job in the channel, through the outbox (see notify()).
     Message will contain a button for applicants to press which opens up a private chat from the bot to choose applicant profile.
     Args:
         update (Update): _description_
@@ -1405,7 +3082,7 @@ async def post_job_in_channel(update: Update, context: ContextTypes.DEFAULT_TYPE
     post_a_job_button = [InlineKeyboardButton("Post a Job", callback_data="post_a_job")]
     keyboard.append(post_a_job_button)
     reply_markup = InlineKeyboardMarkup(keyboard)
-    await context.bot.send_message(chat_id=CHANNEL_ID, text=message, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
+    await notify(CHANNEL_ID, text=message, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
 
 async def apply_button_handler(update: Update, context:ContextTypes.DEFAULT_TYPE):
     """
@@ -1417,7 +3094,7 @@ async def apply_button_handler(update: Update, context:ContextTypes.DEFAULT_TYPE
     if query_data.startswith("apply_"):
         job_post_id = query_data.split('_')[1]
     chat_id = query.from_user.id
-    logger.info(f"Apply button clicked by {chat_id}")
+    logger.info("Apply button clicked by %s", chat_id)
     # Check if job post still exists
     query = '''
     SELECT EXISTS (
@@ -1432,9 +3109,7 @@ async def apply_button_handler(update: Update, context:ContextTypes.DEFAULT_TYPE
         await context.bot.send_message(chat_id=chat_id, text=f"Job does not exist! It could have expired if it was posted more than {JOB_EXPIRY_DAYS} days ago!")
         return
     # Choose applicant profile to apply for job
-    query_string = f'''SELECT id,name FROM applicants WHERE chat_id = "{chat_id}"'''
-    results = await get_db(query_string)
-    applicant_profiles = results
+    applicant_profiles = await safe_get_db(QUERIES['applicants.by_chat_id'], {"chat_id": chat_id})
     keyboard = []
     if not applicant_profiles:
         await context.bot.send_message(chat_id=chat_id, text="You have no applicant profiles to apply for a job.\nYou can create one with the /register command!")
@@ -1481,7 +3156,7 @@ async def select_applicant_apply(update: Update, context:ContextTypes.DEFAULT_TY
         await query.edit_message_text("Sorry, that agency no longer exists")
     else:
         chat_id = results[0][0]
-        await context.bot.send_message(chat_id=chat_id, text=f"An applicant has applied for Job {job_post_id}: {company_name} - {job_title}.\nPlease use the /shortlist command to shortlist applicants")
+        await notify(chat_id, text=f"An applicant has applied for Job {job_post_id}: {company_name} - {job_title}.\nPlease use the /shortlist command to shortlist applicants")
         await query.edit_message_text(text=f"{applicant_name} has successfully applied for Job {job_post_id}: {company_name} - {job_title}!")
 
 
@@ -1524,12 +3199,12 @@ async def save_jobpost(user_data):
 
     # Retrieve the last inserted job_id
     try:
-        async with AsyncSessionLocal() as conn:
-            result = await conn.execute(sqlalchemy.text("SELECT LAST_INSERT_ID()"))
+        async with db_connection() as conn:
+            result = await conn.execute(QUERIES['last_insert_id'])
             job_id = result.scalar_one()
             return job_id
     except Exception as e:
-        logger.error(f"Error retrieving last insert ID: {e}")
+        logger.error("Error retrieving last insert ID: %s", e)
         return None
 
     # async with AsyncSessionLocal() as conn:
@@ -1555,12 +3230,13 @@ async def purchase_shortlists(update: Update, context: CallbackContext) -> int:
     chat_id = update.effective_chat.id
 
     # Retrieve tokens and shortlists balance from the database
-    query_tokens = "SELECT tokens FROM token_balance WHERE chat_id = :chat_id"
-    tokens_result = await safe_get_db(query_tokens, {"chat_id": chat_id})
+    query_tokens = QUERIES['token_balance.tokens']
+    query_shortlists = QUERIES['shortlist_balance.get']
+    tokens_result, shortlists_result = await fetch_many(
+        (query_tokens, {"chat_id": chat_id}),
+        (query_shortlists, {"chat_id": chat_id}),
+    )
     tokens = tokens_result[0][0] if tokens_result else 0
-
-    query_shortlists = "SELECT shortlist FROM shortlist_balance WHERE chat_id = :chat_id"
-    shortlists_result = await safe_get_db(query_shortlists, {"chat_id": chat_id})
     
     # Check if entry for chat_id in shortlist_balance table
     context.user_data['entry_present'] = 1 if shortlists_result else 0
@@ -1616,12 +3292,10 @@ async def handle_amount_choice(update: Update, context: CallbackContext) -> int:
 
     tokens_required = (num_shortlists // 3) * 5
 
-    # Retrieve current tokens balance
-    query_tokens = "SELECT tokens FROM token_balance WHERE chat_id = :chat_id"
-    tokens_result = await safe_get_db(query_tokens, {"chat_id": chat_id})
-    tokens = tokens_result[0][0] if tokens_result else 0
+    # Check current tokens balance
+    have_enough, _ = await debit_tokens(chat_id, tokens_required, check_only=True)
 
-    if tokens < tokens_required:
+    if not have_enough:
         await update.message.reply_text(
             "Insufficient tokens. Please purchase more tokens at /purchase_tokens."
         )
@@ -1661,24 +3335,21 @@ async def confirm_purchase(update: Update, context: CallbackContext) -> int:
         return ConversationHandler.END
 
     # Update the token_balance and shortlist_balance tables
-    update_tokens_query = "UPDATE token_balance SET tokens = tokens - :tokens_required WHERE chat_id = :chat_id"
-    await safe_set_db(update_tokens_query, {"tokens_required": tokens_required, "chat_id": chat_id})
+    debited, updated_tokens = await debit_tokens(chat_id, tokens_required)
+    if not debited:
+        await update.callback_query.message.edit_text("Insufficient tokens. Please purchase more tokens at /purchase_tokens.")
+        return ConversationHandler.END
 
     # If have a chat_id entry in the shortlist_balance table, update value
     if context.user_data['entry_present']:
-        update_shortlists_query = "UPDATE shortlist_balance SET shortlist = shortlist + :new_shortlists WHERE chat_id = :chat_id"
-        await safe_set_db(update_shortlists_query, {"chat_id": chat_id, "new_shortlists": num_shortlists})
+        await safe_set_db(QUERIES['shortlist_balance.add'], {"chat_id": chat_id, "new_shortlists": num_shortlists})
     #Else, create new entry in the shortlist_balance table
     else:
-        insert_shortlists_query = "INSERT INTO shortlist_balance (chat_id, shortlist) VALUES (:chat_id, :new_shortlists)"
-        await safe_set_db(insert_shortlists_query, {"chat_id": chat_id, "new_shortlists": num_shortlists})
+        await safe_set_db(QUERIES['shortlist_balance.insert'], {"chat_id": chat_id, "new_shortlists": num_shortlists})
 
 
-    # Retrieve updated balances
-    updated_tokens_result = await safe_get_db("SELECT tokens FROM token_balance WHERE chat_id = :chat_id", {"chat_id": chat_id})
-    updated_shortlists_result = await safe_get_db("SELECT shortlist FROM shortlist_balance WHERE chat_id = :chat_id", {"chat_id": chat_id})
-
-    updated_tokens = updated_tokens_result[0][0] if updated_tokens_result else 0
+    # Retrieve updated shortlist balance
+    updated_shortlists_result = await safe_get_db(QUERIES['shortlist_balance.get'], {"chat_id": chat_id})
     updated_shortlists = updated_shortlists_result[0][0] if updated_shortlists_result else 0
 
     # Send confirmation message with updated balances
@@ -1695,7 +3366,7 @@ async def confirm_purchase(update: Update, context: CallbackContext) -> int:
 async def shortlist_cancel(update: Update, context: CallbackContext) -> int:
     logger.info("Entered cancel function")
     callback_query = update.callback_query
-    logger.info(f"CALLBACK QUERY: {callback_query}")
+    logger.info("CALLBACK QUERY: %s", callback_query)
     await callback_query.answer()
     await callback_query.message.edit_text("Shortlist purchasing canceled.")
     return ConversationHandler.END
@@ -1852,78 +3523,97 @@ async def select_job(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
     job_title, company_industry = job[0]
 
-    # Update the original message to indicate the selected job
-    await callback_query.message.edit_text(
-        f"You have picked <b>{job_title}</b> - <b>{company_industry}</b>",
-        parse_mode='HTML'
-    )
-
     # Retrieve applicant IDs for the selected job from the job_applications table
     query = "SELECT applicant_id FROM job_applications WHERE job_id = :job_id AND shortlist_status = 'no'"
     applicant_ids = await safe_get_db(query, {"job_id": job_id})
 
     if not applicant_ids:
+        # Update the original message to indicate the selected job
+        await callback_query.message.edit_text(
+            f"You have picked <b>{job_title}</b> - <b>{company_industry}</b>",
+            parse_mode='HTML'
+        )
         await callback_query.message.reply_text("No applicants found for the selected job. Please try again later.")
         return ConversationHandler.END
 
     applicant_ids = [row[0] for row in applicant_ids]
     context.user_data['remaining_applicants'] = applicant_ids # keep track to end convohandler once all applicants are shortlisted
+    context.user_data['selected_job_label'] = f"<b>{job_title}</b> - <b>{company_industry}</b>"
+    context.user_data['applicant_index'] = 0
 
-    # Retrieve applicant details for each applicant_id
-    for i, applicant_id in enumerate(applicant_ids, start=1):
-        query = (
-            "SELECT dob, past_exp, citizenship, race, gender, education,lang_spoken "
-            "FROM applicants WHERE id = :applicant_id"
-        )
-        applicant = await safe_get_db(query, {"applicant_id": applicant_id})
-        if applicant:
-            dob, past_exp, citizenship, race, gender, education, lang_spoken = applicant[0]
-            applicant_details = (
-                f"<b>Applicant {i}</b>\n\n"
-                f"<b>DOB:</b> {dob}\n"
-                f"<b>Languages Spoken:</b> {lang_spoken}\n"
-                f"<b>Past Experiences:</b> {past_exp}\n"
-                f"<b>Citizenship:</b> {citizenship}\n"
-                f"<b>Race:</b> {race}\n"
-                f"<b>Gender:</b> {gender}\n"
-                f"<b>Education:</b> {education}"
-            )
-            keyboard = [
-                [InlineKeyboardButton("Shortlist", callback_data=f"shortlist|{applicant_id}")],
-                [InlineKeyboardButton("Done", callback_data="done")]
-            ]
-
-            # Build keyboard based on shortlist availability. If 0 shortlists, no shortlist button shld be displayed
-            # Initialize reply_markup with default empty state
+    # Retreiving shortlists from db, once for the whole browsing session
+    shortlists = await safe_get_db(QUERIES['shortlist_balance.get'], {"chat_id": context.user_data['chat_id']})
+    context.user_data['shortlists'] = shortlists[0][0] if shortlists else 0
 
-            # Retreiving shortlists from db
-            chat_id = context.user_data['chat_id']
-            query_shortlists = "SELECT shortlist FROM shortlist_balance WHERE chat_id = :chat_id"
-            shortlists = await safe_get_db(query_shortlists, {"chat_id": chat_id})
-            context.user_data['shortlists'] = shortlists[0][0]
+    # Applicants are shown one at a time in the message picking the job, see show_applicant_to_shortlist
+    return await show_applicant_to_shortlist(callback_query, context)
 
+async def edit_browser_message(callback_query, text: str, reply_markup: InlineKeyboardMarkup):
+    """Edits the browser message in place, pressing the button of the card already shown changes nothing"""
+    try:
+        await callback_query.message.edit_text(text, reply_markup=reply_markup, parse_mode='HTML')
+    except telegram.error.BadRequest as e:
+        if "not modified" not in str(e):
+            raise
+
+def browser_navigation(index: int, total: int, callback_prefix: str) -> list:
+    """Previous / position / Next buttons for a browser showing item index of total, callback data is callback_prefix + index"""
+    row = []
+    if index > 0:
+        row.append(InlineKeyboardButton("⬅️ Previous", callback_data=f"{callback_prefix}{index - 1}"))
+    row.append(InlineKeyboardButton(f"{index + 1}/{total}", callback_data=f"{callback_prefix}{index}"))
+    if index < total - 1:
+        row.append(InlineKeyboardButton("Next ➡️", callback_data=f"{callback_prefix}{index + 1}"))
+    return row
+
+async def show_applicant_to_shortlist(callback_query, context: ContextTypes.DEFAULT_TYPE, notice: str = "") -> int:
+    """
+    Shows the applicant at user_data['applicant_index'] of user_data['remaining_applicants'] by editing the browser message,
+    so that going through any number of applicants takes one message and one query per applicant viewed.
+    """
+    applicant_ids = context.user_data.get('remaining_applicants', [])
+    index = max(0, min(context.user_data.get('applicant_index', 0), len(applicant_ids) - 1))
+    context.user_data['applicant_index'] = index
+    applicant_id = applicant_ids[index]
+
+    applicant = await safe_get_db(QUERIES['applicants.card'], {"applicant_id": applicant_id})
+    if applicant:
+        dob, past_exp, citizenship, race, gender, education, lang_spoken = applicant[0]
+        applicant_details = (
+            f"<b>Applicant {index + 1} of {len(applicant_ids)}</b>\n\n"
+            f"<b>DOB:</b> {dob}\n"
+            f"<b>Languages Spoken:</b> {lang_spoken}\n"
+            f"<b>Past Experiences:</b> {past_exp}\n"
+            f"<b>Citizenship:</b> {citizenship}\n"
+            f"<b>Race:</b> {race}\n"
+            f"<b>Gender:</b> {gender}\n"
+            f"<b>Education:</b> {education}"
+        )
+    else:
+        applicant_details = f"<b>Applicant {index + 1} of {len(applicant_ids)}</b>\n\nThis applicant's profile is no longer available."
 
-            keyboard = []
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            shortlists = context.user_data.get('shortlists',0)
-            
-            # Add Shortlist button if shortlists are available
-            if shortlists > 0:
-                keyboard.append([InlineKeyboardButton("Shortlist", callback_data=f"shortlist|{applicant_id}")])
-            else:
-                keyboard.append([InlineKeyboardButton("Shortlist", callback_data="no_shortlists")])
-
-            # Add Done button
-            keyboard.append([InlineKeyboardButton("Done", callback_data="done")])
-
-            # Update reply_markup only if keyboard is not empty
-            if keyboard:
-                reply_markup = InlineKeyboardMarkup(keyboard)
-
-            await callback_query.message.reply_text(applicant_details, reply_markup=reply_markup, parse_mode='HTML')
+    keyboard = [browser_navigation(index, len(applicant_ids), "applicant_")]
+    # If 0 shortlists, the shortlist button leads to purchasing more
+    if context.user_data.get('shortlists', 0) > 0:
+        keyboard.append([InlineKeyboardButton("Shortlist", callback_data=f"shortlist|{applicant_id}")])
+    else:
+        keyboard.append([InlineKeyboardButton("Shortlist", callback_data="no_shortlists")])
+    keyboard.append([InlineKeyboardButton("Done", callback_data="done")])
 
+    await edit_browser_message(
+        callback_query,
+        f"{notice}You have picked {context.user_data.get('selected_job_label', '')}\n\n{applicant_details}",
+        InlineKeyboardMarkup(keyboard),
+    )
     return SHOW_APPLICANTS
 
+# Function to handle the Previous/Next buttons of the applicant browser
+async def browse_applicants(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    callback_query = update.callback_query
+    await callback_query.answer()
+    context.user_data['applicant_index'] = int(callback_query.data.split('_')[1])
+    return await show_applicant_to_shortlist(callback_query, context)
+
 # Function to handle no_shortlists callback and redirect to purchase_shortlists_handler
 async def handle_no_shortlists(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     logger.info("No shortlists available, redirecting to purchase_shortlists")
@@ -1936,12 +3626,13 @@ async def handle_no_shortlists(update: Update, context: ContextTypes.DEFAULT_TYP
     chat_id = update.effective_chat.id
 
     # Retrieve tokens and shortlists balance from the database
-    query_tokens = "SELECT tokens FROM token_balance WHERE chat_id = :chat_id"
-    tokens_result = await safe_get_db(query_tokens, {"chat_id": chat_id})
+    query_tokens = QUERIES['token_balance.tokens']
+    query_shortlists = QUERIES['shortlist_balance.get']
+    tokens_result, shortlists_result = await fetch_many(
+        (query_tokens, {"chat_id": chat_id}),
+        (query_shortlists, {"chat_id": chat_id}),
+    )
     tokens = tokens_result[0][0] if tokens_result else 0
-
-    query_shortlists = "SELECT shortlist FROM shortlist_balance WHERE chat_id = :chat_id"
-    shortlists_result = await safe_get_db(query_shortlists, {"chat_id": chat_id})
     
     # Check if entry for chat_id in shortlist_balance table
     context.user_data['entry_present'] = 1 if shortlists_result else 0
@@ -1997,12 +3688,10 @@ async def handle_amount_choice(update: Update, context: CallbackContext) -> int:
 
     tokens_required = (num_shortlists // 3) * 5
 
-    # Retrieve current tokens balance
-    query_tokens = "SELECT tokens FROM token_balance WHERE chat_id = :chat_id"
-    tokens_result = await safe_get_db(query_tokens, {"chat_id": chat_id})
-    tokens = tokens_result[0][0] if tokens_result else 0
+    # Check current tokens balance
+    have_enough, _ = await debit_tokens(chat_id, tokens_required, check_only=True)
 
-    if tokens < tokens_required:
+    if not have_enough:
         await update.message.reply_text(
             "Insufficient tokens. Please purchase more tokens at /purchase_tokens."
         )
@@ -2042,24 +3731,21 @@ async def confirm_purchase(update: Update, context: CallbackContext) -> int:
         return ConversationHandler.END
 
     # Update the token_balance and shortlist_balance tables
-    update_tokens_query = "UPDATE token_balance SET tokens = tokens - :tokens_required WHERE chat_id = :chat_id"
-    await safe_set_db(update_tokens_query, {"tokens_required": tokens_required, "chat_id": chat_id})
+    debited, updated_tokens = await debit_tokens(chat_id, tokens_required)
+    if not debited:
+        await update.callback_query.message.edit_text("Insufficient tokens. Please purchase more tokens at /purchase_tokens.")
+        return ConversationHandler.END
 
     # If have a chat_id entry in the shortlist_balance table, update value
     if context.user_data['entry_present']:
-        update_shortlists_query = "UPDATE shortlist_balance SET shortlist = shortlist + :new_shortlists WHERE chat_id = :chat_id"
-        await safe_set_db(update_shortlists_query, {"chat_id": chat_id, "new_shortlists": num_shortlists})
+        await safe_set_db(QUERIES['shortlist_balance.add'], {"chat_id": chat_id, "new_shortlists": num_shortlists})
     #Else, create new entry in the shortlist_balance table
     else:
-        insert_shortlists_query = "INSERT INTO shortlist_balance (chat_id, shortlist) VALUES (:chat_id, :new_shortlists)"
-        await safe_set_db(insert_shortlists_query, {"chat_id": chat_id, "new_shortlists": num_shortlists})
-
+        await safe_set_db(QUERIES['shortlist_balance.insert'], {"chat_id": chat_id, "new_shortlists": num_shortlists})
 
-    # Retrieve updated balances
-    updated_tokens_result = await safe_get_db("SELECT tokens FROM token_balance WHERE chat_id = :chat_id", {"chat_id": chat_id})
-    updated_shortlists_result = await safe_get_db("SELECT shortlist FROM shortlist_balance WHERE chat_id = :chat_id", {"chat_id": chat_id})
 
-    updated_tokens = updated_tokens_result[0][0] if updated_tokens_result else 0
+    # Retrieve updated shortlist balance
+    updated_shortlists_result = await safe_get_db(QUERIES['shortlist_balance.get'], {"chat_id": chat_id})
     updated_shortlists = updated_shortlists_result[0][0] if updated_shortlists_result else 0
 
     # Send confirmation message with updated balances
@@ -2076,7 +3762,7 @@ async def confirm_purchase(update: Update, context: CallbackContext) -> int:
 async def shortlist_cancel(update: Update, context: CallbackContext) -> int:
     logger.info("Entered cancel function")
     callback_query = update.callback_query
-    logger.info(f"CALLBACK QUERY: {callback_query}")
+    logger.info("CALLBACK QUERY: %s", callback_query)
     if 'shortlist_message_id' in context.user_data:
         del context.user_data['shortlist_message_id']
     await callback_query.answer()
@@ -2093,9 +3779,10 @@ async def shortlist_applicant(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     # Extract applicant_id from callback data
     _, applicant_id = callback_query.data.split('|')
+    applicant_id = int(applicant_id) # remaining_applicants holds the ids as read from the DB
     job_id = context.user_data.get('selected_job_id')
     chat_id = context.user_data.get('chat_id')  # Ensure chat_id is available
-    logger.info(f"CHAT ID: {chat_id}")
+    logger.info("CHAT ID: %s", chat_id)
 
     if not job_id:
         await callback_query.message.reply_text("No job selected. Please select a job first.")
@@ -2103,21 +3790,15 @@ async def shortlist_applicant(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     # Update the shortlist status for the selected applicant and job
     logger.info("Updating database")
-    query = "UPDATE job_applications SET shortlist_status = 'yes' WHERE job_id = :job_id AND applicant_id = :applicant_id"
-    await safe_set_db(query, {"job_id": job_id, "applicant_id": applicant_id})
+    await safe_set_db(QUERIES['job_applications.shortlist'], {"job_id": job_id, "applicant_id": applicant_id})
 
     # Update the shortlist_balance table
     logger.info("Updating shortlist_balance table")
-    query = """
-        INSERT INTO shortlist_balance (chat_id, shortlist)
-        VALUES (:chat_id, :shortlist)
-        ON DUPLICATE KEY UPDATE shortlist = shortlist - 1
-    """
-    await safe_set_db(query, {"chat_id": chat_id, "shortlist": context.user_data.get('shortlists', 0)})
+    await safe_set_db(QUERIES['shortlist_balance.use'], {"chat_id": chat_id, "shortlist": context.user_data.get('shortlists', 0)})
 
     # Remove the applicant from the list of remaining applicants
     remaining_applicants = context.user_data.get('remaining_applicants', [])
-    logger.info(f'Removing {applicant_id} from {remaining_applicants}')
+    logger.info("Removing %s from %s", applicant_id, remaining_applicants)
     remaining_applicants.remove(applicant_id)
     context.user_data['remaining_applicants'] = remaining_applicants
     
@@ -2134,13 +3815,12 @@ async def shortlist_applicant(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     # Check if there are any remaining applicants to shortlist
     if remaining_applicants:
-        # Provide feedback that the applicant has been shortlisted successfully
-        # remaining_shortlists = context.user_data['shortlists']
-        await callback_query.message.edit_text(
-            f"Applicant has been shortlisted successfully!\n\n"
-            f"You have {remaining_shortlists} shortlists left."
+        # Provide feedback that the applicant has been shortlisted successfully, and show the next one in the same message
+        return await show_applicant_to_shortlist(
+            callback_query,
+            context,
+            notice=f"Applicant has been shortlisted successfully! You have {remaining_shortlists} shortlists left.\n\n",
         )
-        return SHOW_APPLICANTS  # Continue in the SHOW_APPLICANTS state
     # If no more applicants, end the conversation
     else:
         await callback_query.message.edit_text(
@@ -2152,7 +3832,7 @@ async def shortlist_applicant(update: Update, context: ContextTypes.DEFAULT_TYPE
 async def done(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     logger.info("Entered done function")
     callback_query = update.callback_query
-    logger.info(f"CALLBACK QUERY: {callback_query}")
+    logger.info("CALLBACK QUERY: %s", callback_query)
     await callback_query.answer()
 
     # Retrieve the remaining shortlists
@@ -2301,12 +3981,6 @@ async def view_applicants(update: Update, context: CallbackContext) -> int:
 
     job_title, company_industry = job[0]
 
-    # Update the original message to indicate the selected job
-    await callback_query.message.edit_text(
-        f"You have picked <b>{job_title}</b> - <b>{company_industry}</b>",
-        parse_mode='HTML'
-    )
-
     # Retrieve applicant IDs for the selected job
     query_applicants = "SELECT applicant_id FROM job_applications WHERE job_id = :job_id AND shortlist_status = 'yes'"
     applicants_result = await safe_get_db(query_applicants, {"job_id": job_id})
@@ -2316,42 +3990,60 @@ async def view_applicants(update: Update, context: CallbackContext) -> int:
         await callback_query.message.edit_text("You have not shortlisted any applicants.\n You can shortlist candidates at /shortlist.")
         return ConversationHandler.END
 
-    # Send applicant details
-    for i, applicant_id in enumerate(applicant_ids, start=1):
-        query_details = (
-            "SELECT user_handle, name, dob, past_exp, citizenship, race, gender, education, lang_spoken, whatsapp_no "
-            "FROM applicants WHERE id = :applicant_id"
+    # Applicants are shown one at a time in the message listing the jobs, see show_shortlisted_applicant
+    context.user_data['shortlisted_applicants'] = applicant_ids
+    context.user_data['shortlisted_index'] = 0
+    context.user_data['selected_job_label'] = f"<b>{job_title}</b> - <b>{company_industry}</b>"
+    return await show_shortlisted_applicant(callback_query, context)
+
+async def show_shortlisted_applicant(callback_query, context: CallbackContext) -> int:
+    """Shows the applicant at user_data['shortlisted_index'] of user_data['shortlisted_applicants'] by editing the browser message"""
+    applicant_ids = context.user_data.get('shortlisted_applicants', [])
+    index = max(0, min(context.user_data.get('shortlisted_index', 0), len(applicant_ids) - 1))
+    context.user_data['shortlisted_index'] = index
+
+    details_result = await safe_get_db(QUERIES['applicants.contact_card'], {"applicant_id": applicant_ids[index]})
+    if details_result:
+        user_handle, name, dob, past_exp, citizenship, race, gender, education, lang_spoken, wa_number = details_result[0]
+        applicant_details = (
+            f"<b>Applicant {index + 1} of {len(applicant_ids)}</b>\n\n"
+            f"<b>User Handle:</b> @{user_handle}\n"
+            f"<b>Name:</b> {name}\n"
+            f"<b>DOB:</b> {dob}\n"
+            f"<b>Languages Spoken:</b> {lang_spoken}\n"
+            f"<b>Past Experience:</b> {past_exp}\n"
+            f"<b>Citizenship:</b> {citizenship}\n"
+            f"<b>Race:</b> {race}\n"
+            f"<b>Gender:</b> {gender}\n"
+            f"<b>Education:</b>{education}\n"
+            f"<b>WA Number:</b> {wa_number}"
         )
-        details_result = await safe_get_db(query_details, {"applicant_id": applicant_id})
-        if details_result:
-            user_handle, name, dob, past_exp, citizenship, race, gender, education, lang_spoken, wa_number = details_result[0]
-            await callback_query.message.reply_text(
-                f"<b>Applicant {i}</b>\n\n"
-                f"<b>User Handle:</b> @{user_handle}\n"
-                f"<b>Name:</b> {name}\n"
-                f"<b>DOB:</b> {dob}\n"
-                f"<b>Languages Spoken:</b> {lang_spoken}\n"
-                f"<b>Past Experience:</b> {past_exp}\n"
-                f"<b>Citizenship:</b> {citizenship}\n"
-                f"<b>Race:</b> {race}\n"
-                f"<b>Gender:</b> {gender}\n"
-                f"<b>Education:</b>{education}\n"
-                f"<b>WA Number:</b> {wa_number}", parse_mode='HTML'
-            )
-
-    # Add a cancel button
-    await callback_query.message.reply_text("End of the list. If you want to cancel, press the button below.")
-    keyboard = [[InlineKeyboardButton("Cancel", callback_data="cancel_view_shortlisted")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await callback_query.message.reply_text("If you want to cancel, press the button below.", reply_markup=reply_markup)
+    else:
+        applicant_details = f"<b>Applicant {index + 1} of {len(applicant_ids)}</b>\n\nThis applicant's profile is no longer available."
 
+    keyboard = [
+        browser_navigation(index, len(applicant_ids), "shortlisted_"),
+        [InlineKeyboardButton("Cancel", callback_data="cancel_view_shortlisted")],
+    ]
+    await edit_browser_message(
+        callback_query,
+        f"You have picked {context.user_data.get('selected_job_label', '')}\n\n{applicant_details}",
+        InlineKeyboardMarkup(keyboard),
+    )
     return VIEW_JOBS
 
+# Function to handle the Previous/Next buttons of the shortlisted applicant browser
+async def browse_shortlisted(update: Update, context: CallbackContext) -> int:
+    callback_query = update.callback_query
+    await callback_query.answer()
+    context.user_data['shortlisted_index'] = int(callback_query.data.split('_')[1])
+    return await show_shortlisted_applicant(callback_query, context)
+
 # Function to handle cancellation
 async def cancel_view_shortlisted(update: Update, context: CallbackContext) -> int:
     logger.info("Entered cancel_view_shortlisted")
     callback_query = update.callback_query
-    logger.info(f"cancel_view_shortlisted query: {callback_query}")
+    logger.info("cancel_view_shortlisted query: %s", callback_query)
     await callback_query.answer()
     await callback_query.message.edit_text("Viewing shortlisted applicants has been canceled.")
     return ConversationHandler.END
@@ -2389,10 +4081,10 @@ async def view_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
         applicants_query_string = "SELECT id,name, user_handle FROM applicants WHERE chat_id = :chat_id"
         params = {"chat_id": chat_id}
 
-    results = await safe_get_db(agencies_query_string, params)
-    agency_profiles = results
-    results = await safe_get_db(applicants_query_string, params)
-    applicant_profiles = results
+    agency_profiles, applicant_profiles = await fetch_many(
+        (agencies_query_string, params),
+        (applicants_query_string, params),
+    )
 
     keyboard = []
 
@@ -2475,10 +4167,10 @@ async def delete_profile(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         applicants_query_string = "SELECT id,name FROM applicants WHERE chat_id = :chat_id"
         params = {"chat_id": chat_id}
 
-    results = await safe_get_db(agencies_query_string, params)
-    agency_profiles = results
-    results = await safe_get_db(applicants_query_string, params)
-    applicant_profiles = results
+    agency_profiles, applicant_profiles = await fetch_many(
+        (agencies_query_string, params),
+        (applicants_query_string, params),
+    )
 
     # Format profiles as inline buttons
     keyboard = []
@@ -2519,32 +4211,22 @@ async def delete_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         logger.info(profile_name)
             
         if action == 'agency':
-            async with AsyncSessionLocal() as conn:
-                await conn.execute(
-                    sqlalchemy.text(
-                    f"DELETE FROM agencies WHERE id = '{profile_name}'"
-                    )
-                )
-                await conn.commit()
+            async with db_connection(commit=True) as conn:
+                await conn.execute(QUERIES['agencies.delete'], {"id": profile_name})
             
         elif action == 'applicant':
-          async with AsyncSessionLocal() as conn:
-                await conn.execute(
-                    sqlalchemy.text(
-                    f"DELETE FROM applicants WHERE id = '{profile_name}'"
-                    )
-                )
-                await conn.commit()
+            async with db_connection(commit=True) as conn:
+                await conn.execute(QUERIES['applicants.delete'], {"id": profile_name})
 
         await query.edit_message_text("Profile deleted successfully!")
 
     except IndexError:
         # Log the error or handle it as appropriate
-        logger.info(f"Error: Malformed callback_data - {query.data}")
+        logger.info("Error: Malformed callback_data - %s", query.data)
 
     except Exception as e:
         # Log any other unexpected exceptions
-        logger.info(f"Unexpected error: {str(e)}")
+        logger.info("Unexpected error: %s", e)
 
 ###########################################################################################################################################################   
 # Add subscription packages
@@ -2595,6 +4277,7 @@ async def get_price(update: Update, context: CallbackContext) -> int:
             "price": context.user_data['price']
         }
         await safe_set_db(query_string, params)
+        package_catalog.invalidate()
         await update.message.reply_text("Subscription added successfully!")
         context.user_data.clear()
         return ConversationHandler.END
@@ -2671,6 +4354,7 @@ async def validity_input(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             'validity': context.user_data['validity']
         }
         await safe_set_db(query_string, params)
+        package_catalog.invalidate()
 
         await update.message.reply_text("Token package added successfully!")
         return ConversationHandler.END
@@ -2740,6 +4424,7 @@ async def delete_subscription(update: Update, context: CallbackContext) -> int:
         query_string = "DELETE FROM subscription_packages WHERE id = :sub_id"
         params = {"sub_id": sub_id}
         await safe_set_db(query_string, params)
+        package_catalog.invalidate()
 
         await query.edit_message_text("Subscription package deleted successfully!")
 
@@ -2760,12 +4445,8 @@ async def delete_package(update: Update, context: CallbackContext) -> int:
     if (update.effective_chat.id != ADMIN_CHAT_ID):
         return ConversationHandler.END    
     try:
-        async with AsyncSessionLocal() as conn:
-            results = await conn.execute(
-                sqlalchemy.text(
-                    "SELECT package_id, package_name, description FROM token_packages"
-                )
-            )
+        async with db_connection(read_only=True) as conn:
+            results = await conn.execute(QUERIES['token_packages.list'])
             packages = results.fetchall()
 
         if not packages:
@@ -2799,13 +4480,9 @@ async def confirm_delete(update: Update, context: CallbackContext) -> int:
     if user_response == 'yes':
         package_id = context.user_data['package_id']
         try:
-            async with AsyncSessionLocal() as conn:
-                await conn.execute(
-                    sqlalchemy.text(
-                        "DELETE FROM token_packages WHERE package_id = :package_id"
-                    ).params(package_id=package_id)
-                )
-                await conn.commit()
+            async with db_connection(commit=True) as conn:
+                await conn.execute(QUERIES['token_packages.delete'], {"package_id": package_id})
+            package_catalog.invalidate()
 
             await update.message.reply_text("Package deleted successfully!")
         except Exception as e:
@@ -2838,14 +4515,8 @@ async def purchase_tokens(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     Returns:
         int: returns new state for convo handler
     """    
-    # Retrieve token packages from the database
-    async with AsyncSessionLocal() as conn:
-        results = await conn.execute(
-            sqlalchemy.text(
-                "SELECT package_id, package_name, number_of_tokens, price, description, validity FROM token_packages"
-            )
-        )
-        token_packages = results.fetchall()
+    # Retrieve token packages from the catalog
+    token_packages = await package_catalog.get_token_packages()
 
     # Format packages as inline buttons
     keyboard = []
@@ -2902,13 +4573,7 @@ async def purchaseSubscription(update: Update, context: ContextTypes.DEFAULT_TYP
 
     # Retrieve token packages from the database
     context.user_data['chat_id'] = update.effective_chat.id
-    async with AsyncSessionLocal() as conn:
-        results = await conn.execute(
-            sqlalchemy.text(
-                "SELECT subpkg_code, sub_name, number_of_tokens, duration_months, price FROM subscription_packages"
-            )
-        )
-        subscription_packages = results.fetchall()
+    subscription_packages = await package_catalog.get_subscription_packages()
     
 
     # Format packages as inline buttons
@@ -2985,8 +4650,7 @@ async def subscription_selection(update: Update, context: CallbackContext) -> in
         await query.edit_message_text(confirmation_message)
 
         # Send a photo
-        photo_path = "paynow_qrcode.jpg"
-        await query.message.reply_photo(photo=open(photo_path, 'rb'))
+        await media_assets.reply_photo(query.message, PAYNOW_QR_CODE)
         
     # return ConversationHandler.END
     return SUBSCRIPTION_PHOTO_REQUESTED
@@ -3011,12 +4675,8 @@ async def package_selection(update: Update, context: CallbackContext) -> int:
     context.user_data['selected_package_id'] = package_id
 
     # Fetch package details from the database
-    async with AsyncSessionLocal() as conn:
-        results = await conn.execute(
-            sqlalchemy.text(
-                "SELECT package_name, number_of_tokens, price, description FROM token_packages WHERE package_id = :package_id"
-            ).params(package_id=package_id)
-        )
+    async with db_connection(read_only=True) as conn:
+        results = await conn.execute(QUERIES['token_packages.details'], {"package_id": package_id})
         package = results.fetchone()
 
     if package:
@@ -3029,8 +4689,7 @@ async def package_selection(update: Update, context: CallbackContext) -> int:
         await query.edit_message_text(confirmation_message)
 
         # Send a photo
-        photo_path = "paynow_qrcode.jpg"
-        await query.message.reply_photo(photo=open(photo_path, 'rb'))
+        await media_assets.reply_photo(query.message, PAYNOW_QR_CODE)
         
     # return ConversationHandler.END
     return PHOTO_REQUESTED
@@ -3048,14 +4707,12 @@ async def create_transaction_entry(update: Update, context: ContextTypes.DEFAULT
         transaction_id (int): ID of newly created transaction
     """    
     # Create entry in transaction table of DB
-    logger.info(f"LOG: Creating a row in transaction DB table with Chat ID: {chat_id}, Package ID: {package_id}")
-    query_string = f"INSERT INTO transactions (chat_id, package_id) VALUES ('{chat_id}', '{package_id}')"
-    await set_db(query_string)
+    logger.info("LOG: Creating a row in transaction DB table with Chat ID: %s, Package ID: %s", chat_id, package_id)
+    await safe_set_db(QUERIES['transactions.insert'], {"chat_id": chat_id, "package_id": package_id})
     # Get transaction ID of the newly created entry
-    query_string = f"SELECT transaction_id FROM transactions WHERE chat_id = '{chat_id}' ORDER BY transaction_id DESC LIMIT 1"
-    results = await get_db_fetchone(query_string)
-    transaction_id = results[0]
-    logger.info(f"LOG: Transaction created - ID: {transaction_id}")
+    results = await safe_get_db(QUERIES['transactions.latest_id'], {"chat_id": chat_id})
+    transaction_id = results[0][0]
+    logger.info("LOG: Transaction created - ID: %s", transaction_id)
     context.user_data['transaction_id'] = transaction_id
     await update.message.reply_text("Transaction created!")
     return transaction_id
@@ -3107,13 +4764,18 @@ async def forward_to_admin_for_acknowledgement(update: Update, context: ContextT
         job_post_id: 
         id: Transaction ID if payment (image) or Job Posts ID if post (text)
     """    
-    logger.info(f"forward_to_admin_for_acknowledgement() called, forwarding to ADMIN USER {ADMIN_CHAT_ID}")
+    logger.info("forward_to_admin_for_acknowledgement() called, forwarding to ADMIN USER %s", ADMIN_CHAT_ID)
     # Handling token purchase screenshots
     if photo:
         logger.info("Forwarding screenshot to admin for approval")
-        query_string = f"SELECT chat_id, package_id FROM transactions WHERE transaction_id = '{transaction_id}'"
-        results = await get_db(query_string)
-        logger.info(f"Results: {results}")
+        # The transaction, user handle and package details are independent reads, fetch them in one go
+        params = {"transaction_id": transaction_id}
+        results, user_results, sub_results, package_results = await fetch_many(
+            (QUERIES['transactions.details'], params),
+            (QUERIES['user_data.by_transaction'], params),
+            (QUERIES['transactions.subscription_package'], params),
+            (QUERIES['transactions.token_package'], params),
+        )
         chat_id, package_id = results[0] # unpack tuple
         if 's' in package_id:
             isSubscription = True
@@ -3122,38 +4784,30 @@ async def forward_to_admin_for_acknowledgement(update: Update, context: ContextT
         # Set callback data from ID provided
         ss_accept_callback_data = f"ss_accept_{transaction_id}" # Callbackdata has fixed format: ss_<transaction_ID> (screenshot) or jp_<transaction_ID> (job post)
         ss_reject_callback_data = f"ss_reject_{transaction_id}"
-        logger.info(f"Callback data: {ss_accept_callback_data}, {ss_reject_callback_data}")
+        logger.info("Callback data: %s, %s", ss_accept_callback_data, ss_reject_callback_data)
         keyboard = [
             [InlineKeyboardButton("Approve", callback_data=ss_accept_callback_data)],
             [InlineKeyboardButton("Reject", callback_data=ss_reject_callback_data)]
         ] # Can check transaction ID if need details
         reply_markup = InlineKeyboardMarkup(keyboard)
         # Get user handle from chat id
-        query_string = "SELECT user_handle FROM user_data WHERE chat_id = :chat_id"
-        params = {"chat_id": chat_id}
-        results = await safe_get_db(query_string, params)
         # user_handle = results[0][0]
         # user_handle = results[0][0]
-        if not results: # from group chat idk?
+        if not user_results: # from group chat idk?
             logger.info("results are empty")
             user_handle = chat_id
         else:
-            user_handle = results[0][0]
+            user_handle = user_results[0][0]
         if isSubscription:
             # Get sub package details
-            query_string = "SELECT sub_name, number_of_tokens, duration_months, price FROM subscription_packages WHERE subpkg_code = :subpkg_code"
-            params = {"subpkg_code": package_id}
-            results = await safe_get_db(query_string, params)
-            sub_name, tokens_per_month, duration_months, price = results[0]
+            sub_name, tokens_per_month, duration_months, price = sub_results[0]
             caption = f"Dear Admin, {user_handle} wants to purchase the Subscription Package: {sub_name} for ${price}\nThey will be allocated {tokens_per_month} tokens for {duration_months} months."
         else:
-            query_string = "SELECT package_name, number_of_tokens, price, validity FROM token_packages WHERE package_id = :package_id"
-            params = {"package_id": package_id}
-            results = await safe_get_db(query_string, params)
-            package_name, number_of_tokens, price, validity = results[0]
+            package_name, number_of_tokens, price, validity = package_results[0]
             caption = f"Dear Admin, {user_handle} wants to purchase the Subscription Package: {package_name} for ${price}"
-        await context.bot.send_photo(
-            chat_id=ADMIN_CHAT_ID,
+        await notify(
+            ADMIN_CHAT_ID,
+            method="send_photo",
             photo=photo,
             caption=caption,
             reply_markup=reply_markup
@@ -3173,9 +4827,9 @@ async def forward_to_admin_for_acknowledgement(update: Update, context: ContextT
             [InlineKeyboardButton("Reject", callback_data=jp_reject_callback_data)]
         ] # Can check transaction ID if need details
         reply_markup = InlineKeyboardMarkup(keyboard)
-        await context.bot.send_message(chat_id=ADMIN_CHAT_ID, text="There is a new job posting pending your approval:")
-        await context.bot.send_message(
-            chat_id=ADMIN_CHAT_ID,
+        await notify(ADMIN_CHAT_ID, text="There is a new job posting pending your approval:")
+        await notify(
+            ADMIN_CHAT_ID,
             text=message,
             reply_markup=reply_markup,
             parse_mode=ParseMode.HTML
@@ -3212,7 +4866,7 @@ async def get_admin_acknowledgement(update: Update, context: ContextTypes.DEFAUL
     # Get callback query data (e.g. ss_accept_<ID>)
     logger.info("Approve/Reject button pressed")
     query = update.callback_query
-    logger.info(f'Callback query data: {query.data}')
+    logger.info("Callback query data: %s", query.data)
     query_data = query.data
     # Check which query data it is (which button admin pressed)
     # if query_data.startswith('sp_'):
@@ -3225,10 +4879,12 @@ async def get_admin_acknowledgement(update: Update, context: ContextTypes.DEFAUL
         logger.info("SS query found")
         # Getting admin response as well as transaction ID
         status, transaction_id = query_data.split('_')[1:]
-        # Select chat_id based on transaction_id
-        query_string = f"SELECT chat_id, package_id FROM transactions WHERE transaction_id = '{transaction_id}'"
-        results = await get_db(query_string)
-        logger.info(f"Results: {results}")
+        # Select chat_id based on transaction_id, and check for an active subscription of that chat_id at the same time
+        params = {"transaction_id": transaction_id}
+        results, subscribed_results = await fetch_many(
+            (QUERIES['transactions.details'], params),
+            (QUERIES['subscription_balance.has_active_by_transaction'], params),
+        )
         chat_id, package_id = results[0]
         if 's' in package_id:
             isSubscription = True
@@ -3241,9 +4897,8 @@ async def get_admin_acknowledgement(update: Update, context: ContextTypes.DEFAUL
 
         if status == 'accept':
             # Update transaction entry status to 'Approved'
-            query_string = f"UPDATE transactions SET status = 'Approved' WHERE transaction_id = '{transaction_id}'"
-            await set_db(query_string)
-            logger.info(f"Approved {transaction_id} in database!")
+            await safe_set_db(QUERIES['transactions.set_status'], {"status": "Approved", "transaction_id": transaction_id})
+            logger.info("Approved %s in database!", transaction_id)
             if not isSubscription:
                 # Update balance of user account
                 (new_balance, exp_date) = await update_balance(chat_id=chat_id, package_id=package_id)
@@ -3253,19 +4908,11 @@ async def get_admin_acknowledgement(update: Update, context: ContextTypes.DEFAUL
                 # Check if has existing subs
                 # chat_id = update.effective_chat.id
                 # Check if chat_id is already in an active subscription plan
-                query_string = '''
-                SELECT EXISTS (
-                SELECT 1
-                FROM subscription_balance
-                WHERE chat_id = :chat_id AND status = 'active')
-                '''
-                params = {"chat_id": chat_id}
-                results = await safe_get_db(query_string, params)
-                already_subscribed = results[0][0]
+                already_subscribed = subscribed_results[0][0]
                 if already_subscribed:
                     await add_active_subscription(chat_id, package_id)
                     await query.edit_message_caption(caption="You have approved the payment.\n\nCredits have been transferred.")
-                    await context.bot.send_message(chat_id=chat_id, text="Your payment has been acknowledged by an admin!")
+                    await notify(chat_id, text="Your payment has been acknowledged by an admin!")
                     return
 
                 else:
@@ -3277,13 +4924,12 @@ async def get_admin_acknowledgement(update: Update, context: ContextTypes.DEFAUL
             await query.edit_message_caption(caption="You have approved the payment.\n\nCredits have been transferred.")
             
             # Notify the user
-            await context.bot.send_message(chat_id=chat_id, text=f"Your payment has been acknowledged by an admin!.\n\nYour new token balance is: {new_balance}\nExpiring on: {exp_date}")
+            await notify(chat_id, text=f"Your payment has been acknowledged by an admin!.\n\nYour new token balance is: {new_balance}\nExpiring on: {exp_date}")
         
         elif status == 'reject':
             # Update transaction entry status to 'Rejected'
-            query_string = f"UPDATE transactions SET status = 'rejected' WHERE transaction_id = '{transaction_id}'"
-            await set_db(query_string)
-            logger.info(f"Rejected {transaction_id} in database!")
+            await safe_set_db(QUERIES['transactions.set_status'], {"status": "rejected", "transaction_id": transaction_id})
+            logger.info("Rejected %s in database!", transaction_id)
             await query.answer()  # Acknowledge the callback query to remove the loading state
 
             
@@ -3291,68 +4937,45 @@ async def get_admin_acknowledgement(update: Update, context: ContextTypes.DEFAUL
             await query.edit_message_caption(caption="You have rejected the screenshot.\n\nUser will be notified")
             
             # Notify the user
-            await context.bot.send_message(chat_id=chat_id, text="Your payment has been rejected by an admin. Please PM @jojoweipop for more details")
+            await notify(chat_id, text="Your payment has been rejected by an admin. Please PM @jojoweipop for more details")
 
     elif query_data.startswith('jp_'): 
         logger.info("JP query found")
         # Getting admin response as well as job ID
         status, job_post_id = query_data.split('_')[1:]
-        # Check if repost
-        repost = False
-        query_string = '''
-        SELECT EXISTS (
-        SELECT 1
-        FROM job_posts
-        WHERE id = :job_post_id AND status = 'approved')
-        '''
-        params = {"job_post_id": job_post_id}
-        results = await safe_get_db(query_string, params)
-        repost = results[0][0]
-
-        # Check if part time
-        query_string = '''
-        SELECT EXISTS (
-        SELECT 1
-        FROM job_posts
-        WHERE id = :job_post_id AND job_type = 'part')
-        '''
+        # Check if repost, if part time, and get the agency's chat id based on job id
         params = {"job_post_id": job_post_id}
-        results = await safe_get_db(query_string, params)
-        part_time = results[0][0]
-        # Get agency id based on job id
-        query_string = f"SELECT agency_id FROM job_posts WHERE id = '{job_post_id}'"
-        results = await get_db(query_string)
-        agency_id = results[0][0]
-        # Get chat id from agency id 
-        query_string = f"SELECT chat_id FROM agencies WHERE id = '{agency_id}'"
-        results = await get_db(query_string)
+        repost_results, part_time_results, results = await fetch_many(
+            (QUERIES['job_posts.is_approved'], params),
+            (QUERIES['job_posts.is_part_time'], params),
+            (QUERIES['job_posts.agency_chat_id'], params),
+        )
+        repost = repost_results[0][0]
+        part_time = part_time_results[0][0]
         chat_id = results[0][0]
 
 
         if status == 'accept':
             if not repost: # if not repost
                 # Update job post status to 'Approved'
-                query_string = f"UPDATE job_posts SET status = 'Approved' WHERE id = '{job_post_id}'"
-                await set_db(query_string)
-                logger.info(f"Approved {job_post_id} in database!")
+                await safe_set_db(QUERIES['job_posts.set_status'], {"status": "Approved", "job_post_id": job_post_id})
+                logger.info("Approved %s in database!", job_post_id)
             # Post to channel
             message = await draft_job_post_message(job_post_id, repost=repost, part_time=part_time)
             await post_job_in_channel(update, context, message=message, job_post_id=job_post_id)
             # Add 3 shortlist to user chat_id
             num_shortlists = 3
-            query_shortlists = "SELECT shortlist FROM shortlist_balance WHERE chat_id = :chat_id"
+            query_shortlists = QUERIES['shortlist_balance.get']
             shortlists_result = await safe_get_db(query_shortlists, {"chat_id": chat_id})
                 
             # Check if entry for chat_id in shortlist_balance table
             context.user_data['entry_present'] = 1 if shortlists_result else 0
             # If have a chat_id entry in the shortlist_balance table, update value
             if context.user_data['entry_present']:
-                update_shortlists_query = "UPDATE shortlist_balance SET shortlist = shortlist + :new_shortlists WHERE chat_id = :chat_id"
-                await safe_set_db(update_shortlists_query, {"chat_id": chat_id, "new_shortlists": num_shortlists})
+                await safe_set_db(QUERIES['shortlist_balance.add'], {"chat_id": chat_id, "new_shortlists": num_shortlists})
             #Else, create new entry in the shortlist_balance table
             else:
-                insert_shortlists_query = "INSERT INTO shortlist_balance (chat_id, shortlist) VALUES (:chat_id, :new_shortlists)"
-                await safe_set_db(insert_shortlists_query, {"chat_id": chat_id, "new_shortlists": num_shortlists})
+                await safe_set_db(QUERIES['shortlist_balance.insert'], {"chat_id": chat_id, "new_shortlists": num_shortlists})
 
             # Alert user of approval
             await query.answer()  # Acknowledge the callback query to remove the loading state
@@ -3361,7 +4984,7 @@ async def get_admin_acknowledgement(update: Update, context: ContextTypes.DEFAUL
             await query.edit_message_text(text="You have approved this Job Posting.\n\nAgency will be notifed.")
             
             # Notify the user
-            await context.bot.send_message(chat_id=chat_id, text=f"Your posting has been approved by the admin!.\n\nIt has been posted in the channel with Job ID: {job_post_id}")
+            await notify(chat_id, text=f"Your posting has been approved by the admin!.\n\nIt has been posted in the channel with Job ID: {job_post_id}")
         
         elif status == 'reject':
 
@@ -3372,29 +4995,15 @@ async def get_admin_acknowledgement(update: Update, context: ContextTypes.DEFAUL
                 else:
                     tokens_to_deduct = JOB_POST_PRICE
                 # Update job post status to 'Rejected'
-                query_string = f"UPDATE job_posts SET status = 'Rejected' WHERE id = '{job_post_id}'"
-                await set_db(query_string)
-                logger.info(f"Rejected {job_post_id} in database!")
+                await safe_set_db(QUERIES['job_posts.set_status'], {"status": "Rejected", "job_post_id": job_post_id})
+                logger.info("Rejected %s in database!", job_post_id)
             if repost:
                 tokens_to_deduct = JOB_REPOST_PRICE
 
-            # Give user back credits
-            query_string = "SELECT EXISTS (SELECT 1 FROM token_balance WHERE chat_id = :chat_id)"
-            params = {"chat_id": chat_id}
-            results = await safe_get_db(query_string, params)
-            have_entry = results[0][0]
-            # There is an entry in the table
-            logger.info(f"HAVE ENTRY: {have_entry}")
-            if have_entry: 
-                logger.info("entry exists in table")
-                # Give back credits
-                query_string = "UPDATE token_balance SET tokens = tokens + :price_of_job_post WHERE chat_id = :chat_id"
-                params = {
-                    "price_of_job_post": tokens_to_deduct,
-                    "chat_id": chat_id
-                }
-                await safe_set_db(query_string, params)
-            else: # Dont refund if it would have expired
+            # Give user back credits, only updates an existing balance
+            async with db_connection(commit=True) as conn:
+                refunded = (await conn.execute(QUERIES['token_balance.refund'], {"tokens": tokens_to_deduct, "chat_id": chat_id})).rowcount
+            if not refunded: # Dont refund if it would have expired
                 logger.info("CREDITS EXPIRED, NO REFUND")
 
             await query.answer()  # Acknowledge the callback query to remove the loading state
@@ -3411,7 +5020,7 @@ async def get_admin_acknowledgement(update: Update, context: ContextTypes.DEFAUL
                 text = "Your repost has been rejected by an admin. Please PM @jojoweipop for more details"
             else:
                 text = "Your posting has been rejected by an admin. Please PM @jojoweipop for more details"
-            await context.bot.send_message(chat_id=chat_id, text=text)
+            await notify(chat_id, text=text)
 
 async def add_active_subscription(chat_id, package_id):
     '''
@@ -3423,9 +5032,7 @@ async def add_active_subscription(chat_id, package_id):
     else:
         raise Exception("Package is not a subscription")
     # Get subs package details
-    query_string = "SELECT sub_name, number_of_tokens, duration_months, price FROM subscription_packages WHERE subpkg_code = :package_id"
-    params = {"package_id": package_id}
-    results = await safe_get_db(query_string, params)
+    results = await safe_get_db(QUERIES['subscription_packages.details'], {"package_id": package_id})
     package_details = results[0]
     sub_name, tokens_per_month, duration_months, price = package_details
     curr_date = datetime.now().date()
@@ -3477,46 +5084,12 @@ async def update_balance_subscription(chat_id, package_id):
     else:
         raise Exception("Package is not a subscription")
     # Get subs package details
-    query_string = "SELECT sub_name, number_of_tokens, duration_months, price FROM subscription_packages WHERE subpkg_code = :package_id"
-    params = {"package_id": package_id}
-    results = await safe_get_db(query_string, params)
+    results = await safe_get_db(QUERIES['subscription_packages.details'], {"package_id": package_id})
     package_details = results[0]
     sub_name, tokens_per_month, duration_months, price = package_details
     # Give one month of tokens first, with expiry being one month as well
-
-    # Check if user chat_id has row in token_balance table for db
-    query_string = f"SELECT EXISTS (SELECT 1 FROM token_balance WHERE chat_id = '{chat_id}')"
-    results = await get_db(query_string)
-    # Calculate new expiry date
-    curr_date = datetime.now()
-    new_date = curr_date + relativedelta(months=1) #! hardcoded package expiry to be each month
-    # If have existing entry
-    logger.info(f"Chat ID is already in token_balance table: {results}")
-    if (results[0][0]):
-        # Get balance and current expiry date of tokens
-        query_string = f"SELECT tokens, exp_date FROM token_balance WHERE chat_id = '{chat_id}'"
-        results = await get_db(query_string)
-        curr_tokens, curr_exp_date = results[0]
-        # Calculate new tokens
-        new_balance = curr_tokens + tokens_per_month
-        # If extended date is longer than current exp date, updates both token balance and exp date of chat_id
-        if new_date > curr_exp_date:
-            query_string = f"UPDATE token_balance SET tokens = '{new_balance}', exp_date = '{new_date}' WHERE chat_id = '{chat_id}'"
-
-        # Otherwise, dont touch exp date
-        else:
-            query_string = f"UPDATE token_balance SET tokens = '{new_balance}' WHERE chat_id = '{chat_id}'"
-            new_date = curr_exp_date # Just for returning the expiry date, new_date is not used here
-        # Update db
-        await set_db(query_string)
-        return new_balance, new_date
-    # If no existing entry, create new entry
-    else: 
-        # Create new entry
-        query_string = f"INSERT INTO token_balance (chat_id, tokens, exp_date) VALUES ('{chat_id}', '{tokens_per_month}', '{new_date}')"
-        await set_db(query_string)
-        logger.info("Chat ID does not exist in token_balance table")
-        return tokens_per_month, new_date
+    new_date = datetime.now() + relativedelta(months=1) #! hardcoded package expiry to be each month
+    return await credit_tokens(chat_id, tokens_per_month, new_date)
 
 async def update_balance(chat_id, package_id):
     """
@@ -3526,47 +5099,201 @@ async def update_balance(chat_id, package_id):
     """
 
     # Check number of tokens and validity of purchased package, validity is in days
-    query_string = f"SELECT number_of_tokens,validity FROM token_packages WHERE package_id = '{package_id}'"
-    results = await get_db(query_string)
+    results = await safe_get_db(QUERIES['token_packages.allocation'], {"package_id": package_id})
     package_tokens, validity = results[0]
-    # Check if user chat_id has row in token_balance table for db
-    query_string = f"SELECT EXISTS (SELECT 1 FROM token_balance WHERE chat_id = '{chat_id}')"
-    results = await get_db(query_string)
     # Calculate new expiry date
-    curr_date = datetime.now()
-    new_date = curr_date + timedelta(days=validity)
-    # If have existing entry
-    logger.info(f"Chat ID is already in token_balance table: {results}")
-    if (results[0][0]):
-        # Get balance and current expiry date of tokens
-        query_string = f"SELECT tokens, exp_date FROM token_balance WHERE chat_id = '{chat_id}'"
-        results = await get_db(query_string)
-        curr_tokens, curr_exp_date = results[0]
-        # Calculate new tokens
-        new_balance = curr_tokens + package_tokens
-        # If extended date is longer than current exp date, updates both token balance and exp date of chat_id
-        if new_date > curr_exp_date:
-            query_string = f"UPDATE token_balance SET tokens = '{new_balance}', exp_date = '{new_date}' WHERE chat_id = '{chat_id}'"
+    new_date = datetime.now() + timedelta(days=validity)
+    return await credit_tokens(chat_id, package_tokens, new_date)
+
 
-        # Otherwise, dont touch exp date
-        else:
-            query_string = f"UPDATE token_balance SET tokens = '{new_balance}' WHERE chat_id = '{chat_id}'"
-            new_date = curr_exp_date # Just for returning the expiry date, new_date is not used here
-        # Update db
-        await set_db(query_string)
-        return new_balance, new_date
-    # If no existing entry, create new entry
-    else: 
-        # Create new entry
-        query_string = f"INSERT INTO token_balance (chat_id, tokens, exp_date) VALUES ('{chat_id}', '{package_tokens}', '{new_date}')"
-        await set_db(query_string)
-        logger.info("Chat ID does not exist in token_balance table")
-        return package_tokens, new_date
 
 
 
 
+###########################################################################################################################################################
+# Pending approvals
+# /pending shows the admin every pending job post and payment in one paginated message. Items can be ticked and approved or
+# rejected together: the status changes, shortlist grants, refunds, token allocations, channel posts and user notices of
+# a batch are one transaction, the posts and notices going out through the outbox once it has committed.
+
+def pending_view(state: dict, notice: str = "") -> tuple:
+    """Text and keyboard of the /pending message for state (user_data['pending'])"""
+    items = state['items']
+    pages = max(1, -(-len(items) // PENDING_PAGE_SIZE))
+    state['page'] = page = max(0, min(state['page'], pages - 1))
+    visible = items[page * PENDING_PAGE_SIZE:(page + 1) * PENDING_PAGE_SIZE]
+    selected = state['selected']
+
+    lines = [notice, ""] if notice else []
+    if not items:
+        lines.append("There is nothing pending your approval.")
+        return "\n".join(lines), InlineKeyboardMarkup([[InlineKeyboardButton("Refresh", callback_data="pending_refresh")]])
+    lines.append(f"<b>Pending approval: {len(items)}</b> ({len(selected)} selected)\n")
+    lines += [f"{'☑️' if key in selected else '⬜'} {label}" for key, label in visible]
+
+    keyboard = []
+    for key, label in visible:
+        kind, item_id = key.split('_')
+        keyboard.append([InlineKeyboardButton(
+            f"{'☑️' if key in selected else '⬜'} {'Job' if kind == 'jp' else 'Payment'} #{item_id}",
+            callback_data=f"pending_toggle_{key}",
+        )])
+    if pages > 1:
+        keyboard.append(browser_navigation(page, pages, "pending_page_"))
+    keyboard.append([InlineKeyboardButton("Approve all visible", callback_data="pending_approve_visible")])
+    if selected:
+        keyboard.append([
+            InlineKeyboardButton(f"Approve selected ({len(selected)})", callback_data="pending_approve_selected"),
+            InlineKeyboardButton(f"Reject selected ({len(selected)})", callback_data="pending_reject_selected"),
+        ])
+    keyboard.append([InlineKeyboardButton("Refresh", callback_data="pending_refresh")])
+    return "\n".join(lines), InlineKeyboardMarkup(keyboard)
+
+async def load_pending(state: dict, primary: bool = False):
+    """
+    Reloads the pending payments and job posts into state, dropping selections of items that are no longer pending.
+    primary reads them from the primary, so that decisions just committed are not shown as pending by a lagging replica.
+    """
+    payments, job_posts = await fetch_many((QUERIES['transactions.pending'], {}), (QUERIES['job_posts.pending'], {}), primary=primary)
+    items = [
+        (f"ss_{transaction_id}", f"Payment #{transaction_id}: {html.escape(str(user_handle))} bought {html.escape(str(package_name))} for ${price}")
+        for transaction_id, user_handle, package_name, price in payments
+    ] + [
+        (f"jp_{job_post_id}", f"Job #{job_post_id}: {html.escape(str(job_title))} at {html.escape(str(company_name))} by {html.escape(str(agency_name))}"
+                              f"{' (part time)' if job_type == 'part' else ''}")
+        for job_post_id, job_title, company_name, job_type, agency_name in job_posts
+    ]
+    state['items'] = items
+    state['selected'] &= {key for key, _ in items}
+
+async def pending(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin command showing the pending approval queue"""
+    if update.effective_chat.id != ADMIN_CHAT_ID:
+        return
+    state = context.user_data['pending'] = {"items": [], "page": 0, "selected": set()}
+    await load_pending(state)
+    text, reply_markup = pending_view(state)
+    await update.message.reply_text(text, reply_markup=reply_markup, parse_mode='HTML')
+
+async def pending_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    CallbackHandler for the buttons of the /pending message.
+    Callbackdata is pending_page_<page>, pending_toggle_<ss|jp>_<ID>, pending_refresh,
+    pending_approve_visible, pending_approve_selected or pending_reject_selected
+    """
+    query = update.callback_query
+    if update.effective_chat.id != ADMIN_CHAT_ID:
+        await query.answer()
+        return
+    state = context.user_data.get('pending')
+    if state is None: # Buttons of a /pending message from before a restart
+        state = context.user_data['pending'] = {"items": [], "page": 0, "selected": set()}
+        await load_pending(state)
+    action = query.data[len("pending_"):]
+    notice = ""
+    if action.startswith("page_"):
+        state['page'] = int(action[len("page_"):])
+        await query.answer()
+    elif action.startswith("toggle_"):
+        state['selected'] ^= {action[len("toggle_"):]}
+        await query.answer()
+    elif action == "refresh":
+        await load_pending(state)
+        await query.answer()
+    else:
+        decision, scope = action.split('_')
+        approve = decision == "approve"
+        if scope == "visible":
+            keys = [key for key, _ in state['items'][state['page'] * PENDING_PAGE_SIZE:(state['page'] + 1) * PENDING_PAGE_SIZE]]
+        else:
+            keys = [key for key, _ in state['items'] if key in state['selected']]
+        if not keys:
+            await query.answer("Nothing to do.")
+            return
+        await query.answer("Working on it...")
+        try:
+            handled = await decide_pending(context, keys, approve)
+            notice = f"{'Approved' if approve else 'Rejected'} {handled} of {len(keys)}."
+            if handled < len(keys):
+                notice += " The rest had already been handled."
+        except Exception:
+            logger.exception("Could not %s pending items %s", decision, keys)
+            notice = f"Could not {decision} them, nothing was changed."
+        state['selected'] -= set(keys)
+        await load_pending(state, primary=True)
+    text, reply_markup = pending_view(state, notice)
+    await edit_browser_message(query, text, reply_markup)
+
+async def allocate_purchase(chat_id, package_id) -> str:
+    """Allocates an approved token or subscription package purchase the way get_admin_acknowledgement does, returns the notice for the buyer"""
+    if 's' not in package_id:
+        new_balance, exp_date = await update_balance(chat_id=chat_id, package_id=package_id)
+    else:
+        results = await safe_get_db(QUERIES['subscription_balance.has_active'], {"chat_id": chat_id})
+        if results[0][0]: # Stacks after the current subscription, whose tokens are still being allocated
+            await add_active_subscription(chat_id, package_id)
+            return "Your payment has been acknowledged by an admin!"
+        new_balance, exp_date = await update_balance_subscription(chat_id, package_id)
+        await add_active_subscription(chat_id, package_id)
+    return f"Your payment has been acknowledged by an admin!.\n\nYour new token balance is: {new_balance}\nExpiring on: {exp_date.date()}"
+
+async def decide_pending(context: ContextTypes.DEFAULT_TYPE, keys: list, approve: bool) -> int:
+    """
+    Approves or rejects the pending payments (ss_<ID>) and job posts (jp_<ID>) in keys with the side effects of get_admin_acknowledgement.
+    Items are locked while their status is still pending, so an item approved or rejected elsewhere in the meantime is left alone.
+    All DB changes, and the channel posts and notices queued in the outbox, are made in a savepoint of the update's unit of work:
+    they are committed together with it, or not at all if this raises.
 
+    Returns:
+        int: Number of items handled
+    """
+    transaction_ids = tuple(int(key[3:]) for key in keys if key.startswith("ss_"))
+    job_post_ids = tuple(int(key[3:]) for key in keys if key.startswith("jp_"))
+    async with savepoint():
+        async with db_connection(commit=True) as conn:
+            payments = (await conn.execute(QUERIES['transactions.lock_pending'], {"transaction_ids": transaction_ids})).all() if transaction_ids else []
+            job_posts = (await conn.execute(QUERIES['job_posts.lock_pending'], {"job_post_ids": job_post_ids})).all() if job_post_ids else []
+            if payments:
+                await conn.execute(QUERIES['transactions.set_status'], [
+                    {"status": "Approved" if approve else "rejected", "transaction_id": transaction_id} for transaction_id, _, _ in payments
+                ])
+            if job_posts:
+                await conn.execute(QUERIES['job_posts.set_status'], [
+                    {"status": "Approved" if approve else "Rejected", "job_post_id": job_post_id} for job_post_id, _, _ in job_posts
+                ])
+            if job_posts and approve:
+                # Add 3 shortlists per approved post to the agency
+                shortlists = collections.Counter()
+                for _, _, chat_id in job_posts:
+                    shortlists[chat_id] += 3
+                existing = {row[0] for row in await conn.execute(QUERIES['shortlist_balance.existing'], {"chat_ids": tuple(shortlists)})}
+                if existing:
+                    await conn.execute(QUERIES['shortlist_balance.add'], [{"chat_id": chat_id, "new_shortlists": shortlists[chat_id]} for chat_id in existing])
+                if existing != set(shortlists):
+                    await conn.execute(QUERIES['shortlist_balance.insert'], [
+                        {"chat_id": chat_id, "new_shortlists": count} for chat_id, count in shortlists.items() if chat_id not in existing
+                    ])
+            elif job_posts:
+                # Give agencies back their tokens, only updates an existing balance
+                refunds = collections.Counter()
+                for _, job_type, chat_id in job_posts:
+                    refunds[chat_id] += PART_JOB_POST_PRICE if job_type == 'part' else JOB_POST_PRICE
+                await conn.execute(QUERIES['token_balance.refund'], [{"tokens": tokens, "chat_id": chat_id} for chat_id, tokens in refunds.items()])
+
+        for transaction_id, chat_id, package_id in payments:
+            if approve:
+                await notify(chat_id, text=await allocate_purchase(chat_id, package_id))
+            else:
+                await notify(chat_id, text="Your payment has been rejected by an admin. Please PM @jojoweipop for more details")
+        for job_post_id, job_type, chat_id in job_posts:
+            if approve:
+                message = await draft_job_post_message(job_post_id, part_time=job_type == 'part')
+                await post_job_in_channel(None, context, message=message, job_post_id=job_post_id)
+                await notify(chat_id, text=f"Your posting has been approved by the admin!.\n\nIt has been posted in the channel with Job ID: {job_post_id}")
+            else:
+                await notify(chat_id, text="Your posting has been rejected by an admin. Please PM @jojoweipop for more details")
+    logger.info("%s payments %s and job posts %s", 'Approved' if approve else 'Rejected', [row[0] for row in payments], [row[0] for row in job_posts])
+    return len(payments) + len(job_posts)
 
 ###########################################################################################################################################################
 #? Misc Commands
@@ -3576,18 +5303,13 @@ async def view_tokens(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     # Get token balance with chat_id
     chat_id = update.effective_chat.id
-    query_string = "SELECT tokens, exp_date FROM token_balance WHERE chat_id = :chat_id"
-    params = {"chat_id": chat_id}
-    
     # Check if user chat_id has row in token_balance table for db
-    query_string = f"SELECT EXISTS (SELECT 1 FROM token_balance WHERE chat_id = '{chat_id}')"
-    results = await get_db(query_string)
+    results = await safe_get_db(QUERIES['token_balance.exists'], {"chat_id": chat_id})
     # If have existing entry
-    logger.info(f"Chat ID is already in token_balance table: {results}")
+    logger.info("Chat ID is already in token_balance table: %s", results)
     if (results[0][0]):
         # Get balance and current expiry date of tokens
-        query_string = f"SELECT tokens, exp_date FROM token_balance WHERE chat_id = '{chat_id}'"
-        results = await get_db(query_string)
+        results = await safe_get_db(QUERIES['token_balance.get'], {"chat_id": chat_id})
         curr_tokens, curr_exp_date = results[0]
         # Notify user
         await update.message.reply_text(text=f"You have {curr_tokens} tokens expiring on {curr_exp_date.date()}.")
@@ -3641,10 +5363,11 @@ async def webhook_update(update: WebhookUpdate, context: CustomContext) -> None:
 # Error Handler
 async def global_error_handler(update, context):
     """Handles and logs any unexpected errors."""
+    # Roll back what the failed handler wrote since its last message
+    fail_unit_of_work()
 
     # Log the error
-    logger.info(f"Update {update} caused error {context.error}")
-    traceback.print_exc()
+    logger.error("Update %s caused error %s", update, context.error, exc_info=context.error)
 
     # Optionally, notify the developer or admin
     # await context.bot.send_message(chat_id=CHANNEL_ID, text=f"An error occurred: {context.error}")
@@ -3654,111 +5377,155 @@ async def global_error_handler(update, context):
 ###########################################################################################################################################################   
 # Function to check and update expired credits
 async def daily_checks(bot):
+    """
+    Expires tokens and subscriptions and allocates this month's subscription tokens.
+    All DB work is done first, then the user notices are sent concurrently and the admin gets one digest of the run.
+    Every change is conditional on the row still being as it was read, so a rerun after a partial run does not repeat it.
+    Raises once the notices and digest are out if any DB step failed, so that the scheduler retries the run.
+    """
+    notices = [] # (chat_id, text) for each user to notify
+    expiries = [] # (chat_id, tokens)
+    allocations = [] # (chat_id, sub_name, tokens, new_balance, new_date)
+    expired_subs = [] # (chat_id, sub_balance_id)
+    failures = [] # DB steps that failed
+    # prune update_ids that Telegram will no longer redeliver
+    if UPDATE_DEDUPE_DB:
+        try:
+            async with db_connection(commit=True) as conn:
+                await conn.execute(QUERIES['processed_updates.prune'], {"before": datetime.now() - timedelta(days=UPDATE_DEDUPE_DB_DAYS)})
+        except Exception:
+            logger.exception("Daily checks: could not prune processed updates")
+            failures.append("processed updates")
+    # drop outbox messages that were sent or given up on
+    try:
+        async with db_connection(commit=True) as conn:
+            await conn.execute(QUERIES['outbox.prune'], {"before": datetime.now() - timedelta(days=OUTBOX_KEEP_DAYS)})
+    except Exception:
+        logger.exception("Daily checks: could not prune the outbox")
+        failures.append("outbox")
     # remove expired credits
     try:
-        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        query_string = f"SELECT chat_id, tokens FROM token_balance WHERE exp_date <= '{now}'"
-        results = await get_db(query_string)
-        logger.info(f"Checking expiring tokens at {now}")
-        for entries in results:
-            chat_id, expiring_tokens = entries
-            #remove expired entry
-            query_string = f"DELETE from token_balance WHERE chat_id = '{chat_id}'"
-            await set_db(query_string)
-            logger.info(f"Removed {expiring_tokens} expired tokens from {chat_id} account")
-            # Get tele handle from chat_id
-            query_string = "SELECT user_handle FROM user_data WHERE chat_id = :chat_id"
-            params = {"chat_id": chat_id}
-            results = await safe_get_db(query_string, params)
-            user_handle = results[0][0]
-
-            # notify users that their credits have expired (send to admin as well)
-            await bot.send_message(chat_id=chat_id, text=f"{expiring_tokens} tokens have expired today!\n\nTo purchase more tokens, please use the /purchase_tokens command!")
-            await bot.send_message(chat_id=ADMIN_CHAT_ID, text=f"{expiring_tokens} tokens has expired from {user_handle}'s account.")
-            
-            # Remove expired job posts
-            
-    except Exception as e:
-        logger.info(e)
+        now = datetime.now().replace(microsecond=0)
+        logger.info("Checking expiring tokens at %s", now)
+        async with db_connection() as conn:
+            results = (await conn.execute(QUERIES['token_balance.expired'], {"now": now})).all()
+        for chat_id, expiring_tokens in results:
+            # Not if the balance has been topped up (or removed by an earlier run) since
+            async with db_connection(commit=True) as conn:
+                removed = (await conn.execute(QUERIES['token_balance.delete_expired'], {"chat_id": chat_id, "now": now})).rowcount
+            if not removed:
+                continue
+            logger.info("Removed %s expired tokens from %s account", expiring_tokens, chat_id)
+            expiries.append((chat_id, expiring_tokens))
+            notices.append((chat_id, f"{expiring_tokens} tokens have expired today!\n\nTo purchase more tokens, please use the /purchase_tokens command!"))
+    except Exception:
+        logger.exception("Daily checks: could not remove expired tokens")
+        failures.append("token expiry")
     # check active subscriptions
     try:
         # get active subscriptions
         now = datetime.now()
         logger.info("Getting active subs:")
-        query_string = "SELECT id, chat_id, start_date, end_date, last_distribution, subpkg_id FROM subscription_balance WHERE status = :status"
-        params = {"status": 'active'}
-        active_subs = await safe_get_db(query_string, params)
-        # chat_id, end_date, last_distribution, subpkg_id = active_subs
-        # Get tokens_per_month from subscription_packages with subpkg_id
+        async with db_connection() as conn:
+            active_subs = (await conn.execute(QUERIES['subscription_balance.active'])).all()
+        packages = {} # subpkg_id -> details, looked up once per run
 
+        for sub_balance_id, chat_id, start_date, end_date, last_distribution, subpkg_id in active_subs:
+            try:
+                # if expired
+                if now >= end_date:
+                    async with db_connection(commit=True) as conn:
+                        expired = (await conn.execute(QUERIES['subscription_balance.expire'], {"sub_balance_id": sub_balance_id})).rowcount
+                    if expired:
+                        expired_subs.append((chat_id, sub_balance_id))
+                    continue # goes to next subscription
+
+                # if active subscription
+                if subpkg_id not in packages:
+                    async with db_connection() as conn:
+                        packages[subpkg_id] = (await conn.execute(QUERIES['subscription_packages.details'], {"package_id": subpkg_id})).one()
+                sub_name, tokens_per_month, duration_months, price = packages[subpkg_id]
+
+                # Calculate the next distribution date
+                next_distribution_date = last_distribution + relativedelta(months=1)
+                if not ((now >= next_distribution_date) and (now >= start_date)):
+                    continue
+
+                logger.info("Allocating tokens for subscription id: %s", sub_balance_id)
+                # Moving last_distribution on and crediting the tokens commit together, and only if last_distribution
+                # is still the one read above, so each month is allocated once however often the run is retried
+                async with unit_of_work():
+                    async with db_connection(commit=True) as conn:
+                        claimed = (await conn.execute(QUERIES['subscription_balance.claim_distribution'], {"id": sub_balance_id, "last_distribution": last_distribution, "now": now})).rowcount
+                    if not claimed:
+                        continue
+                    # Allocate this month's tokens, expiring in a month
+                    new_balance, new_date = await credit_tokens(chat_id, tokens_per_month, now + relativedelta(months=1))
+                allocations.append((chat_id, sub_name, tokens_per_month, new_balance, new_date))
+                notices.append((chat_id, f"{tokens_per_month} tokens have been allocated to your account.\nYour have a new balance of {new_balance}, expiring on {new_date.date()}."))
+            except Exception:
+                logger.exception("Daily checks: could not update subscription %s", sub_balance_id)
+                failures.append(f"subscription {sub_balance_id}")
+    except Exception:
+        logger.exception("Daily checks: could not read the active subscriptions")
+        failures.append("subscriptions")
+
+    failed = await send_notices(bot, notices)
+    try:
+        await send_daily_digest(bot, expiries, allocations, expired_subs, failed)
+    except Exception:
+        logger.exception("Daily checks: could not send the digest")
+    if failures:
+        raise RuntimeError(f"Daily checks failed for: {', '.join(failures)}")
 
+async def send_notices(bot, notices) -> list:
+    """
+    Sends each (chat_id, text) notice, DAILY_CHECKS_SEND_CONCURRENCY at a time.
+    The bot's rate limiter keeps each chat and the bot as a whole within Telegram's limits.
 
-        for sub_balance_id, chat_id, start_date, end_date, last_distribution, subpkg_id in active_subs:
-            # if expired
-            if now >= end_date:
-                # Set status to expired
-                query_string = "UPDATE subscription_balance SET status = :status WHERE id = :sub_balance_id"
-                params = {"status": "expired", "sub_balance_id": sub_balance_id}
-                await safe_set_db(query_string, params)
-                continue # goes to next subscription
-
-            # if active subscription
-            query_string = "SELECT sub_name, number_of_tokens, duration_months FROM subscription_packages WHERE subpkg_code = :subpkg_code"
-            params = {"subpkg_code": subpkg_id}
-            results = await safe_get_db(query_string, params)
-            sub_name, tokens_per_month, duration_months = results[0]
-
-            # Calculate the next distribution date
-            next_distribution_date = last_distribution + relativedelta(months=1)
-            
-            if (now >= next_distribution_date) and (now >= start_date):
-                logger.info(f"Allocating tokens for subscription id: {sub_balance_id}")
-                # Set last distribution_date
-                query_string = "UPDATE subscription_balance SET last_distribution = :last_distribution WHERE id = :id"
-                params = {
-                    "last_distribution": now,
-                    "id": sub_balance_id
-                    }
-                await safe_set_db(query_string, params)
-                
-                # Check if user chat_id has row in token_balance table for db
-                query_string = f"SELECT EXISTS (SELECT 1 FROM token_balance WHERE chat_id = '{chat_id}')"
-                results = await get_db(query_string)
-                # Calculate new expiry date
-                curr_date = now
-                new_date = curr_date + relativedelta(months=1)
-                # If have existing entry
-                logger.info(f"Chat ID is already in token_balance table: {results}")
-                if (results[0][0]):
-                    # Get balance and current expiry date of tokens
-                    query_string = f"SELECT tokens, exp_date FROM token_balance WHERE chat_id = '{chat_id}'"
-                    results = await get_db(query_string)
-                    curr_tokens, curr_exp_date = results[0]
-                    # Calculate new tokens
-                    new_balance = curr_tokens + tokens_per_month
-                    # If extended date is longer than current exp date, updates both token balance and exp date of chat_id
-                    if new_date > curr_exp_date:
-                        query_string = f"UPDATE token_balance SET tokens = '{new_balance}', exp_date = '{new_date}' WHERE chat_id = '{chat_id}'"
-                    # Otherwise, dont touch exp date
-                    else:
-                        query_string = f"UPDATE token_balance SET tokens = '{new_balance}' WHERE chat_id = '{chat_id}'"
-                        new_date = curr_exp_date # Just for returning the expiry date, new_date is not used here
-                    # Update db
-                    await set_db(query_string)
-                    await bot.send_message(chat_id=chat_id, text=f"{tokens_per_month} tokens have been allocated to your account.\nYour have a new balance of {new_balance}, expiring on {new_date.date()}.")
-
-                    # return new_balance, new_date
-                # If no existing entry, create new entry
-                else: 
-                    # Create new entry
-                    query_string = f"INSERT INTO token_balance (chat_id, tokens, exp_date) VALUES ('{chat_id}', '{tokens_per_month}', '{new_date}')"
-                    await set_db(query_string)
-                    logger.info("Chat ID does not exist in token_balance table")
-                    await bot.send_message(chat_id=chat_id, text=f"{tokens_per_month} tokens have been allocated to your account.\nYour have a new balance of {tokens_per_month}, expiring on {new_date.date()}.")
-
-                    # return tokens_per_month, new_date
-    except Exception as e:
-        logger.info(e)
+    Returns:
+        The (chat_id, error) of every notice that could not be sent
+    """
+    semaphore = asyncio.Semaphore(DAILY_CHECKS_SEND_CONCURRENCY)
+
+    async def send(chat_id, text):
+        async with semaphore:
+            await bot.send_message(chat_id=chat_id, text=text)
+
+    results = await asyncio.gather(*(send(chat_id, text) for chat_id, text in notices), return_exceptions=True)
+    failed = [(chat_id, result) for (chat_id, _), result in zip(notices, results) if isinstance(result, Exception)]
+    logger.info("Sent %s of %s daily notices", len(notices) - len(failed), len(notices))
+    return failed
+
+async def send_daily_digest(bot, expiries, allocations, expired_subs, failed) -> None:
+    """Sends the admin one message (or a text file, if it is too long for one) listing everything daily_checks did"""
+    chat_ids = {chat_id for chat_id, *_ in expiries + allocations + expired_subs + failed}
+    handles = {}
+    if chat_ids:
+        # safe_get_db returns None if the lookup fails, the digest then shows the bare chat_ids
+        handles = dict(await safe_get_db(QUERIES['user_data.user_handles'], {"chat_ids": tuple(chat_ids)}) or [])
+    handle = lambda chat_id: handles.get(chat_id) or str(chat_id)
+
+    summary = (f"Daily checks for {datetime.now().date()}: {len(expiries)} token expiries, {len(allocations)} subscription allocations, "
+               f"{len(expired_subs)} expired subscriptions, {len(failed)} failed notices.")
+    lines = [summary]
+    if expiries:
+        lines += ["", "Expired tokens:"] + [f"• {handle(chat_id)}: {tokens} tokens" for chat_id, tokens in expiries]
+    if allocations:
+        lines += ["", "Subscription allocations:"] + [
+            f"• {handle(chat_id)}: {tokens} tokens ({sub_name}), balance {new_balance} expiring on {new_date.date()}"
+            for chat_id, sub_name, tokens, new_balance, new_date in allocations
+        ]
+    if expired_subs:
+        lines += ["", "Expired subscriptions:"] + [f"• {handle(chat_id)} (subscription {sub_balance_id})" for chat_id, sub_balance_id in expired_subs]
+    if failed:
+        lines += ["", "Failed notices:"] + [f"• {handle(chat_id)}: {error}" for chat_id, error in failed]
+    digest = "\n".join(lines)
+
+    if len(digest) <= MessageLimit.MAX_TEXT_LENGTH:
+        await bot.send_message(chat_id=ADMIN_CHAT_ID, text=digest)
+    else:
+        await bot.send_document(chat_id=ADMIN_CHAT_ID, document=InputFile(digest.encode(), filename=f"daily_checks_{datetime.now().date()}.txt"), caption=summary)
 
 # async def test_schedule(bot):
 #     logger.info(f"test_schedule called at {datetime.now()}")
@@ -3767,6 +5534,494 @@ async def daily_checks(bot):
 #         logger.info("DELETED!")
 #     await bot.send_message(chat_id=ADMIN_CHAT_ID, text="Your agency account has been deleted!")
 
+###########################################################################################################################################################
+# Scheduled jobs
+# Every instance runs the `schedule` loop, but jobs only run on the one holding the scheduler lease (a row in
+# scheduler_leases, renewed every SCHEDULER_HEARTBEAT_SECONDS). If the leader dies its lease runs out and another instance
+# takes over. Each job also claims its period in scheduled_job_runs, so it runs at most once per period even across a handover.
+# A run that was missed (no leader at the time) or failed (its claim is released) is caught up by the leader's heartbeat,
+# but only within SCHEDULER_MISFIRE_GRACE_SECONDS of its time, so that a deploy in the afternoon does not run it then.
+
+class ScheduledJobs:
+    """
+    Jobs that should only run on one instance, once a day at a set time.
+    Call add() for each job, then run heartbeat() as a task and have `schedule` call run(name) at that time.
+    """
+
+    def __init__(self, lease_name: str = "scheduler", holder: str = INSTANCE_ID):
+        self.lease_name = lease_name
+        self.holder = holder
+        self.jobs = {}
+        self.leader_until = 0 # time.monotonic() until which the lease is surely ours
+        self.tasks = {} # job name -> task running it on this instance
+
+    @property
+    def is_leader(self) -> bool:
+        return time.monotonic() < self.leader_until
+
+    def add(self, name: str, job: Callable[..., Awaitable], *args, at: str = "00:00"):
+        """Registers job, called as job(*args) once a day at `at` (HH:MM, local time)"""
+        self.jobs[name] = (job, args, at)
+
+    @staticmethod
+    def last_scheduled(at: str) -> datetime:
+        """The latest time at `at` that is not in the future, its date is the period a run belongs to"""
+        now = datetime.now()
+        hour, minute = map(int, at.split(":"))
+        scheduled = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        return scheduled if scheduled <= now else scheduled - timedelta(days=1)
+
+    def start(self, name: str, catch_up: bool = False):
+        """Runs the job in a task of its own, so that a long job does not hold up the heartbeat, unless it is already running"""
+        if name in self.tasks:
+            return
+        task = self.tasks[name] = asyncio.create_task(self.run(name, catch_up=catch_up))
+        task.add_done_callback(lambda _: self.tasks.pop(name, None))
+
+    async def renew_lease(self) -> bool:
+        """Renews the lease, or takes it over if it has expired. Returns whether this instance is the leader"""
+        params = {"name": self.lease_name, "holder": self.holder, "seconds": SCHEDULER_LEASE_SECONDS}
+        started = time.monotonic()
+        async with db_connection(commit=True, new_connection=True) as conn:
+            renewed = (await conn.execute(QUERIES['scheduler_leases.renew'], params)).rowcount
+            if not renewed:
+                renewed = (await conn.execute(QUERIES['scheduler_leases.insert'], params)).rowcount
+        # Counted from before the renewal was sent, and a heartbeat short, so that the lease surely has not run out yet
+        self.leader_until = started + SCHEDULER_LEASE_SECONDS - SCHEDULER_HEARTBEAT_SECONDS if renewed else 0
+        return bool(renewed)
+
+    async def heartbeat(self):
+        """Keeps renewing the lease. While the leader, catches up on the jobs that have not run at their last time"""
+        while True:
+            was_leader = self.is_leader
+            try:
+                is_leader = await self.renew_lease()
+            except Exception as e:
+                logger.warning("Could not renew the scheduler lease: %s", e)
+                is_leader = self.is_leader
+            if is_leader and not was_leader:
+                logger.info("Scheduler: %s is now the leader", self.holder)
+            if is_leader:
+                for name in self.jobs:
+                    self.start(name, catch_up=True)
+            elif was_leader:
+                logger.warning("Scheduler: %s lost the lease", self.holder)
+            await asyncio.sleep(SCHEDULER_HEARTBEAT_SECONDS)
+
+    async def release(self):
+        """Gives the lease up, so that another instance takes over without waiting for it to run out"""
+        if self.is_leader:
+            self.leader_until = 0
+            await safe_set_db(QUERIES['scheduler_leases.release'], {"name": self.lease_name, "holder": self.holder})
+
+    async def run(self, name: str, catch_up: bool = False):
+        """
+        Runs the job if this instance is the leader and it has not run yet for its last scheduled time.
+        When catching up, only within SCHEDULER_MISFIRE_GRACE_SECONDS of that time.
+        If the job fails its claim is released, so that the heartbeat tries it again.
+        """
+        if not self.is_leader:
+            if not catch_up:
+                logger.info("Scheduler: skipping %s, %s is not the leader", name, self.holder)
+            return
+        job, args, at = self.jobs[name]
+        scheduled = self.last_scheduled(at)
+        if catch_up and (datetime.now() - scheduled).total_seconds() > SCHEDULER_MISFIRE_GRACE_SECONDS:
+            return
+        run = {"job": name, "period": scheduled.date().isoformat(), "holder": self.holder}
+        try:
+            async with db_connection(commit=True, new_connection=True) as conn:
+                claimed = (await conn.execute(QUERIES['scheduled_job_runs.claim'], run)).rowcount
+        except Exception as e:
+            logger.error("Scheduler: could not claim %s for %s, not running it: %s", name, run['period'], e)
+            return
+        if not claimed:
+            if not catch_up:
+                logger.info("Scheduler: %s has already run for %s", name, run['period'])
+            return
+        logger.info("Scheduler: running %s for %s", name, run['period'])
+        try:
+            await job(*args)
+        except Exception:
+            logger.exception("Scheduler: %s for %s failed, releasing it to be retried", name, run['period'])
+            await safe_set_db(QUERIES['scheduled_job_runs.release'], run)
+            return
+        await safe_set_db(QUERIES['scheduled_job_runs.finish'], run)
+
+###########################################################################################################################################################
+# Webhook server
+# Plain ASGI app served by uvicorn. Requests are handled on the event loop directly and updates go
+# straight into application.update_queue.
+
+@dataclass
+class HTTPRequest:
+    """Incoming HTTP request, the body is only read when a route asks for it"""
+    scope: dict
+    receive: Callable
+
+    @property
+    def method(self) -> str:
+        return self.scope["method"]
+
+    @property
+    def path(self) -> str:
+        return self.scope["path"]
+
+    @functools.cached_property
+    def query(self) -> dict:
+        """Query parameters, the first value of each"""
+        return {key: values[0] for key, values in parse_qs(self.scope.get("query_string", b"").decode("latin-1")).items()}
+
+    @functools.cached_property
+    def headers(self) -> dict:
+        return {key.decode("latin-1").lower(): value.decode("latin-1") for key, value in self.scope.get("headers", [])}
+
+    async def stream(self):
+        """Yields the body chunk by chunk as it arrives, nothing more is read while the caller is busy with a chunk"""
+        while True:
+            message = await self.receive()
+            if message["type"] == "http.disconnect":
+                raise ConnectionError("Client disconnected")
+            chunk = message.get("body", b"")
+            if chunk:
+                yield chunk
+            if not message.get("more_body", False):
+                return
+
+    async def body(self, limit: int = MAX_REQUEST_BODY_BYTES) -> bytes:
+        """Reads the whole body, raises ValueError if it is larger than limit"""
+        chunks = []
+        size = 0
+        async for chunk in self.stream():
+            size += len(chunk)
+            if size > limit:
+                raise ValueError(f"Request body larger than {limit} bytes")
+            chunks.append(chunk)
+        return b"".join(chunks)
+
+@dataclass
+class HTTPResponse:
+    status: int = HTTPStatus.OK
+    body: bytes = b""
+    content_type: str = "text/plain; charset=utf-8"
+    headers: list = field(default_factory=list)
+
+    @classmethod
+    def json(cls, data, status: int = HTTPStatus.OK) -> "HTTPResponse":
+        return cls(status=status, body=orjson.dumps(data), content_type="application/json")
+
+class JSONRecordSplitter:
+    """
+    Splits a streamed body into records: the items of a JSON array, or the lines of NDJSON if the body does not start with "[".
+    Records are returned as bytes, for the caller to parse, as soon as the chunk completing them has been fed.
+    """
+    STRUCTURE = re.compile(rb'[\[\]{}",]')
+    STRING_END = re.compile(rb'\\.|"', re.DOTALL)
+
+    def __init__(self, max_record_bytes: int = MAX_REQUEST_BODY_BYTES):
+        self.max_record_bytes = max_record_bytes
+        self.buffer = bytearray()
+        self.is_array = None
+        self.ended = False
+        self.start = 0 # where the current record starts in buffer
+        self.pos = 0 # where scanning resumes
+        self.depth = 0
+        self.in_string = False
+
+    def feed(self, chunk: bytes) -> list:
+        """Adds chunk, returns the records it completed. Raises ValueError for a record over max_record_bytes"""
+        self.buffer += chunk
+        if self.is_array is None:
+            stripped = self.buffer.lstrip()
+            if not stripped:
+                return []
+            self.is_array = stripped.startswith(b"[")
+            if self.is_array:
+                self.pos = self.start = len(self.buffer) - len(stripped) + 1
+                self.depth = 1
+        records = self._split_array() if self.is_array else self._split_lines()
+        if len(self.buffer) - self.start > self.max_record_bytes:
+            raise ValueError(f"Record larger than {self.max_record_bytes} bytes")
+        return records
+
+    def finish(self) -> list:
+        """Returns the last record once the body has ended, raises ValueError if the body was cut off"""
+        if self.is_array and not self.ended:
+            raise ValueError("JSON array is not terminated")
+        if self.is_array or not self.buffer.strip():
+            return []
+        return [bytes(self.buffer).strip()]
+
+    def _split_lines(self) -> list:
+        *lines, rest = self.buffer.split(b"\n")
+        self.buffer = bytearray(rest)
+        return [bytes(line).strip() for line in lines if line.strip()]
+
+    def _split_array(self) -> list:
+        records = []
+        while not self.ended:
+            if self.in_string:
+                for match in self.STRING_END.finditer(self.buffer, self.pos):
+                    if match.group() == b'"':
+                        self.in_string = False
+                        self.pos = match.end()
+                        break
+                    # escape sequences are skipped whole, so an escaped quote does not end the string
+                    self.pos = match.end()
+                else:
+                    break
+                continue
+            match = self.STRUCTURE.search(self.buffer, self.pos)
+            if match is None:
+                self.pos = len(self.buffer)
+                break
+            self.pos = match.end()
+            token = match.group()
+            if token == b'"':
+                self.in_string = True
+            elif token in b"[{":
+                self.depth += 1
+            elif token in b"]}":
+                self.depth -= 1
+                if self.depth == 0:
+                    self.ended = True
+                    record = bytes(self.buffer[self.start:match.start()]).strip()
+                    if record:
+                        records.append(record)
+                    self.start = self.pos
+            elif self.depth == 1: # a comma between two items
+                records.append(bytes(self.buffer[self.start:match.start()]).strip())
+                self.start = self.pos
+        # Drop what has been returned already
+        del self.buffer[:self.start]
+        self.pos -= self.start
+        self.start = 0
+        return records
+
+class UpdateDeduplicator:
+    """
+    Remembers the last `size` update_ids, so that updates Telegram delivers again (e.g. after a slow reply) are dropped.
+    With use_db, update_ids are also claimed in the processed_updates table, which catches redeliveries
+    that land on another instance.
+    """
+
+    def __init__(self, size: int = UPDATE_DEDUPE_SIZE, use_db: bool = UPDATE_DEDUPE_DB):
+        self.size = size
+        self.use_db = use_db
+        self.seen = collections.OrderedDict()
+        self.duplicates = 0
+
+    async def claim(self, update_id: int) -> bool:
+        """Marks update_id as seen, returns False if it had already been seen"""
+        if update_id in self.seen:
+            self.seen.move_to_end(update_id)
+            self.duplicates += 1
+            return False
+        if self.use_db:
+            try:
+                async with db_connection(commit=True, new_connection=True) as conn:
+                    claimed = (await conn.execute(QUERIES['processed_updates.claim'], {"update_id": update_id})).rowcount
+            except Exception as e:
+                logger.warning("Could not claim update %s in the DB, deduplicating in memory only: %s", update_id, e)
+                claimed = True
+            if not claimed:
+                self.duplicates += 1
+                return False
+        self.seen[update_id] = None
+        if len(self.seen) > self.size:
+            self.seen.popitem(last=False)
+        return True
+
+    async def release(self, update_id: int):
+        """Forgets update_id, for updates that were claimed but not accepted, so that their redelivery goes through"""
+        self.seen.pop(update_id, None)
+        if self.use_db:
+            try:
+                await safe_set_db(QUERIES['processed_updates.release'], {"update_id": update_id})
+            except Exception as e:
+                logger.warning("Could not release update %s in the DB: %s", update_id, e)
+
+class WebhookServer:
+    """
+    ASGI app with the bot's HTTP routes.
+    Routes are coroutine methods taking an HTTPRequest and returning an HTTPResponse, registered in self.routes.
+    """
+
+    def __init__(self, application: Application):
+        self.application = application
+        self.deduplicator = UpdateDeduplicator()
+        self.forbidden = 0
+        self.bulk_accepted = 0
+        self.bulk_rejected = 0
+        self.routes = {
+            "/telegram": (("POST",), self.telegram),
+            "/submitpayload": (("GET", "POST"), self.custom_updates),
+            "/submitpayload/bulk": (("POST",), self.bulk_custom_updates),
+            "/healthcheck": (("GET",), self.health),
+            "/metrics": (("GET",), self.metrics),
+        }
+
+    async def __call__(self, scope: dict, receive: Callable, send: Callable):
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    await send({"type": "lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+        if scope["type"] != "http":
+            return
+        request = HTTPRequest(scope, receive)
+        route = self.routes.get(request.path)
+        if route is None:
+            response = HTTPResponse(HTTPStatus.NOT_FOUND, b"Not Found")
+        elif request.method not in route[0]:
+            response = HTTPResponse(HTTPStatus.METHOD_NOT_ALLOWED, b"Method Not Allowed", headers=[(b"allow", ", ".join(route[0]).encode())])
+        else:
+            try:
+                response = await route[1](request)
+            except ConnectionError:
+                return
+            except Exception:
+                logger.exception("Error handling %s %s", request.method, request.path)
+                response = HTTPResponse(HTTPStatus.INTERNAL_SERVER_ERROR, b"Internal Server Error")
+        await send({
+            "type": "http.response.start",
+            "status": int(response.status),
+            "headers": [(b"content-type", response.content_type.encode()), (b"content-length", str(len(response.body)).encode()), *response.headers],
+        })
+        await send({"type": "http.response.body", "body": response.body})
+
+    async def telegram(self, request: HTTPRequest) -> HTTPResponse:
+        """Handle incoming Telegram updates by putting them into the `update_queue`"""
+        # Reject anything not sent by Telegram before reading the body
+        if WEBHOOK_SECRET_TOKEN and not hmac.compare_digest(
+            request.headers.get("x-telegram-bot-api-secret-token", "").encode(), WEBHOOK_SECRET_TOKEN.encode()
+        ):
+            self.forbidden += 1
+            return HTTPResponse(HTTPStatus.FORBIDDEN, b"Forbidden")
+        try:
+            data = orjson.loads(await request.body())
+            update_id = data["update_id"]
+        except (ValueError, KeyError, TypeError) as e: # orjson.JSONDecodeError is a ValueError, as is an oversized body
+            return HTTPResponse(HTTPStatus.BAD_REQUEST, f"Invalid update: {e}".encode())
+        # Telegram redelivers updates it got no timely answer for, only the first delivery is processed
+        if not await self.deduplicator.claim(update_id):
+            update_logger.info("Dropping duplicate update %s", update_id)
+            return HTTPResponse()
+        update_logger.info("MESSAGE RECEIVED: update %s", update_id)
+        response = await self.enqueue(Update.de_json(data=data, bot=self.application.bot))
+        if response.status != HTTPStatus.OK:
+            await self.deduplicator.release(update_id)
+        return response
+
+    async def custom_updates(self, request: HTTPRequest) -> HTTPResponse:
+        """
+        Handle incoming webhook updates by also putting them into the `update_queue` if
+        the required parameters were passed correctly.
+        """
+        try:
+            user_id = int(request.query["user_id"])
+            payload = request.query["payload"]
+        except KeyError:
+            return HTTPResponse(HTTPStatus.BAD_REQUEST, b"Please pass both `user_id` and `payload` as query parameters.")
+        except ValueError:
+            return HTTPResponse(HTTPStatus.BAD_REQUEST, b"The `user_id` must be a string!")
+
+        return await self.enqueue(WebhookUpdate(user_id=user_id, payload=payload))
+
+    async def bulk_custom_updates(self, request: HTTPRequest) -> HTTPResponse:
+        """
+        Accepts many custom updates in one request, as a JSON array or NDJSON of {"user_id": ..., "payload": ...} objects.
+        Records are validated and queued while the body streams in. Once bulk updates fill their share of the queue,
+        reading the body pauses until there is room again, which slows the sender down through TCP flow control.
+        Replies with the number of accepted and rejected records, and the index and reason of the rejected ones.
+        If the queue stays full for BULK_ADMIT_TIMEOUT, or the body is malformed, the reply also has `retry_from`,
+        the index of the first record that was not read.
+        """
+        if BULK_UPDATES_TOKEN and not hmac.compare_digest(
+            request.headers.get("authorization", "").encode(), f"Bearer {BULK_UPDATES_TOKEN}".encode()
+        ):
+            self.forbidden += 1
+            return HTTPResponse(HTTPStatus.FORBIDDEN, b"Forbidden")
+        splitter = JSONRecordSplitter()
+        result = {"accepted": 0, "rejected": 0, "errors": []}
+        index = 0
+        try:
+            async for chunk in request.stream():
+                for record in splitter.feed(chunk):
+                    if not await self.enqueue_bulk_record(record, index, result):
+                        return HTTPResponse.json(result | {"retry_from": index}, HTTPStatus.SERVICE_UNAVAILABLE)
+                    index += 1
+            for record in splitter.finish():
+                if not await self.enqueue_bulk_record(record, index, result):
+                    return HTTPResponse.json(result | {"retry_from": index}, HTTPStatus.SERVICE_UNAVAILABLE)
+                index += 1
+        except ValueError as e:
+            return HTTPResponse.json(result | {"retry_from": index, "error": str(e)}, HTTPStatus.BAD_REQUEST)
+        finally:
+            self.bulk_accepted += result["accepted"]
+            self.bulk_rejected += result["rejected"]
+            logger.info("Bulk custom updates: %s accepted, %s rejected", result['accepted'], result['rejected'])
+        return HTTPResponse.json(result)
+
+    async def enqueue_bulk_record(self, record: bytes, index: int, result: dict) -> bool:
+        """Validates and queues one bulk record, waiting for room in the queue. Returns False if there was none in time"""
+        try:
+            update = WebhookUpdate.from_json(record)
+        except ValueError as e:
+            result["rejected"] += 1
+            if len(result["errors"]) < BULK_MAX_ERRORS:
+                result["errors"].append({"index": index, "error": str(e)})
+            return True
+        processor = self.application.update_processor
+        deadline = time.monotonic() + BULK_ADMIT_TIMEOUT
+        while processor.in_flight[False] >= processor.limits[False] * BULK_QUEUE_SHARE or not processor.admit(update):
+            if time.monotonic() >= deadline:
+                logger.warning("Update queue full for %ss, stopping bulk request at record %s", BULK_ADMIT_TIMEOUT, index)
+                return False
+            await asyncio.sleep(0.05)
+        await self.application.update_queue.put(update)
+        result["accepted"] += 1
+        return True
+
+    async def enqueue(self, update: object) -> HTTPResponse:
+        """Puts the update into the `update_queue`, or answers 503 if too many updates are already waiting"""
+        if not self.application.update_processor.admit(update):
+            logger.warning("Update queue full, asking for redelivery of %s", update.update_id if isinstance(update, Update) else update)
+            return HTTPResponse(
+                HTTPStatus.SERVICE_UNAVAILABLE,
+                b"Too many updates waiting, please retry later",
+                headers=[(b"retry-after", str(UPDATE_RETRY_AFTER).encode())],
+            )
+        await self.application.update_queue.put(update)
+        return HTTPResponse()
+
+    async def health(self, request: HTTPRequest) -> HTTPResponse:
+        """For the health endpoint, reply with a simple plain text message."""
+        return HTTPResponse(body=b"The bot is still running fine :)")
+
+    async def metrics(self, request: HTTPRequest) -> HTTPResponse:
+        """Reply with the slowest DB statements by total time, pass `top` to change how many are listed"""
+        try:
+            top_n = int(request.query.get("top", METRICS_TOP_N))
+        except ValueError:
+            top_n = METRICS_TOP_N
+        return HTTPResponse.json({
+            "ingress": {
+                "duplicates": self.deduplicator.duplicates,
+                "forbidden": self.forbidden,
+                "bulk_accepted": self.bulk_accepted,
+                "bulk_rejected": self.bulk_rejected,
+            },
+            "logging": {"queued": log_handler.queue.qsize(), "dropped": log_handler.dropped},
+            "updates": self.application.update_processor.stats(),
+            "sends": self.application.bot.rate_limiter.stats(),
+            "outbox": outbox_sender.stats(),
+            "queries": query_stats.top(top_n),
+        })
+
 # Function to run scheduled tasks
 async def run_schedule():
     while True:
@@ -3780,9 +6035,26 @@ async def main() -> None:
     # Here we set updater to None because we want our custom webhook server to handle the updates
     # and hence we don't need an Updater instance
 
+    if UPDATE_CONCURRENCY * (1 + FETCH_MANY_MAX_CONNECTIONS) > DB_POOL_SIZE + DB_MAX_OVERFLOW:
+        logger.warning("UPDATE_CONCURRENCY=%s updates can need %s DB connections at once, "
+                       "more than the pool's %s. Raise DB_POOL_SIZE or lower UPDATE_CONCURRENCY or FETCH_MANY_MAX_CONNECTIONS",
+                       UPDATE_CONCURRENCY, UPDATE_CONCURRENCY * (1 + FETCH_MANY_MAX_CONNECTIONS), DB_POOL_SIZE + DB_MAX_OVERFLOW)
+
+    # Every update is processed inside its own unit of work, updates from different chats run concurrently,
+    # see ChatOrderedUpdateProcessor
     application = (
-        Application.builder().token(BOT_TOKEN).updater(None).context_types(context_types).build()
+        Application.builder()
+        .token(BOT_TOKEN)
+        .updater(None)
+        .context_types(context_types)
+        .concurrent_updates(ChatOrderedUpdateProcessor(max_concurrent_updates=UPDATE_CONCURRENCY))
+        .persistence(DBPersistence(stateless_callbacks={help, view_tokens, get_chat_id, delete_button, apply_button_handler, view_button_handler}))
+        .request(BotAPIRequest())
+        .rate_limiter(SendScheduler())
+        .build()
     )
+    # Same bot on a pool of its own for bulk notifications, sharing the rate limits with the main one
+    bulk_bot = ExtBot(token=BOT_TOKEN, request=BotAPIRequest(BOT_API_BULK_POOL_SIZE), rate_limiter=application.bot.rate_limiter)
 
     # Command handlers
     application.add_handler(CommandHandler('viewtokens', view_tokens))
@@ -3793,6 +6065,7 @@ async def main() -> None:
     application.add_handler(CommandHandler("deleteprofile", delete_profile))
     application.add_handler(CommandHandler("viewprofile", view_profile))
     application.add_handler(CommandHandler('get_chat_id', get_chat_id))
+    application.add_handler(CommandHandler('pending', pending))
     # application.add_handler(CommandHandler('send_message_to_group', send_message_to_group))
 
 
@@ -3811,6 +6084,8 @@ async def main() -> None:
 
     # Registration Convo Handler
     registration_conversation_handler = ConversationHandler(
+        name='registration_conversation',
+        persistent=True,
         entry_points=[
             CommandHandler('start', start),
             CommandHandler('register', start)
@@ -3837,6 +6112,8 @@ async def main() -> None:
 
     # Edit profile convo handler
     edit_profile_convo_handler = ConversationHandler(
+        name='edit_profile_convo',
+        persistent=True,
         entry_points=[CommandHandler('editprofile', edit_profile)],
         states={
             SELECT_PROFILE: [
@@ -3854,6 +6131,8 @@ async def main() -> None:
 
 # Job post convo handler
     job_post_handler = ConversationHandler(
+    name='job_post',
+    persistent=True,
     entry_points=[
         CommandHandler('jobpost', job_post), 
         # CallbackQueryHandler(post_a_job_button, pattern='post_a_job')
@@ -3879,6 +6158,8 @@ async def main() -> None:
 
 # Job REPOST convo handler
     job_repost_handler = ConversationHandler(
+    name='job_repost',
+    persistent=True,
     entry_points=[CommandHandler('jobrepost', job_repost)],
     states={
         SELECT_JOB_TO_REPOST: [CallbackQueryHandler(jobrepost_button)],
@@ -3894,6 +6175,8 @@ async def main() -> None:
     
 # Add Subscription package convo handler
     add_subscription_handler = ConversationHandler(
+        name='add_subscription',
+        persistent=True,
         entry_points=[CommandHandler('addsubscription', start_add_subscription)],
 
         states={
@@ -3912,6 +6195,8 @@ async def main() -> None:
 
 # Delete subscription package convo handler
     delete_sub_handler = ConversationHandler(
+        name='delete_sub',
+        persistent=True,
         entry_points=[CommandHandler('deletesubscription', list_subscriptions)],
         states={
             DELETE_CONFIRMATION: [
@@ -3928,6 +6213,8 @@ async def main() -> None:
 
 # Add token package convo handler
     add_package_handler = ConversationHandler(
+        name='add_package',
+        persistent=True,
         entry_points=[CommandHandler('addpackage', add_package)],
         states={
             PACKAGE_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, package_name_input)],
@@ -3943,6 +6230,8 @@ async def main() -> None:
 
 # Delete token package convo handler
     delete_package_handler = ConversationHandler(
+    name='delete_package',
+    persistent=True,
     entry_points=[CommandHandler('deletepackage', delete_package)],
     states={
         SELECT_PACKAGE: [CallbackQueryHandler(select_package)],
@@ -3954,6 +6243,8 @@ async def main() -> None:
 
 # Purchasing tokens convo handler
     purchase_subscription_handler = ConversationHandler(
+    name='purchase_subscription',
+    persistent=True,
     entry_points=[CommandHandler('purchase_subscription', purchaseSubscription)],
     states={
         SELECTING_SUBSCRIPTION: [CallbackQueryHandler(subscription_selection)],
@@ -3965,6 +6256,8 @@ async def main() -> None:
 
 # Purchasing tokens convo handler
     purchase_tokens_handler = ConversationHandler(
+    name='purchase_tokens',
+    persistent=True,
     entry_points=[CommandHandler('purchase_tokens', purchase_tokens)],
     states={
         SELECTING_PACKAGE: [CallbackQueryHandler(package_selection)],
@@ -3976,6 +6269,8 @@ async def main() -> None:
 
 #Purchasing shortlists convo handler
     purchase_shortlists_handler = ConversationHandler(
+    name='purchase_shortlists',
+    persistent=True,
     entry_points=[CommandHandler('purchase_shortlists', purchase_shortlists)],
     states={
         CHOOSE_AMOUNT: [
@@ -3994,6 +6289,8 @@ async def main() -> None:
 
 # Shortlisting applicants convo handler
     shortlist_handler = ConversationHandler(
+        name='shortlist',
+        persistent=True,
         entry_points=[CommandHandler('shortlist', shortlist)],
         states={
             SELECT_JOB: [
@@ -4003,6 +6300,7 @@ async def main() -> None:
                 CallbackQueryHandler(shortlist_cancel, pattern='^cancel$')  # Cancel action
             ],
             SHOW_APPLICANTS: [
+                CallbackQueryHandler(browse_applicants, pattern=r'^applicant_\d+$'),
                 CallbackQueryHandler(shortlist_applicant, pattern='^shortlist\|'),
                 CallbackQueryHandler(handle_no_shortlists, pattern='^no_shortlists$'),
                 CallbackQueryHandler(done, pattern='^done$')
@@ -4037,11 +6335,14 @@ async def main() -> None:
 
 # Viewing shortlisted applicants convo handler
     view_shortlisted_handler = ConversationHandler(
+    name='view_shortlisted',
+    persistent=True,
     entry_points=[CommandHandler('view_shortlisted', view_shortlisted)],
     states={
         VIEW_JOBS: [
                 CallbackQueryHandler(handle_pagination, pattern=r"^page_\d+$"),
                 CallbackQueryHandler(view_applicants, pattern='view_applicants_'),
+                CallbackQueryHandler(browse_shortlisted, pattern=r'^shortlisted_\d+$'),
                 CallbackQueryHandler(cancel_view_shortlisted, pattern='^cancel_view_shortlisted')]
     },
     fallbacks=[CallbackQueryHandler(cancel_view_shortlisted, pattern='^cancel_view_shortlisted')],
@@ -4052,7 +6353,8 @@ async def main() -> None:
     # CallbackQueryHandlers
     application.add_handler(CallbackQueryHandler(delete_button, pattern='^delete\\|'))
     # application.add_handler(CallbackQueryHandler(register_button, pattern='^(applicant|agency)$'))
-    application.add_handler(CallbackQueryHandler(get_admin_acknowledgement, pattern='^(ss_|jp_)(accept|reject)_\d+$'))
+    application.add_handler(CallbackQueryHandler(get_admin_acknowledgement, pattern=ADMIN_ACK_PATTERN))
+    application.add_handler(CallbackQueryHandler(pending_button, pattern=PENDING_PATTERN))
     application.add_handler(CallbackQueryHandler(select_applicant_apply, pattern="^ja_\d+_[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}"))
     application.add_handler(CallbackQueryHandler(apply_button_handler, pattern='^apply_\d+$'))
     application.add_handler(CallbackQueryHandler(view_button_handler, pattern='^view_(agency|applicant)_(.+)$'))
@@ -4063,64 +6365,50 @@ async def main() -> None:
 
     # Misc
     application.add_handler(TypeHandler(type=WebhookUpdate, callback=webhook_update))
+    # Before every other group, so that the ConversationHandlers see the states other instances have written
+    application.add_handler(TypeHandler(type=Update, callback=application.persistence.refresh), group=-1)
     
     # Error Handlers
     application.add_error_handler(global_error_handler)
 
+    # Get the bot and the database ready together, the webhook is only registered once the pool is warm
+    startup_start = time.perf_counter()
+    await asyncio.gather(
+        log_startup_phase("bulk bot initialize", bulk_bot.initialize()),
+        log_startup_phase("database", prepare_database()),
+    )
+    # Only once the migrations are done, persistence reads and writes their tables
+    await log_startup_phase("application initialize", application.initialize())
+
     # Pass webhook settings to telegram
-    await application.bot.set_webhook(url=f"{URL}/telegram", allowed_updates=Update.ALL_TYPES)
+    await log_startup_phase(
+        "webhook registration",
+        application.bot.set_webhook(url=f"{URL}/telegram", allowed_updates=Update.ALL_TYPES, secret_token=WEBHOOK_SECRET_TOKEN),
+    )
+    logger.info("Startup: ready to receive updates after %.0fms", (time.perf_counter() - startup_start) * 1000)
 
     # Set up webserver
-    flask_app = Flask(__name__)
-
-    # Flask app routes
-    @flask_app.post("/telegram")  # type: ignore[misc]
-    async def telegram() -> Response:
-        logger.info(f"MESSAGE RECEIVED: {request.json}")
-        """Handle incoming Telegram updates by putting them into the `update_queue`"""
-        await application.update_queue.put(Update.de_json(data=request.json, bot=application.bot))
-        return Response(status=HTTPStatus.OK)
-
-    @flask_app.route("/submitpayload", methods=["GET", "POST"])  # type: ignore[misc]
-    async def custom_updates() -> Response:
-        """
-        Handle incoming webhook updates by also putting them into the `update_queue` if
-        the required parameters were passed correctly.
-        """
-        try:
-            user_id = int(request.args["user_id"])
-            payload = request.args["payload"]
-        except KeyError:
-            abort(
-                HTTPStatus.BAD_REQUEST,
-                "Please pass both `user_id` and `payload` as query parameters.",
-            )
-        except ValueError:
-            abort(HTTPStatus.BAD_REQUEST, "The `user_id` must be a string!")
-
-        await application.update_queue.put(WebhookUpdate(user_id=user_id, payload=payload))
-        return Response(status=HTTPStatus.OK)
-
-    @flask_app.get("/healthcheck")  # type: ignore[misc]
-    async def health() -> Response:
-        """For the health endpoint, reply with a simple plain text message."""
-        response = make_response("The bot is still running fine :)", HTTPStatus.OK)
-        response.mimetype = "text/plain"
-        return response
-
     webserver = uvicorn.Server(
         config=uvicorn.Config(
-            app=WsgiToAsgi(flask_app),
+            app=WebhookServer(application),
             port=PORT,
             use_colors=False,
             host="0.0.0.0",
+            log_config=None, # uvicorn logs go through the root logger's queue like everything else
+            access_log=LOG_ACCESS,
         )
     )
     loop = asyncio.get_event_loop()
-    schedule.every().day.at("00:00").do(lambda: asyncio.run_coroutine_threadsafe(daily_checks(application.bot), loop))
+    # Only the instance holding the scheduler lease runs the jobs, see ScheduledJobs
+    scheduled_jobs = ScheduledJobs()
+    scheduled_jobs.add("daily_checks", daily_checks, bulk_bot, at="00:00")
+    schedule.every().day.at("00:00").do(lambda: loop.call_soon_threadsafe(scheduled_jobs.start, "daily_checks"))
 
     # Create the asyncio task for running the schedule
     schedule_task = loop.create_task(run_schedule())
+    heartbeat_task = loop.create_task(scheduled_jobs.heartbeat())
+    # Notifications queued by notify() go out on the bulk bot, so they do not take connections from replies
+    outbox_task = loop.create_task(outbox_sender.run(bulk_bot))
     
     # Run application and webserver together
     async with application:
@@ -4128,6 +6416,11 @@ async def main() -> None:
         await webserver.serve()
         await application.stop()
 
+    heartbeat_task.cancel()
+    outbox_task.cancel() # Anything still queued is sent by another instance, or by this one after a restart
+    await scheduled_jobs.release()
+    await bulk_bot.shutdown()
+
     await schedule_task
     
 
@@ -0,0 +1,86 @@
+import os
+import random
+import sys
+import unittest
+
+os.environ.setdefault('CLOUD_URL', 'https://example.com')
+os.environ.setdefault('BOT_TOKEN', '1:test')
+os.environ.setdefault('DB_USER', 'user')
+os.environ.setdefault('DB_PASS', 'password')
+os.environ.setdefault('DB_NAME', 'test')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import orjson
+
+import main
+
+# Strings with everything that could be mistaken for structure
+RECORDS = [
+    {"user_id": 1, "payload": "plain"},
+    {"user_id": 2, "payload": 'quote " and backslash \\ and \\" together'},
+    {"user_id": 3, "payload": "brackets ] } [ { and commas , , inside"},
+    {"user_id": 4, "payload": "line\nbreak and tab\t and unicode é中"},
+    {"user_id": 5, "payload": {"nested": [1, [2, {"a": "]"}], {}], "empty": ""}},
+    {"user_id": 6, "payload": "ends with a backslash \\"},
+]
+
+
+def split_randomly(body: bytes, rng: random.Random) -> list:
+    chunks = []
+    while body:
+        size = rng.randint(1, 16)
+        chunks.append(body[:size])
+        body = body[size:]
+    return chunks
+
+
+def split_records(chunks: list, max_record_bytes: int = main.MAX_REQUEST_BODY_BYTES) -> list:
+    splitter = main.JSONRecordSplitter(max_record_bytes)
+    records = []
+    for chunk in chunks:
+        records += splitter.feed(chunk)
+    return [orjson.loads(record) for record in records + splitter.finish()]
+
+
+class JSONRecordSplitterTest(unittest.TestCase):
+
+    def test_array_with_random_chunk_boundaries(self):
+        rng = random.Random(18)
+        body = b'  \n[ ' + b' ,\n '.join(orjson.dumps(record) for record in RECORDS) + b' ]\n'
+        for _ in range(200):
+            self.assertEqual(split_records(split_randomly(body, rng)), RECORDS)
+
+    def test_ndjson_with_random_chunk_boundaries(self):
+        rng = random.Random(18)
+        body = b'\n'.join(orjson.dumps(record) for record in RECORDS) + b'\n\n'
+        for _ in range(200):
+            self.assertEqual(split_records(split_randomly(body, rng)), RECORDS)
+
+    def test_last_ndjson_line_without_newline(self):
+        self.assertEqual(split_records([b'{"user_id": 1}\n{"user_id"', b': 2}']), [{"user_id": 1}, {"user_id": 2}])
+
+    def test_records_are_returned_as_soon_as_they_are_complete(self):
+        splitter = main.JSONRecordSplitter()
+        self.assertEqual(splitter.feed(b'[{"user_id": 1}, {"user_'), [b'{"user_id": 1}'])
+        self.assertEqual(splitter.feed(b'id": 2}]'), [b'{"user_id": 2}'])
+        self.assertEqual(splitter.finish(), [])
+
+    def test_empty_bodies(self):
+        self.assertEqual(split_records([b'[', b' ]']), [])
+        self.assertEqual(split_records([b' \n ']), [])
+
+    def test_unterminated_array(self):
+        splitter = main.JSONRecordSplitter()
+        splitter.feed(b'[{"user_id": 1}, {"user_id": 2')
+        with self.assertRaises(ValueError):
+            splitter.finish()
+
+    def test_oversized_record(self):
+        splitter = main.JSONRecordSplitter(max_record_bytes=32)
+        self.assertEqual(splitter.feed(b'[{"user_id": 1}, '), [b'{"user_id": 1}'])
+        with self.assertRaises(ValueError):
+            splitter.feed(b'{"user_id": 2, "payload": "' + b'x' * 40)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,176 @@
+import os
+import sys
+import time
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+os.environ.setdefault('CLOUD_URL', 'https://example.com')
+os.environ.setdefault('BOT_TOKEN', '1:test')
+os.environ.setdefault('DB_USER', 'user')
+os.environ.setdefault('DB_PASS', 'password')
+os.environ.setdefault('DB_NAME', 'test')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+class FakeResult:
+    def __init__(self, rows, rowcount):
+        self.rows = rows
+        self.rowcount = rowcount
+
+    def all(self):
+        return self.rows
+
+    def one(self):
+        return self.rows[0]
+
+
+class FakeConnection:
+    """Pooled connection, awaited inside a unit of work and used as a context manager outside of one"""
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def __await__(self):
+        yield from []
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def execute(self, statement, params=None):
+        name = main.query_name(statement)
+        self.engine.log.append(('execute', name, params))
+        if name in self.engine.fail_on:
+            raise RuntimeError(f"{name} failed")
+        rows = self.engine.rows.get(name, [])
+        return FakeResult(rows, self.engine.rowcounts.get(name, len(rows)))
+
+    async def commit(self):
+        self.engine.log.append(('commit',))
+
+    async def rollback(self):
+        self.engine.log.append(('rollback',))
+
+    async def close(self):
+        pass
+
+
+class FakeEngine:
+    """Stands in for the pool, answering registered statements with the rows (and rowcount) given for their name"""
+
+    def __init__(self, rows: dict = None, rowcounts: dict = None, fail_on: tuple = ()):
+        self.rows = rows or {}
+        self.rowcounts = rowcounts or {}
+        self.fail_on = fail_on
+        self.log = []
+
+    def connect(self):
+        return FakeConnection(self)
+
+    def executed(self, name: str) -> list:
+        return [entry[2] for entry in self.log if entry[0] == 'execute' and entry[1] == name]
+
+
+class DailyChecksTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.pools = (main.async_pool, main.read_pool)
+        self.bot = mock.AsyncMock()
+        patch = mock.patch.object(main, 'send_daily_digest', mock.AsyncMock())
+        self.digest = patch.start()
+        self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        main.async_pool, main.read_pool = self.pools
+
+    def use_engine(self, **kwargs) -> FakeEngine:
+        engine = FakeEngine(**kwargs)
+        main.async_pool = main.read_pool = engine
+        return engine
+
+    def due_subscription(self) -> dict:
+        last_distribution = datetime.now() - timedelta(days=40)
+        return {
+            'subscription_balance.active': [(7, 100, last_distribution, datetime.now() + timedelta(days=60), last_distribution, 'sub_1')],
+            'subscription_packages.details': [("Monthly", 30, 3, 100)],
+            'token_balance.get': [(30, datetime.now() + timedelta(days=30))],
+        }
+
+    async def test_allocates_due_subscription(self):
+        engine = self.use_engine(rows=self.due_subscription(), rowcounts={'subscription_balance.claim_distribution': 1})
+        await main.daily_checks(self.bot)
+
+        self.assertEqual(len(engine.executed('token_balance.credit')), 1)
+        # The claim and the credit are committed together
+        claim = engine.log.index(('execute', 'subscription_balance.claim_distribution', engine.executed('subscription_balance.claim_distribution')[0]))
+        self.assertEqual([entry[0] for entry in engine.log[claim:]], ['execute', 'execute', 'execute', 'commit'])
+        self.assertEqual(self.bot.send_message.await_count, 1)
+
+    async def test_rerun_does_not_allocate_twice(self):
+        # An earlier run already moved last_distribution on, so the claim matches no row
+        engine = self.use_engine(rows=self.due_subscription(), rowcounts={'subscription_balance.claim_distribution': 0})
+        await main.daily_checks(self.bot)
+
+        self.assertEqual(engine.executed('token_balance.credit'), [])
+        self.bot.send_message.assert_not_awaited()
+
+    async def test_rerun_does_not_remove_topped_up_tokens(self):
+        engine = self.use_engine(rows={'token_balance.expired': [(100, 20)]}, rowcounts={'token_balance.delete_expired': 0})
+        await main.daily_checks(self.bot)
+
+        self.assertEqual(len(engine.executed('token_balance.delete_expired')), 1)
+        self.bot.send_message.assert_not_awaited()
+        expiries = self.digest.await_args.args[1]
+        self.assertEqual(expiries, [])
+
+    async def test_failed_step_raises_after_the_rest(self):
+        rows = self.due_subscription()
+        rows['token_balance.expired'] = [(200, 20)]
+        engine = self.use_engine(rows=rows, rowcounts={'subscription_balance.claim_distribution': 1}, fail_on=('token_balance.delete_expired',))
+        with self.assertRaises(RuntimeError):
+            await main.daily_checks(self.bot)
+
+        # The subscriptions are still handled, and their notices and the digest still go out
+        self.assertEqual(len(engine.executed('token_balance.credit')), 1)
+        self.assertEqual(self.bot.send_message.await_count, 1)
+        self.digest.assert_awaited_once()
+
+
+class ScheduledJobsTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.pools = (main.async_pool, main.read_pool)
+        self.engine = FakeEngine(rowcounts={'scheduled_job_runs.claim': 1})
+        main.async_pool = main.read_pool = self.engine
+        self.scheduled_jobs = main.ScheduledJobs(holder="test")
+        self.scheduled_jobs.leader_until = time.monotonic() + 60
+
+    def tearDown(self):
+        main.async_pool, main.read_pool = self.pools
+
+    async def test_failed_run_releases_its_claim(self):
+        self.scheduled_jobs.add("job", mock.AsyncMock(side_effect=RuntimeError("failed")))
+        with self.assertLogs("main", "ERROR"):
+            await self.scheduled_jobs.run("job")
+
+        self.assertEqual(len(self.engine.executed('scheduled_job_runs.release')), 1)
+        self.assertEqual(self.engine.executed('scheduled_job_runs.finish'), [])
+
+    async def test_successful_run_is_finished(self):
+        job = mock.AsyncMock()
+        self.scheduled_jobs.add("job", job, "argument")
+        await self.scheduled_jobs.run("job")
+
+        job.assert_awaited_once_with("argument")
+        self.assertEqual(len(self.engine.executed('scheduled_job_runs.finish')), 1)
+        self.assertEqual(self.engine.executed('scheduled_job_runs.release'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
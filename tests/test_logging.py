@@ -0,0 +1,45 @@
+import logging
+import os
+import queue
+import sys
+import unittest
+
+os.environ.setdefault('CLOUD_URL', 'https://example.com')
+os.environ.setdefault('BOT_TOKEN', '1:test')
+os.environ.setdefault('DB_USER', 'user')
+os.environ.setdefault('DB_PASS', 'password')
+os.environ.setdefault('DB_NAME', 'test')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+class NonBlockingQueueHandlerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = queue.Queue(1)
+        self.handler = main.NonBlockingQueueHandler(self.queue)
+        self.logger = logging.getLogger("test.logging")
+        self.logger.propagate = False
+        self.logger.addHandler(self.handler)
+        self.addCleanup(self.logger.removeHandler, self.handler)
+
+    def test_mutable_args_are_rendered_as_logged(self):
+        params = {"chat_id": 1}
+        self.logger.warning("Executing %s with params: %s (%d rows)", "token_balance.get", params, 2)
+        params["chat_id"] = 2
+
+        record = self.queue.get_nowait()
+        self.assertEqual(record.args, ("token_balance.get", "{'chat_id': 1}", 2))
+        self.assertEqual(main.StructuredFormatter(json_output=False).redacted_message(record), "Executing token_balance.get with params: {'chat_id': 1} (2 rows)")
+
+    def test_full_queue_drops_records(self):
+        self.logger.warning("first")
+        self.logger.warning("second")
+
+        self.assertEqual(self.queue.get_nowait().msg, "first")
+        self.assertEqual(self.handler.dropped, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
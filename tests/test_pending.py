@@ -0,0 +1,164 @@
+import os
+import sys
+import unittest
+from unittest import mock
+
+os.environ.setdefault('CLOUD_URL', 'https://example.com')
+os.environ.setdefault('BOT_TOKEN', '1:test')
+os.environ.setdefault('DB_USER', 'user')
+os.environ.setdefault('DB_PASS', 'password')
+os.environ.setdefault('DB_NAME', 'test')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+class FakeResult:
+    def __init__(self, rows):
+        self.rows = rows
+        self.rowcount = len(rows)
+
+    def all(self):
+        return self.rows
+
+    def fetchall(self):
+        return self.rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+
+class FakeSavepoint:
+    def __init__(self, engine):
+        self.engine = engine
+
+    async def commit(self):
+        self.engine.log.append(('release savepoint',))
+
+    async def rollback(self):
+        self.engine.log.append(('rollback to savepoint',))
+
+
+class FakeConnection:
+    def __init__(self, engine):
+        self.engine = engine
+
+    async def execute(self, statement, params=None):
+        name = main.query_name(statement)
+        self.engine.log.append(('execute', name, params))
+        if name in self.engine.fail_on:
+            raise RuntimeError(f"{name} failed")
+        return FakeResult(self.engine.rows.get(name, []))
+
+    async def begin_nested(self):
+        self.engine.log.append(('savepoint',))
+        return FakeSavepoint(self.engine)
+
+    async def commit(self):
+        self.engine.log.append(('commit',))
+
+    async def rollback(self):
+        self.engine.log.append(('rollback',))
+
+    async def close(self):
+        self.engine.log.append(('close',))
+
+
+class FakeEngine:
+    """Stands in for the pool, answering registered statements with the rows given for their name"""
+
+    def __init__(self, rows: dict, fail_on: tuple = ()):
+        self.rows = rows
+        self.fail_on = fail_on
+        self.log = []
+        self.connections = 0
+
+    async def connect(self):
+        self.connections += 1
+        return FakeConnection(self)
+
+    def executed(self, name: str) -> list:
+        return [entry[2] for entry in self.log if entry[0] == 'execute' and entry[1] == name]
+
+
+class DecidePendingTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.pools = (main.async_pool, main.read_pool)
+        patches = [
+            mock.patch.object(main, 'allocate_purchase', mock.AsyncMock(return_value="Your payment has been acknowledged by an admin!")),
+            mock.patch.object(main, 'draft_job_post_message', mock.AsyncMock(return_value="job post")),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        main.async_pool, main.read_pool = self.pools
+
+    def use_engine(self, **kwargs) -> FakeEngine:
+        engine = FakeEngine(**kwargs)
+        main.async_pool = main.read_pool = engine
+        return engine
+
+    async def test_approves_only_the_items_still_pending(self):
+        # ss_2 and jp_6 were handled elsewhere in the meantime, so the locking reads do not return them
+        engine = self.use_engine(rows={
+            'transactions.lock_pending': [(1, 100, 'p1')],
+            'job_posts.lock_pending': [(5, 'full', 200)],
+            'shortlist_balance.existing': [(200,)],
+        })
+        async with main.unit_of_work():
+            handled = await main.decide_pending(None, ["ss_1", "ss_2", "jp_5", "jp_6"], approve=True)
+
+        self.assertEqual(handled, 2)
+        self.assertEqual(engine.executed('transactions.lock_pending'), [{"transaction_ids": (1, 2)}])
+        self.assertEqual(engine.executed('transactions.set_status'), [[{"status": "Approved", "transaction_id": 1}]])
+        self.assertEqual(engine.executed('job_posts.set_status'), [[{"status": "Approved", "job_post_id": 5}]])
+        self.assertEqual(engine.executed('shortlist_balance.add'), [[{"chat_id": 200, "new_shortlists": 3}]])
+        self.assertEqual(engine.executed('shortlist_balance.insert'), [])
+        # The buyer's notice, the channel post and the agency's notice
+        self.assertEqual([params["chat_id"] for params in engine.executed('outbox.insert')], [100, main.CHANNEL_ID, 200])
+        # All on the update's own connection, committed once with it
+        self.assertEqual(engine.connections, 1)
+        self.assertEqual(engine.log[-3:], [('release savepoint',), ('commit',), ('close',)])
+
+    async def test_reject_refunds_job_posts(self):
+        engine = self.use_engine(rows={
+            'job_posts.lock_pending': [(5, 'full', 200), (7, 'part', 200)],
+        })
+        async with main.unit_of_work():
+            handled = await main.decide_pending(None, ["jp_5", "jp_7"], approve=False)
+
+        self.assertEqual(handled, 2)
+        self.assertEqual(engine.executed('job_posts.set_status'), [[
+            {"status": "Rejected", "job_post_id": 5}, {"status": "Rejected", "job_post_id": 7},
+        ]])
+        self.assertEqual(engine.executed('token_balance.refund'), [[{"tokens": main.JOB_POST_PRICE + main.PART_JOB_POST_PRICE, "chat_id": 200}]])
+        self.assertEqual(engine.executed('shortlist_balance.add'), [])
+
+    async def test_nothing_pending_changes_nothing(self):
+        engine = self.use_engine(rows={})
+        async with main.unit_of_work():
+            handled = await main.decide_pending(None, ["ss_1", "jp_5"], approve=True)
+
+        self.assertEqual(handled, 0)
+        self.assertEqual(engine.executed('transactions.set_status'), [])
+        self.assertEqual(engine.executed('job_posts.set_status'), [])
+        self.assertEqual(engine.executed('outbox.insert'), [])
+
+    async def test_failure_rolls_back_the_batch_only(self):
+        engine = self.use_engine(rows={'transactions.lock_pending': [(1, 100, 'p1')]}, fail_on=('outbox.insert',))
+        async with main.unit_of_work():
+            await main.safe_set_db("UPDATE user_data SET user_handle = 'a' WHERE chat_id = 1")
+            with self.assertRaises(RuntimeError):
+                await main.decide_pending(None, ["ss_1"], approve=True)
+
+        self.assertIn(('rollback to savepoint',), engine.log)
+        self.assertNotIn(('release savepoint',), engine.log)
+        # The update's own write before the batch is still committed
+        self.assertEqual(engine.log[-2:], [('commit',), ('close',)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,197 @@
+import os
+import sys
+import unittest
+from datetime import datetime
+
+os.environ.setdefault('CLOUD_URL', 'https://example.com')
+os.environ.setdefault('BOT_TOKEN', '1:test')
+os.environ.setdefault('DB_USER', 'user')
+os.environ.setdefault('DB_PASS', 'password')
+os.environ.setdefault('DB_NAME', 'test')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+from telegram import Chat, Message, MessageEntity, Update, User
+from telegram.ext import Application, CommandHandler, ConversationHandler, ExtBot, MessageHandler, TypeHandler, filters
+
+
+class FakeResult:
+    def __init__(self, rows, rowcount):
+        self.rows = rows
+        self.rowcount = rowcount
+
+    def all(self):
+        return self.rows
+
+    def first(self):
+        return self.rows[0] if self.rows else None
+
+
+class FakeConnection:
+    """Pooled connection, used as a context manager outside of a unit of work"""
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    async def execute(self, statement, params=None):
+        name = main.query_name(statement)
+        self.engine.log.append(('execute', name, params))
+        if self.engine.before_execute is not None:
+            self.engine.before_execute(name)
+        rows = self.engine.rows.get(name, [])
+        return FakeResult(rows, self.engine.rowcounts.get(name, len(rows)))
+
+    async def commit(self):
+        self.engine.log.append(('commit',))
+
+
+class FakeEngine:
+    """Stands in for the pool, answering registered statements with the rows (and rowcount) given for their name"""
+
+    def __init__(self, rows: dict = None, rowcounts: dict = None, before_execute=None):
+        self.rows = rows or {}
+        self.rowcounts = rowcounts or {}
+        self.before_execute = before_execute
+        self.log = []
+
+    def connect(self):
+        return FakeConnection(self)
+
+    def executed(self, name: str = None) -> list:
+        return [entry[2] for entry in self.log if entry[0] == 'execute' and name in (None, entry[1])]
+
+
+class OfflineBot(ExtBot):
+    """Bot that does not call getMe, so an Application can be initialized without network access"""
+
+    async def initialize(self):
+        pass
+
+
+async def step(update, context):
+    context.application.steps.append(update.message.text)
+
+
+async def stateless(update, context):
+    pass
+
+
+class PersistenceTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.pools = (main.async_pool, main.read_pool)
+        self.use_engine()
+        self.persistence = main.DBPersistence(stateless_callbacks={stateless})
+        self.application = Application.builder().bot(OfflineBot(os.environ['BOT_TOKEN'])).updater(None).persistence(self.persistence).build()
+        self.application.steps = []
+        self.application.add_handler(ConversationHandler(
+            entry_points=[CommandHandler("start", step)],
+            states={1: [MessageHandler(filters.TEXT & ~filters.COMMAND, step)]},
+            fallbacks=[],
+            name="flow",
+            persistent=True,
+        ))
+        self.application.add_handler(CommandHandler("help", stateless))
+        self.application.add_handler(TypeHandler(type=Update, callback=self.persistence.refresh), group=-1)
+        await self.application.initialize()
+
+    async def asyncTearDown(self):
+        main.async_pool, main.read_pool = self.pools
+
+    def use_engine(self, **kwargs) -> FakeEngine:
+        self.engine = FakeEngine(**kwargs)
+        main.async_pool = main.read_pool = self.engine
+        return self.engine
+
+    def update(self, text: str) -> Update:
+        user = User(id=5, first_name="user", is_bot=False)
+        entities = [MessageEntity(type=MessageEntity.BOT_COMMAND, offset=0, length=len(text))] if text.startswith("/") else []
+        message = Message(message_id=1, date=datetime.now(), chat=Chat(id=5, type=Chat.PRIVATE), from_user=user, text=text, entities=entities)
+        return Update(update_id=1, message=message)
+
+    async def test_loads_state_written_by_another_instance(self):
+        # Another instance has moved user 5 into state 1 of "flow", which only matches plain text from there on
+        self.use_engine(rows={
+            'persistence.versions': [(None, 2), ("flow", 3)],
+            'persistence_user_data.get': [(self.persistence.dumps({"step": "name"}), 2)],
+            'persistence_conversations.by_key': [("flow", "1", 3)],
+        })
+        await self.application.process_update(self.update("hello"))
+
+        # Fails if PTB changes how ConversationHandler keeps its states, which refresh_conversations sets directly
+        self.assertEqual(self.application.steps, ["hello"])
+        self.assertEqual(self.application.user_data[5], {"step": "name"})
+        self.assertEqual(self.persistence.known[5][1], 2)
+        self.assertEqual(self.persistence.known[("flow", (5, 5))][1], 3)
+
+        # What was loaded is not written back as a change of this instance's own
+        self.engine.log.clear()
+        await self.application.update_persistence()
+        await self.persistence.flush()
+        self.assertEqual(self.engine.log, [])
+
+    async def test_current_state_only_reads_versions(self):
+        self.persistence.remember(5, None, 2)
+        self.persistence.remember(("flow", (5, 5)), None, 3)
+        self.use_engine(rows={'persistence.versions': [(None, 2), ("flow", 3)]})
+        await self.application.process_update(self.update("hello"))
+
+        self.assertEqual(self.engine.executed(), [{"user_id": 5, "conversation_key": "[5,5]"}])
+
+    async def test_skips_updates_only_stateless_handlers_see(self):
+        await self.application.process_update(self.update("/help"))
+
+        self.assertEqual(self.engine.log, [])
+
+    async def test_conflicting_write_is_dropped(self):
+        # Another instance has written user 5 since this one saw version 3, so the conditional update matches no row
+        self.persistence.remember(5, hash(b"old"), 3)
+        self.use_engine(rowcounts={'persistence_user_data.update': 0})
+        await self.persistence.update_user_data(5, {"step": "name"})
+        await self.persistence.flush()
+
+        self.assertEqual([params["version"] for params in self.engine.executed('persistence_user_data.update')], [3])
+        self.assertEqual(self.persistence.conflicts, 1)
+        self.assertNotIn(5, self.persistence.known)
+        self.assertEqual(self.persistence.pending_user_data, {})
+
+    async def test_successful_write_is_remembered(self):
+        self.persistence.remember(5, hash(b"old"), 3)
+        self.use_engine(rowcounts={'persistence_user_data.update': 1, 'persistence_conversations.insert': 1})
+        await self.persistence.update_user_data(5, {"step": "name"})
+        await self.persistence.update_conversation("flow", (5, 5), 1)
+        await self.persistence.flush()
+
+        self.assertEqual(self.persistence.known[5][1], 4)
+        self.assertEqual(self.persistence.known[("flow", (5, 5))], (hash("1"), 1))
+        self.assertEqual(self.persistence.conflicts, 0)
+
+    async def test_failed_write_is_merged_into_the_next_batch(self):
+        persistence = self.persistence
+
+        def fail(name):
+            # user_data of user 5 changes again while the batch is being written
+            persistence.pending_user_data[5] = b"newer"
+            raise RuntimeError("connection lost")
+
+        self.use_engine(before_execute=fail)
+        await persistence.update_user_data(5, {"step": "name"})
+        await persistence.update_user_data(6, {"step": "dob"})
+        await persistence.update_conversation("flow", (6, 6), 1)
+        await persistence.flush()
+
+        # Newer state buffered in the meantime wins, the rest of the failed batch is written with the next one
+        self.assertEqual(persistence.pending_user_data[5], b"newer")
+        self.assertEqual(persistence.loads(persistence.pending_user_data[6]), {"step": "dob"})
+        self.assertEqual(persistence.pending_conversations, {("flow", (6, 6)): "1"})
+        self.assertNotIn(5, persistence.known)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+import asyncio
+import os
+import sys
+import types
+import unittest
+from unittest import mock
+
+os.environ.setdefault('CLOUD_URL', 'https://example.com')
+os.environ.setdefault('BOT_TOKEN', '1:test')
+os.environ.setdefault('DB_USER', 'user')
+os.environ.setdefault('DB_PASS', 'password')
+os.environ.setdefault('DB_NAME', 'test')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+from telegram.error import RetryAfter
+
+
+class Clock:
+    """Stands in for time.monotonic() and asyncio.sleep() in main, sleeping only moves the clock on"""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    async def sleep(self, delay: float):
+        self.sleeps.append(round(delay, 3))
+        self.now += delay
+        await asyncio.sleep(0)
+
+
+class ClockedAsyncio:
+    def __init__(self, clock: Clock):
+        self.sleep = clock.sleep
+
+    def __getattr__(self, name):
+        return getattr(asyncio, name)
+
+
+class ClockTestCase(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        for name, value in (('time', types.SimpleNamespace(monotonic=self.clock.monotonic)), ('asyncio', ClockedAsyncio(self.clock))):
+            patch = mock.patch.object(main, name, value)
+            patch.start()
+            self.addCleanup(patch.stop)
+
+
+class TokenBucketTest(ClockTestCase):
+
+    async def test_waits_for_tokens_once_the_burst_is_used(self):
+        bucket = main.TokenBucket(rate=2, capacity=2)
+        for _ in range(4):
+            await bucket.acquire()
+
+        self.assertEqual(self.clock.sleeps, [0.5, 0.5])
+        self.assertFalse(bucket.is_idle())
+        self.clock.now += 1
+        self.assertTrue(bucket.is_idle())
+
+    async def test_waiters_are_served_in_order(self):
+        bucket = main.TokenBucket(rate=1, capacity=1)
+        order = []
+
+        async def acquire(name):
+            await bucket.acquire()
+            order.append(name)
+
+        await asyncio.gather(*(acquire(name) for name in "abc"))
+        self.assertEqual(order, ["a", "b", "c"])
+        self.assertEqual(self.clock.sleeps, [1, 1])
+
+
+class SendSchedulerTest(ClockTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.scheduler = main.SendScheduler()
+
+    async def send(self, callback, chat_id=1, endpoint="sendMessage", rate_limit_args=None):
+        data = {} if chat_id is None else {"chat_id": chat_id}
+        return await self.scheduler.process_request(callback, (), {}, endpoint, data, rate_limit_args)
+
+    async def test_retry_after_is_waited_out_with_backoff(self):
+        callback = mock.AsyncMock(side_effect=[RetryAfter(2), RetryAfter(2), "sent"])
+
+        self.assertEqual(await self.send(callback), "sent")
+        # retry_after, then twice retry_after on the second attempt
+        self.assertEqual(self.clock.sleeps, [2, 4])
+        self.assertEqual(self.scheduler.stats() | {"chats": 0}, {"waiting": 0, "sending": 0, "paused_for": 0, "rate_limited": 2, "failed": 0, "chats": 0})
+
+    async def test_gives_up_after_the_retries(self):
+        callback = mock.AsyncMock(side_effect=RetryAfter(1))
+
+        with self.assertRaises(RetryAfter), self.assertLogs("main", "ERROR"):
+            await self.send(callback, rate_limit_args=1)
+        self.assertEqual(callback.await_count, 2)
+        self.assertEqual(self.scheduler.failed, 1)
+
+    async def test_retry_after_pauses_other_chats(self):
+        self.scheduler.resume_at = self.clock.now + 3
+        await self.send(mock.AsyncMock(), chat_id=2)
+
+        self.assertEqual(self.clock.sleeps, [3])
+
+    async def test_private_chat_is_limited_after_its_burst(self):
+        for _ in range(main.SEND_CHAT_BURST + 1):
+            await self.send(mock.AsyncMock())
+
+        self.assertEqual(self.clock.sleeps, [1 / main.SEND_CHAT_PER_SECOND])
+
+    async def test_edits_have_a_bucket_of_their_own(self):
+        for _ in range(main.SEND_CHAT_BURST):
+            await self.send(mock.AsyncMock())
+        # The chat's message bucket is empty, the edits of a browsing user still go straight through
+        for _ in range(main.SEND_EDIT_BURST):
+            await self.send(mock.AsyncMock(), endpoint="editMessageText")
+        self.assertEqual(self.clock.sleeps, [])
+
+        await self.send(mock.AsyncMock(), endpoint="editMessageReplyMarkup")
+        self.assertEqual(self.clock.sleeps, [round(1 / main.SEND_EDIT_PER_SECOND, 3)])
+
+    async def test_group_is_limited_per_minute(self):
+        for _ in range(main.SEND_CHAT_BURST + 1):
+            await self.send(mock.AsyncMock(), chat_id=-100)
+
+        self.assertEqual(self.clock.sleeps, [round(60 / main.SEND_GROUP_PER_MINUTE, 3)])
+
+    async def test_requests_without_chat_are_not_limited(self):
+        callback = mock.AsyncMock(return_value="me")
+
+        self.assertEqual(await self.send(callback, chat_id=None, endpoint="getMe"), "me")
+        self.assertEqual(self.scheduler.chat_buckets, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+import asyncio
+import os
+import sys
+import unittest
+
+os.environ.setdefault('CLOUD_URL', 'https://example.com')
+os.environ.setdefault('BOT_TOKEN', '1:test')
+os.environ.setdefault('DB_USER', 'user')
+os.environ.setdefault('DB_PASS', 'password')
+os.environ.setdefault('DB_NAME', 'test')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+from telegram.ext import Application, ExtBot, TypeHandler
+
+
+class FakeConnection:
+    def __init__(self, engine):
+        self.engine = engine
+
+    async def execute(self, statement, params=None):
+        self.engine.log.append(('execute', str(statement)))
+
+    async def commit(self):
+        self.engine.log.append(('commit',))
+
+    async def rollback(self):
+        self.engine.log.append(('rollback',))
+
+    async def close(self):
+        self.engine.log.append(('close',))
+
+
+class FakeEngine:
+    """Stands in for the pool, recording what the unit of work does with its connection"""
+
+    def __init__(self):
+        self.log = []
+
+    async def connect(self):
+        return FakeConnection(self)
+
+
+class OfflineBot(ExtBot):
+    """Bot that does not call getMe, so an Application can be initialized without network access"""
+
+    async def initialize(self):
+        pass
+
+
+class UnitOfWorkTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.engine = FakeEngine()
+        self.pools = (main.async_pool, main.read_pool)
+        main.async_pool = main.read_pool = self.engine
+
+    def tearDown(self):
+        main.async_pool, main.read_pool = self.pools
+
+    async def process(self, handler) -> None:
+        application = (
+            Application.builder().bot(OfflineBot(os.environ['BOT_TOKEN'])).updater(None)
+            .concurrent_updates(main.UnitOfWorkUpdateProcessor(max_concurrent_updates=1)).build()
+        )
+        await application.initialize()
+        application.add_handler(TypeHandler(type=str, callback=handler))
+        application.add_error_handler(main.global_error_handler)
+        await application.update_processor.process_update("update", application.process_update("update"))
+
+    async def test_failing_handler_commits_nothing(self):
+        async def handler(update, context):
+            await main.safe_set_db("UPDATE token_balance SET tokens = tokens - 70 WHERE chat_id = 1")
+            raise RuntimeError("handler failed after its first write")
+
+        await self.process(handler)
+        self.assertIn(('execute', "UPDATE token_balance SET tokens = tokens - 70 WHERE chat_id = 1"), self.engine.log)
+        self.assertIn(('rollback',), self.engine.log)
+        self.assertNotIn(('commit',), self.engine.log)
+
+    async def test_successful_handler_commits(self):
+        async def handler(update, context):
+            await main.safe_set_db("UPDATE token_balance SET tokens = tokens - 70 WHERE chat_id = 1")
+
+        await self.process(handler)
+        self.assertEqual(self.engine.log[-2:], [('commit',), ('close',)])
+        self.assertNotIn(('rollback',), self.engine.log)
+
+    async def test_writes_are_committed_before_sending(self):
+        async with main.unit_of_work():
+            await main.safe_set_db("UPDATE token_balance SET tokens = tokens - 70 WHERE chat_id = 1")
+            await main.commit_before_sending()
+            self.assertEqual(self.engine.log[-1], ('commit',))
+            main.fail_unit_of_work()
+        # Only what was written after the checkpoint is rolled back
+        self.assertEqual(self.engine.log.count(('commit',)), 1)
+        self.assertIn(('rollback',), self.engine.log)
+
+
+if __name__ == '__main__':
+    unittest.main()
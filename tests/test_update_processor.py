@@ -0,0 +1,135 @@
+import asyncio
+import os
+import sys
+import unittest
+from datetime import datetime
+
+os.environ.setdefault('CLOUD_URL', 'https://example.com')
+os.environ.setdefault('BOT_TOKEN', '1:test')
+os.environ.setdefault('DB_USER', 'user')
+os.environ.setdefault('DB_PASS', 'password')
+os.environ.setdefault('DB_NAME', 'test')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+from telegram import CallbackQuery, Chat, Message, PhotoSize, Update, User
+
+
+def message_update(update_id: int, chat_id: int) -> Update:
+    chat = Chat(id=chat_id, type=Chat.PRIVATE)
+    message = Message(message_id=update_id, date=datetime.now(), chat=chat, from_user=User(id=chat_id, first_name="user", is_bot=False), text="text")
+    return Update(update_id=update_id, message=message)
+
+
+class PrioritySlotsTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_freed_slot_goes_to_priority_waiters_first(self):
+        slots = main.PrioritySlots(1)
+        await slots.acquire()
+        order = []
+
+        async def wait(name, priority):
+            async with slots.slot(priority):
+                order.append(name)
+
+        tasks = [asyncio.create_task(wait("normal", False)), asyncio.create_task(wait("priority", True))]
+        await asyncio.sleep(0)
+        self.assertEqual((slots.waiting(True), slots.waiting(False)), (1, 1))
+
+        slots.release()
+        await asyncio.gather(*tasks)
+        self.assertEqual(order, ["priority", "normal"])
+        self.assertEqual(slots.free, 1)
+
+    async def test_cancelled_waiter_does_not_keep_a_slot(self):
+        slots = main.PrioritySlots(1)
+        await slots.acquire()
+        waiter = asyncio.create_task(slots.acquire())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiter
+
+        slots.release()
+        self.assertEqual(slots.free, 1)
+
+    async def test_slot_handed_over_to_a_cancelled_waiter_is_passed_on(self):
+        slots = main.PrioritySlots(1)
+        await slots.acquire()
+        waiter = asyncio.create_task(slots.acquire())
+        await asyncio.sleep(0)
+        slots.release() # hands the slot to the waiter, which is cancelled before it runs
+        waiter.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiter
+
+        self.assertEqual(slots.free, 1)
+
+
+class ChatOrderedUpdateProcessorTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.processor = main.ChatOrderedUpdateProcessor(max_concurrent_updates=2, queue_limit=10, priority_queue_limit=2)
+        self.handled = []
+
+    async def handle(self, update: Update, delay: float = 0, until: asyncio.Event = None):
+        if until is not None:
+            await until.wait()
+        await asyncio.sleep(delay)
+        self.handled.append(update.update_id)
+
+    def process(self, update: Update, **kwargs) -> asyncio.Task:
+        return asyncio.create_task(self.processor.process_update(update, self.handle(update, **kwargs)))
+
+    async def test_same_chat_is_processed_in_order(self):
+        # Later updates finish sooner, but each waits for the previous one of its chat
+        tasks = [self.process(message_update(update_id, 1), delay=delay) for update_id, delay in ((1, 0.03), (2, 0.01), (3, 0))]
+        await asyncio.gather(*tasks)
+
+        self.assertEqual(self.handled, [1, 2, 3])
+        self.assertEqual(self.processor.chat_locks, {})
+
+    async def test_busy_chat_does_not_hold_up_other_chats(self):
+        release = asyncio.Event()
+        # Chat 1 takes one of the two slots, its next updates wait for it without taking the other slot
+        busy = [self.process(message_update(update_id, 1), until=release) for update_id in (1, 2, 3)]
+        other = self.process(message_update(4, 2))
+        await asyncio.wait_for(other, 1)
+
+        self.assertEqual(self.handled, [4])
+        self.assertEqual(self.processor.stats()["busy_chats"], 1)
+        self.assertEqual(self.processor.slots.free, 1)
+
+        release.set()
+        await asyncio.gather(*busy)
+        self.assertEqual(self.handled, [4, 1, 2, 3])
+        self.assertEqual(self.processor.slots.free, 2)
+
+    async def test_updates_without_chat_are_not_ordered(self):
+        release = asyncio.Event()
+        blocked = self.process(Update(update_id=1), until=release)
+        await asyncio.wait_for(self.process(Update(update_id=2)), 1)
+
+        self.assertEqual(self.handled, [2])
+        release.set()
+        await blocked
+        self.assertEqual(self.processor.chat_locks, {})
+
+    async def test_lanes_are_bounded_separately(self):
+        photo = Message(message_id=1, date=datetime.now(), chat=Chat(id=1, type=Chat.PRIVATE), photo=[PhotoSize("file", "unique", 1, 1)])
+        admin_ack = CallbackQuery(id="1", from_user=User(id=1, first_name="admin", is_bot=False), chat_instance="1", data="ss_accept_1")
+        priority = [Update(update_id=1, message=photo), Update(update_id=2, callback_query=admin_ack), Update(update_id=3, message=photo)]
+        self.assertTrue(all(self.processor.is_priority(update) for update in priority))
+
+        self.assertEqual([self.processor.admit(update) for update in priority], [True, True, False])
+        # The normal lane is not affected by the full priority lane
+        self.assertTrue(self.processor.admit(message_update(4, 1)))
+        self.assertEqual(self.processor.rejected, {True: 1, False: 0})
+
+        await self.processor.process_update(priority[0], self.handle(priority[0]))
+        self.assertEqual(self.processor.in_flight, {True: 1, False: 1})
+        self.assertTrue(self.processor.admit(priority[2]))
+
+
+if __name__ == '__main__':
+    unittest.main()
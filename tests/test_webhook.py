@@ -0,0 +1,143 @@
+import os
+import sys
+import unittest
+from http import HTTPStatus
+from unittest import mock
+
+os.environ.setdefault('CLOUD_URL', 'https://example.com')
+os.environ.setdefault('BOT_TOKEN', '1:test')
+os.environ.setdefault('DB_USER', 'user')
+os.environ.setdefault('DB_PASS', 'password')
+os.environ.setdefault('DB_NAME', 'test')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import orjson
+
+import main
+from telegram.ext import Application, ExtBot
+
+
+class FakeResult:
+    def __init__(self, rowcount):
+        self.rowcount = rowcount
+
+
+class FakeConnection:
+    """Pooled connection, used as a context manager outside of a unit of work"""
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    async def execute(self, statement, params=None):
+        name = main.query_name(statement)
+        self.engine.log.append((name, params))
+        return FakeResult(self.engine.rowcounts.get(name, 1))
+
+    async def commit(self):
+        pass
+
+
+class FakeEngine:
+    """Stands in for the pool, answering registered statements with the rowcount given for their name"""
+
+    def __init__(self, rowcounts: dict = None):
+        self.rowcounts = rowcounts or {}
+        self.log = []
+
+    def connect(self):
+        return FakeConnection(self)
+
+
+class UpdateDeduplicatorTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_redelivery_is_dropped(self):
+        deduplicator = main.UpdateDeduplicator(size=10, use_db=False)
+
+        self.assertEqual([await deduplicator.claim(update_id) for update_id in (1, 2, 1)], [True, True, False])
+        self.assertEqual(deduplicator.duplicates, 1)
+
+    async def test_least_recently_seen_is_forgotten(self):
+        deduplicator = main.UpdateDeduplicator(size=2, use_db=False)
+        await deduplicator.claim(1)
+        await deduplicator.claim(2)
+        await deduplicator.claim(1) # seen again, so 2 is now the oldest
+        await deduplicator.claim(3)
+
+        self.assertEqual(list(deduplicator.seen), [1, 3])
+        self.assertTrue(await deduplicator.claim(2))
+
+    async def test_update_claimed_by_another_instance_is_dropped(self):
+        pools = (main.async_pool, main.read_pool)
+        self.addCleanup(setattr, main, 'read_pool', pools[1])
+        self.addCleanup(setattr, main, 'async_pool', pools[0])
+        main.async_pool = main.read_pool = engine = FakeEngine(rowcounts={'processed_updates.claim': 0})
+        deduplicator = main.UpdateDeduplicator(size=10, use_db=True)
+
+        self.assertFalse(await deduplicator.claim(1))
+        self.assertEqual(engine.log, [('processed_updates.claim', {"update_id": 1})])
+        self.assertNotIn(1, deduplicator.seen)
+
+
+class OfflineBot(ExtBot):
+    """Bot that does not call getMe, so an Application can be built without network access"""
+
+    async def initialize(self):
+        pass
+
+
+class WebhookTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.processor = main.ChatOrderedUpdateProcessor(max_concurrent_updates=1, queue_limit=1, priority_queue_limit=1)
+        application = Application.builder().bot(OfflineBot(os.environ['BOT_TOKEN'])).updater(None).concurrent_updates(self.processor).build()
+        self.server = main.WebhookServer(application)
+        self.server.deduplicator = main.UpdateDeduplicator(size=10, use_db=False)
+        patch = mock.patch.object(main, 'WEBHOOK_SECRET_TOKEN', "secret-token")
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    async def post(self, update_id: int, secret: str = "secret-token") -> main.HTTPResponse:
+        body = orjson.dumps({"update_id": update_id, "message": {
+            "message_id": update_id, "date": 0, "chat": {"id": update_id, "type": "private"}, "text": "text",
+        }})
+        messages = iter([{"type": "http.request", "body": body, "more_body": False}])
+
+        async def receive():
+            return next(messages)
+
+        scope = {"type": "http", "method": "POST", "path": "/telegram", "headers": [(b"x-telegram-bot-api-secret-token", secret.encode())]}
+        return await self.server.telegram(main.HTTPRequest(scope, receive))
+
+    async def test_update_refused_with_503_is_accepted_when_redelivered(self):
+        self.assertEqual((await self.post(1)).status, HTTPStatus.OK)
+        # The normal lane holds one update, so the next one is refused and must not count as seen
+        self.assertEqual((await self.post(2)).status, HTTPStatus.SERVICE_UNAVAILABLE)
+        self.assertNotIn(2, self.server.deduplicator.seen)
+
+        self.processor.in_flight[False] -= 1 # update 1 has been processed
+        self.assertEqual((await self.post(2)).status, HTTPStatus.OK)
+        self.assertEqual(self.server.deduplicator.duplicates, 0)
+        self.assertEqual(self.server.application.update_queue.qsize(), 2)
+
+    async def test_duplicate_is_answered_but_not_queued(self):
+        await self.post(1)
+        self.processor.in_flight[False] -= 1
+
+        self.assertEqual((await self.post(1)).status, HTTPStatus.OK)
+        self.assertEqual(self.server.application.update_queue.qsize(), 1)
+        self.assertEqual(self.server.deduplicator.duplicates, 1)
+
+    async def test_wrong_secret_token_is_forbidden(self):
+        self.assertEqual((await self.post(1, secret="wrong-token")).status, HTTPStatus.FORBIDDEN)
+        self.assertEqual(self.server.forbidden, 1)
+        self.assertNotIn(1, self.server.deduplicator.seen)
+
+
+if __name__ == '__main__':
+    unittest.main()